@@ -4,20 +4,36 @@ import asyncio
 import re
 import json
 import logging
+import random
 import base64
-from typing import Optional
+import hashlib
+import secrets
+import mimetypes
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from string import Template
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from types import MappingProxyType
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Tuple, Union
 from datetime import datetime
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Query
+from urllib.parse import unquote
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response, StreamingResponse, FileResponse
-import json as json_lib
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder
+from fastapi.responses import ORJSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from dotenv import load_dotenv
 import httpx
-from PIL import Image
+import orjson
+from cachetools import LRUCache, TTLCache
+from PIL import Image, ImageOps
 import fal_client
 import replicate
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 load_dotenv()
 
@@ -83,7 +99,41 @@ logging.basicConfig(
 cost_logger = logging.getLogger('costs')
 cost_logger.setLevel(logging.INFO)
 
-app = FastAPI(title="Background Remover API")
+# Общий HTTP-клиент (пул соединений, HTTP/2), создаётся при старте приложения
+http_pool: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Получение общего HTTP-клиента (создаётся при первом обращении)"""
+    global http_pool
+    if http_pool is None or http_pool.is_closed:
+        http_pool = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=100, max_connections=1000, keepalive_expiry=30.0),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            # Клиент общий для всех пользователей - cookies ответов не сохраняем
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+        )
+    return http_pool
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Создание общего HTTP-клиента при старте и закрытие при остановке"""
+    global http_pool
+    get_http_client()
+    yield
+    if http_pool is not None:
+        await http_pool.aclose()
+        http_pool = None
+
+app = FastAPI(title="Background Remover API", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Ошибки HTTPException тоже сериализуем через orjson (по умолчанию FastAPI отдает их через JSONResponse)
+@app.exception_handler(StarletteHTTPException)
+async def orjson_http_exception_handler(request: Request, exc: StarletteHTTPException):
+    """Ответ с ошибкой в формате {"detail": ...}"""
+    if exc.status_code < 200 or exc.status_code in (204, 304):
+        return Response(status_code=exc.status_code, headers=exc.headers)
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers)
 
 # Статические файлы (CSS, JS)
 app.mount("/static", StaticFiles(directory="."), name="static")
@@ -97,76 +147,493 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Хранилище токенов Яндекс Диска
-yandex_tokens = set()
+# Уже сжатые форматы (изображения, архивы) и SSE отдаются без gzip - по Content-Type ответа
+NO_GZIP_MEDIA_TYPES = ("image/", "video/", "audio/", "application/zip", "application/gzip", "application/octet-stream", "text/event-stream")
+
+class MediaTypeGZipResponder(GZipResponder):
+    """GZipResponder, пропускающий без сжатия ответы с типами из NO_GZIP_MEDIA_TYPES"""
+    async def send_with_gzip(self, message):
+        if message["type"] == "http.response.start":
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            if content_type.startswith(NO_GZIP_MEDIA_TYPES):
+                await self.send(message)
+                # Тело такого ответа уходит как есть (та же ветка, что и для ответов с Content-Encoding)
+                self.started = True
+                self.content_encoding_set = True
+                return
+        await super().send_with_gzip(message)
+
+class MediaTypeGZipMiddleware(GZipMiddleware):
+    """Сжатие JSON/HTML ответов (включая /static), изображения и SSE проходят без сжатия"""
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = MediaTypeGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+app.add_middleware(MediaTypeGZipMiddleware, minimum_size=1024)
+
+# Хранилище токенов Яндекс Диска (ограничено по размеру и времени жизни, чтобы не расти бесконечно)
+yandex_tokens = TTLCache(maxsize=10_000, ttl=3600)
+
+# Токен и OAuth настройки Яндекс Диска из .env (читаются один раз при старте)
+YANDEX_ENV_TOKEN = os.getenv("YANDEX_DISK_TOKEN")
+YANDEX_CLIENT_ID = os.getenv("YANDEX_DISK_CLIENT_ID")
+YANDEX_CLIENT_SECRET = os.getenv("YANDEX_DISK_CLIENT_SECRET")
+# Для Railway обязательно задать YANDEX_DISK_REDIRECT_URI, localhost - fallback для локальной разработки
+YANDEX_REDIRECT_URI = os.getenv("YANDEX_DISK_REDIRECT_URI") or "http://localhost:8000/auth/yandex/callback"
+
+# Расширения файлов для поддерживаемых MIME типов изображений
+IMAGE_MIME_EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/gif": "gif",
+    "image/webp": "webp",
+}
+
+# Content-Type по расширению файла (для ответов, где сервер отдал application/octet-stream)
+EXTENSION_CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+
+def guess_content_type(path: str) -> str:
+    """Content-Type по расширению пути (неизвестные расширения - через mimetypes)"""
+    extension = os.path.splitext(path)[1].lower()
+    return EXTENSION_CONTENT_TYPES.get(extension) or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+def sniff_mime(image_bytes: Union[bytes, BinaryIO]) -> str:
+    """Определение MIME типа изображения по первым байтам (по умолчанию JPEG)"""
+    if not isinstance(image_bytes, bytes):
+        # Файловый объект: читаем заголовок и возвращаемся в начало
+        position = image_bytes.tell()
+        head = image_bytes.read(12)
+        image_bytes.seek(position)
+        image_bytes = head
+    if image_bytes[:3] == b'\xff\xd8\xff':
+        return "image/jpeg"
+    if image_bytes[:8] == b'\x89PNG\r\n\x1a\n':
+        return "image/png"
+    if image_bytes[:6] in (b'GIF87a', b'GIF89a'):
+        return "image/gif"
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return "image/webp"
+    return "image/jpeg"
+
+# Пути к URL результата в ответах провайдеров: {"image": {"url": ...}}, {"image": "..."}, {"output": ...}, {"images": [...]}
+RESULT_URL_PATHS = (
+    ("image", "url"),
+    ("image",),
+    ("output", "url"),
+    ("output",),
+    ("images", 0, "url"),
+    ("images", 0),
+)
+
+def extract_result_url(result) -> Optional[str]:
+    """Извлечение URL результата из ответа провайдера (строка или словарь)"""
+    if isinstance(result, str):
+        return result
+    if not isinstance(result, dict):
+        return None
+    for path in RESULT_URL_PATHS:
+        current = result
+        for key in path:
+            if isinstance(key, int):
+                if not (isinstance(current, list) and len(current) > key):
+                    break
+                current = current[key]
+            elif isinstance(current, dict) and key in current:
+                current = current[key]
+            else:
+                break
+        else:
+            if isinstance(current, str):
+                return current
+    return None
+
+# Размер чанка при потоковой передаче файлов
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Кэш результатов обработки по хэшу изображения и модели (ограничен суммарным размером, RESULT_CACHE_MB)
+RESULT_CACHE = LRUCache(maxsize=int(os.getenv("RESULT_CACHE_MB", "256")) * 1024 * 1024, getsizeof=len)
+
+def cache_result(cache_key: str, result: bytes):
+    """Сохранение результата в кэш (слишком большие результаты не кэшируются)"""
+    if len(result) <= RESULT_CACHE.maxsize:
+        RESULT_CACHE[cache_key] = result
+
+# Запросы /api/process, которые обрабатываются прямо сейчас (ключ кэша -> будущий результат):
+# одинаковый запрос ждет результат первого, а не вызывает платный API второй раз
+INFLIGHT_RESULTS: Dict[str, asyncio.Future] = {}
+# Сколько секунд ждать результат одинакового запроса, прежде чем обработать изображение самому
+INFLIGHT_WAIT_SECONDS = float(os.getenv("INFLIGHT_WAIT_SECONDS", "120"))
+
+def finish_inflight(cache_key: str, result: Optional[bytes]):
+    """Передача результата ожидающим одинаковым запросам (None - результата нет, ожидающие обработают изображение сами)"""
+    future = INFLIGHT_RESULTS.pop(cache_key, None)
+    if future is not None and not future.done():
+        future.set_result(result)
+
+async def send_following_redirects(client: httpx.AsyncClient, request: httpx.Request, stream: bool = False) -> httpx.Response:
+    """Отправка с переходом по редиректам и cookies только в пределах этой цепочки (общий клиент cookies не хранит)"""
+    # Ссылки Яндекс Диска ведут через downloader.disk.yandex.ru: cookie, выставленный на одном шаге, нужен на следующем
+    cookies = httpx.Cookies()
+    for _ in range(client.max_redirects + 1):
+        response = await client.send(request, stream=stream)
+        if not response.has_redirect_location:
+            return response
+        cookies.extract_cookies(response)
+        request = response.next_request
+        await response.aclose()
+        cookies.set_cookie_header(request)
+    raise httpx.TooManyRedirects("Exceeded maximum allowed redirects.", request=request)
+
+# Ответы внешних API, при которых имеет смысл повторить запрос
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+async def send_with_retry(request: httpx.Request, stream: bool = False, follow_redirects: bool = False,
+                          max_attempts: int = 4, base_delay: float = 0.5) -> httpx.Response:
+    """Отправка запроса с повторами при 429/5xx и сетевых ошибках (экспоненциальная задержка с джиттером, учитывает Retry-After)"""
+    client = get_http_client()
+    for attempt in range(1, max_attempts + 1):
+        delay = min(60.0, base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+        try:
+            if follow_redirects:
+                response = await send_following_redirects(client, request, stream=stream)
+            else:
+                response = await client.send(request, stream=stream)
+        except httpx.TransportError as e:
+            if attempt == max_attempts:
+                raise
+            logging.warning(f"{request.method} {request.url.host} failed: {str(e)}, retry {attempt}/{max_attempts - 1} in {delay:.1f}s")
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt == max_attempts:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = min(60.0, float(retry_after))
+            await response.aclose()
+            logging.warning(f"{request.method} {request.url.host} returned {response.status_code}, retry {attempt}/{max_attempts - 1} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+async def open_download_stream(url: str, headers: Optional[dict] = None) -> httpx.Response:
+    """Открытие потокового скачивания (тело не читается в память)"""
+    request = get_http_client().build_request("GET", url, headers=headers, timeout=60.0)
+    return await send_with_retry(request, stream=True, follow_redirects=True)
+
+async def iter_download_stream(response: httpx.Response, cache_key: Optional[str] = None, inflight_key: Optional[str] = None):
+    """Отдача тела ответа чанками с закрытием соединения по окончании (с cache_key полный ответ сохраняется в RESULT_CACHE и передается ожидающим по inflight_key)"""
+    chunks = [] if cache_key else None
+    result = None
+    try:
+        async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+            if chunks is not None:
+                chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            result = b"".join(chunks)
+            cache_result(cache_key, result)
+    finally:
+        await response.aclose()
+        if cache_key:
+            finish_inflight(inflight_key or cache_key, result)
+
+class UpstreamStreamingResponse(StreamingResponse):
+    """Потоковая отдача открытого ответа провайдера (соединение закрывается, даже если отдача тела не началась)"""
+    def __init__(self, upstream: httpx.Response, cache_key: Optional[str] = None, inflight_key: Optional[str] = None, **kwargs):
+        super().__init__(iter_download_stream(upstream, cache_key=cache_key, inflight_key=inflight_key), **kwargs)
+        self.upstream = upstream
+        self.inflight_key = inflight_key or cache_key
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Клиент мог отключиться до начала тела - генератор тогда не запускался и сам соединение не закроет
+            await self.body_iterator.aclose()
+            await self.upstream.aclose()
+            # Если результат не был передан ожидающим (поток не дошел до конца) - они обработают изображение сами
+            if self.inflight_key:
+                finish_inflight(self.inflight_key, None)
+
+# Максимальный размер файла, скачиваемого в память для пакетной обработки (MAX_DOWNLOAD_MB)
+MAX_DOWNLOAD_BYTES = int(os.getenv("MAX_DOWNLOAD_MB", "50")) * 1024 * 1024
+
+# ETag последней скачанной версии файла пакетной обработки по URL (для условного GET с If-None-Match)
+DOWNLOAD_ETAGS = TTLCache(maxsize=4096, ttl=3600)
+
+async def read_download_limited(response: httpx.Response, max_bytes: int) -> Optional[bytes]:
+    """Чтение тела потокового ответа не больше max_bytes (None - файл больше лимита), соединение закрывается"""
+    try:
+        content_length = response.headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > max_bytes:
+            return None
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+            buffer.extend(chunk)
+            if len(buffer) > max_bytes:
+                return None
+        return bytes(buffer)
+    finally:
+        await response.aclose()
+
+async def fetch_result(url: str, label: str, stream: bool = False):
+    """Скачивание результата модели по URL (при stream=True возвращается открытый потоковый ответ)"""
+    response = await open_download_stream(url)
+    if response.status_code != 200:
+        await response.aclose()
+        raise HTTPException(status_code=500, detail=f"Failed to download {label} result: {response.status_code}")
+    if stream:
+        return response
+    await response.aread()
+    return response.content
 
 # Модели обработки
-async def process_removebg(image_bytes: bytes, api_key: str) -> bytes:
-    """Remove.bg API"""
-    async with httpx.AsyncClient() as client:
-        files = {"image_file": ("image.jpg", image_bytes, "image/jpeg")}
-        data = {"size": "auto"}
-        headers = {"X-Api-Key": api_key}
-        
-        response = await client.post(
-            "https://api.remove.bg/v1.0/removebg",
-            files=files,
-            data=data,
-            headers=headers,
-            timeout=30.0
-        )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail=f"Remove.bg API error: {response.text}")
-        
-        return response.content
+async def process_removebg(image_bytes: Union[bytes, BinaryIO], api_key: str, prompt: Optional[str] = None, mime: Optional[str] = None, stream: bool = False):
+    """Remove.bg API (принимает bytes или файловый объект - файл отправляется потоком)"""
+    mime = mime or sniff_mime(image_bytes)
+    client = get_http_client()
+    files = {"image_file": (f"image.{IMAGE_MIME_EXTENSIONS[mime]}", image_bytes, mime)}
+    data = {"size": "auto"}
+    headers = {"X-Api-Key": api_key}
+    
+    request = client.build_request(
+        "POST",
+        "https://api.remove.bg/v1.0/removebg",
+        files=files,
+        data=data,
+        headers=headers,
+        timeout=30.0
+    )
+    response = await send_with_retry(request, stream=stream)
+    
+    if response.status_code != 200:
+        await response.aread()
+        raise HTTPException(status_code=response.status_code, detail=f"Remove.bg API error: {response.text}")
+    
+    return response if stream else response.content
 
-async def process_clipdrop(image_bytes: bytes, api_key: str) -> bytes:
-    """Clipdrop API"""
-    async with httpx.AsyncClient() as client:
-        files = {"image_file": ("image.jpg", image_bytes, "image/jpeg")}
-        headers = {"x-api-key": api_key}
-        
-        response = await client.post(
-            "https://clipdrop-api.co/remove-background/v1",
-            files=files,
-            headers=headers,
-            timeout=30.0
-        )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail=f"Clipdrop API error: {response.text}")
-        
-        return response.content
+async def process_clipdrop(image_bytes: Union[bytes, BinaryIO], api_key: str, prompt: Optional[str] = None, mime: Optional[str] = None, stream: bool = False):
+    """Clipdrop API (принимает bytes или файловый объект - файл отправляется потоком)"""
+    mime = mime or sniff_mime(image_bytes)
+    client = get_http_client()
+    files = {"image_file": (f"image.{IMAGE_MIME_EXTENSIONS[mime]}", image_bytes, mime)}
+    headers = {"x-api-key": api_key}
+    
+    request = client.build_request(
+        "POST",
+        "https://clipdrop-api.co/remove-background/v1",
+        files=files,
+        headers=headers,
+        timeout=30.0
+    )
+    response = await send_with_retry(request, stream=stream)
+    
+    if response.status_code != 200:
+        await response.aread()
+        raise HTTPException(status_code=response.status_code, detail=f"Clipdrop API error: {response.text}")
+    
+    return response if stream else response.content
+
+@lru_cache(maxsize=32)
+def get_replicate_client(api_key: str) -> replicate.Client:
+    """Клиент Replicate для ключа (кэшируется, чтобы не создавать HTTP-сессию на каждый запрос)"""
+    return replicate.Client(api_token=api_key)
+
+@lru_cache(maxsize=32)
+def get_fal_client(api_key: Optional[str]) -> fal_client.AsyncClient:
+    """Клиент FAL для ключа (кэшируется - внутренний httpx клиент с пулом соединений создается один раз)"""
+    return fal_client.AsyncClient(key=api_key)
+
+async def run_replicate_model(replicate_client: replicate.Client, model_info: dict, file_obj: io.BytesIO, stream: bool = False):
+    """Один запуск модели Replicate: результат в bytes (или открытый ответ при stream=True)"""
+    # Подготавливаем input для модели
+    # Согласно документации Replicate, можно передать file object напрямую
+    # bria/remove-background может принимать file object или URL
+    # 851-labs/background-remover и lucataco/remove-bg тоже принимают file objects
+    if model_info['name'] == "bria/remove-background":
+        # bria/remove-background принимает image как file object или URL
+        model_input = {
+            "image": file_obj
+        }
+    else:
+        # Inne modele принимают image, format i background_type
+        model_input = {
+            "image": file_obj,
+            "format": "png",
+            "background_type": "rgba"  # прозрачный фон
+        }
+    
+    # Используем replicate.run() - согласно документации Replicate
+    # replicate.run() синхронный, используем asyncio.to_thread() для async
+    # Согласно документации, replicate.run() может принимать file objects напрямую
+    # SDK сам делает seek(0) перед чтением, поэтому один file object переиспользуется между попытками
+    logging.info(f"Running model {model_info['name']} with file object")
+    output = await asyncio.to_thread(
+        replicate_client.run,
+        model_info['full_id'],
+        input=model_input
+    )
+    
+    logging.info(f"Replicate model {model_info['name']} succeeded")
+    # Подробности ответа - только при DEBUG (форматирование ленивое)
+    logging.debug("Replicate output type: %s, value (first 200 chars): %.200s", type(output), output)
+    if isinstance(output, list) and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Output is a list with %d items", len(output))
+        for item_idx, item in enumerate(output[:3]):  # Log first 3 items
+            logging.debug("  Output[%d]: %s, value: %.100s", item_idx, type(item), item)
+    
+    # output может быть FileOutput объект (с методом .read()) или список FileOutput
+    # Согласно документации Replicate v1.0.0+, replicate.run() возвращает FileOutput объекты
+    result_bytes = None
+    
+    if hasattr(output, 'read'):
+        # Если это FileOutput объект (replicate v1.0.0+)
+        logging.info("Output is FileOutput object, using .read() method")
+        result_bytes = output.read()
+    elif isinstance(output, list) and len(output) > 0:
+        # Если это список FileOutput объектов, берем первый
+        logging.info(f"Output is a list with {len(output)} items, using first item")
+        first_item = output[0]
+        if hasattr(first_item, 'read'):
+            result_bytes = first_item.read()
+        elif isinstance(first_item, str):
+            # Если это URL строка
+            output_url = first_item
+        else:
+            output_url = str(first_item)
+    elif isinstance(output, str):
+        # Если это строка URL
+        output_url = output
+    elif hasattr(output, 'url'):
+        # Если это объект с URL
+        output_url = output.url
+    else:
+        # Пробуем преобразовать в строку (может быть URL)
+        output_url = str(output) if output else None
+    
+    # Если result_bytes уже получен через .read(), возвращаем его
+    if result_bytes:
+        logging.info(f"Replicate processing completed successfully using model: {model_info['name']}")
+        return result_bytes
+    
+    # Если есть URL, скачиваем результат
+    if output_url:
+        logging.info(f"Downloading result from URL: {output_url[:100]}...")
+        result = await fetch_result(output_url, "Replicate", stream=stream)
+        logging.info(f"Replicate processing completed successfully using model: {model_info['name']}")
+        return result
+    
+    # Если ничего не сработало
+    raise HTTPException(status_code=500, detail=f"Unexpected Replicate output format: {type(output)}, value: {str(output)[:200]}")
+
+# Через сколько секунд без ответа запускать следующую fallback-модель Replicate параллельно
+# 0 (по умолчанию) - строго последовательно: каждый параллельный запуск оплачивается отдельно, поэтому hedging включается явно
+REPLICATE_HEDGE_SECONDS = float(os.getenv("REPLICATE_HEDGE_SECONDS", "0"))
+# Пауза перед следующей моделью после ответа о превышении лимита запросов Replicate
+REPLICATE_RATE_LIMIT_WAIT = 15
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Ошибка превышения лимита запросов Replicate (429 / throttled)"""
+    error_str = str(error).lower()
+    return "429" in error_str or "rate limit" in error_str or "throttled" in error_str
+
+async def hedge_replicate_models(replicate_client: replicate.Client, models: List[dict], image_bytes: bytes, mime: str, hedge_delay: float, stream: bool = False):
+    """Hedged fallback: следующая модель стартует, если текущие не ответили за hedge_delay секунд или упали; возвращается первый успешный результат"""
+    # hedge_delay=0 - все модели сразу (race): время ответа как у самой быстрой модели, но платим за каждый запуск.
+    # Отмена не останавливает уже запущенный replicate.run в потоке, только освобождает запрос
+    # Каждой задаче свой BytesIO: потоки читают параллельно (буфер bytes при этом не копируется)
+    loop = asyncio.get_running_loop()
+    tasks = {}
+    pending = set()
+    next_idx = 0
+    next_launch = loop.time()
+    last_error = None
+    try:
+        while True:
+            if next_idx < len(models) and loop.time() >= next_launch:
+                # Ответа нет (таймаут или ошибка) - добавляем следующую модель к уже запущенным
+                model_info = models[next_idx]
+                next_idx += 1
+                file_obj = io.BytesIO(image_bytes)
+                file_obj.name = f"image.{IMAGE_MIME_EXTENSIONS[mime]}"
+                task = asyncio.create_task(run_replicate_model(replicate_client, model_info, file_obj, stream=stream))
+                tasks[task] = model_info['name']
+                pending.add(task)
+                logging.info(f"Trying Replicate model {next_idx}/{len(models)}: {model_info['name']}")
+                next_launch = loop.time() + hedge_delay
+            if not pending and next_idx >= len(models):
+                break
+            timeout = max(0.0, next_launch - loop.time()) if next_idx < len(models) else None
+            if not pending:
+                # Все запущенные модели упали по лимиту запросов - выдерживаем паузу перед следующей
+                await asyncio.sleep(timeout)
+                continue
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            http_error = None
+            failed = rate_limited = False
+            for task in done:
+                error = task.exception()
+                if isinstance(error, HTTPException):
+                    http_error = error
+                elif error is not None:
+                    last_error = error
+                    failed = True
+                    rate_limited = rate_limited or is_rate_limit_error(error)
+                    logging.warning(f"Replicate model {tasks[task]} failed: {str(error)}")
+                elif winner is None:
+                    winner = task
+                elif isinstance(task.result(), httpx.Response):
+                    # Одновременно завершившийся проигравший - закрываем его поток
+                    await task.result().aclose()
+            if winner is not None:
+                logging.info(f"Replicate result from model: {tasks[winner]}")
+                return winner.result()
+            if http_error is not None:
+                # Как и в последовательном режиме, HTTPException пробрасываем дальше без fallback
+                raise http_error
+            if rate_limited:
+                # Лимит запросов - следующую модель запускаем не сразу, а после паузы
+                logging.warning(f"Rate limit detected. Waiting {REPLICATE_RATE_LIMIT_WAIT} seconds before trying next model...")
+                next_launch = loop.time() + REPLICATE_RATE_LIMIT_WAIT
+            elif failed:
+                next_launch = loop.time()
+    finally:
+        for task in pending:
+            task.cancel()
+    
+    logging.error(f"All Replicate models failed. Last error: {str(last_error)}")
+    raise HTTPException(status_code=500, detail=f"All Replicate models failed. Last error: {str(last_error)}")
 
-async def process_replicate(image_bytes: bytes, api_key: str, prompt: Optional[str] = None) -> bytes:
+async def process_replicate(image_bytes: bytes, api_key: str, prompt: Optional[str] = None, mime: Optional[str] = None, stream: bool = False, race: bool = False):
     """Replicate API с fallback на три модели: bria/remove-background (primary), 851-labs/background-remover (fallback 1), lucataco/remove-bg (fallback 2)"""
     # Используем REPLICATE_API_KEY из .env если не передан ключ
     if not api_key:
-        api_key = os.getenv("REPLICATE_API_KEY", "")
+        api_key = ENV_API_KEYS["replicate"]
     
     if not api_key:
         raise HTTPException(status_code=400, detail="Replicate API key not provided")
     
-    # Проверяем доступные методы (упрощенное логирование для production)
-    try:
-        logging.info("Initializing Replicate client...")
-        if hasattr(replicate, 'Client'):
-            logging.info("replicate.Client available")
-        if hasattr(replicate, 'run'):
-            logging.info("replicate.run available")
-        if hasattr(replicate, 'files'):
-            logging.info("replicate.files available")
-    except Exception as debug_error:
-        logging.warning(f"Error during replicate module check: {str(debug_error)}")
-    
-    # Устанавливаем API токен для replicate
-    # Согласно документации, replicate.run() использует REPLICATE_API_TOKEN из env
-    os.environ["REPLICATE_API_TOKEN"] = api_key
+    # Проверяем доступные методы (только при DEBUG логировании)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Initializing Replicate client...")
+        for attr in ('Client', 'run', 'files'):
+            if hasattr(replicate, attr):
+                logging.debug("replicate.%s available", attr)
+    
+    # Клиент с ключом запроса (без записи токена в os.environ), переиспользуется между запросами
+    replicate_client = get_replicate_client(api_key)
     
     # Согласно документации Replicate, можно передать file object напрямую в replicate.run()
     # replicate.run() автоматически загрузит файл, если это необходимо
-    logging.info(f"Replicate: Preparing image file (size: {len(image_bytes)} bytes)")
+    mime = mime or sniff_mime(image_bytes)
+    logging.info(f"Replicate: Preparing image file (size: {len(image_bytes)} bytes, type: {mime})")
     
     # Список моделей для попытки (primary и fallback)
     models = [
@@ -184,6 +651,16 @@ async def process_replicate(image_bytes: bytes, api_key: str, prompt: Optional[s
         }
     ]
     
+    if race:
+        return await hedge_replicate_models(replicate_client, models, image_bytes, mime, 0, stream=stream)
+    if REPLICATE_HEDGE_SECONDS > 0:
+        # Медленная основная модель не блокирует fallback на весь таймаут
+        return await hedge_replicate_models(replicate_client, models, image_bytes, mime, REPLICATE_HEDGE_SECONDS, stream=stream)
+    
+    # Один file object на все последовательные попытки
+    file_obj = io.BytesIO(image_bytes)
+    file_obj.name = f"image.{IMAGE_MIME_EXTENSIONS[mime]}"
+    
     # Пробуем каждый модель, используя первый успешный
     last_error = None
     for idx, model_info in enumerate(models):
@@ -195,106 +672,16 @@ async def process_replicate(image_bytes: bytes, api_key: str, prompt: Optional[s
                 await asyncio.sleep(delay_seconds)
             
             logging.info(f"Trying Replicate model {idx + 1}/{len(models)}: {model_info['name']}")
-            
-            # Создаем новый BytesIO для каждой попытки (так как он может быть использован)
-            file_obj = io.BytesIO(image_bytes)
-            file_obj.name = "image.jpg"
-            
-            # Подготавливаем input для модели
-            # Согласно документации Replicate, можно передать file object напрямую
-            # bria/remove-background может принимать file object или URL
-            # 851-labs/background-remover и lucataco/remove-bg тоже принимают file objects
-            if model_info['name'] == "bria/remove-background":
-                # bria/remove-background принимает image как file object или URL
-                model_input = {
-                    "image": file_obj
-                }
-            else:
-                # Inne modele принимают image, format i background_type
-                model_input = {
-                    "image": file_obj,
-                    "format": "png",
-                    "background_type": "rgba"  # прозрачный фон
-                }
-            
-            # Используем replicate.run() - согласно документации Replicate
-            # replicate.run() синхронный, используем asyncio.to_thread() для async
-            # Согласно документации, replicate.run() может принимать file objects напрямую
-            logging.info(f"Running model {model_info['name']} with file object (size: {len(image_bytes)} bytes)")
-            output = await asyncio.to_thread(
-                replicate.run,
-                model_info['full_id'],
-                input=model_input
-            )
-            
-            logging.info(f"Replicate model {model_info['name']} succeeded, output type: {type(output)}")
-            logging.info(f"Replicate output value (first 200 chars): {str(output)[:200] if output else 'None'}")
-            if isinstance(output, list):
-                logging.info(f"Output is a list with {len(output)} items")
-                for idx, item in enumerate(output[:3]):  # Log first 3 items
-                    logging.info(f"  Output[{idx}]: {type(item)}, value: {str(item)[:100]}")
-            
-            # output может быть FileOutput объект (с методом .read()) или список FileOutput
-            # Согласно документации Replicate v1.0.0+, replicate.run() возвращает FileOutput объекты
-            result_bytes = None
-            
-            if hasattr(output, 'read'):
-                # Если это FileOutput объект (replicate v1.0.0+)
-                logging.info("Output is FileOutput object, using .read() method")
-                result_bytes = output.read()
-            elif isinstance(output, list) and len(output) > 0:
-                # Если это список FileOutput объектов, берем первый
-                logging.info(f"Output is a list with {len(output)} items, using first item")
-                first_item = output[0]
-                if hasattr(first_item, 'read'):
-                    result_bytes = first_item.read()
-                elif isinstance(first_item, str):
-                    # Если это URL строка
-                    output_url = first_item
-                else:
-                    output_url = str(first_item)
-            elif isinstance(output, str):
-                # Если это строка URL
-                output_url = output
-            elif hasattr(output, 'url'):
-                # Если это объект с URL
-                output_url = output.url
-            else:
-                # Пробуем преобразовать в строку (может быть URL)
-                output_url = str(output) if output else None
-            
-            # Если result_bytes уже получен через .read(), возвращаем его
-            if result_bytes:
-                logging.info(f"Replicate processing completed successfully using model: {model_info['name']}")
-                return result_bytes
-            
-            # Если есть URL, скачиваем результат
-            if output_url:
-                logging.info(f"Downloading result from URL: {output_url[:100]}...")
-                async with httpx.AsyncClient() as http_client:
-                    response = await http_client.get(output_url, timeout=60.0, follow_redirects=True)
-                    if response.status_code != 200:
-                        raise HTTPException(status_code=500, detail=f"Failed to download Replicate result: {response.status_code}")
-                    result_bytes = response.content
-                    logging.info(f"Replicate processing completed successfully using model: {model_info['name']}")
-                    return result_bytes
-            
-            # Если ничего не сработало
-            raise HTTPException(status_code=500, detail=f"Unexpected Replicate output format: {type(output)}, value: {str(output)[:200]}")
+            return await run_replicate_model(replicate_client, model_info, file_obj, stream=stream)
             
         except HTTPException:
             # HTTPException пробрасываем дальше без fallback
             raise
         except Exception as e:
-            # Проверяем, является ли это ошибкой rate limiting (429)
-            error_str = str(e)
-            is_rate_limit = "429" in error_str or "rate limit" in error_str.lower() or "throttled" in error_str.lower()
-            
-            if is_rate_limit and idx < len(models) - 1:
-                # Если это rate limit и есть еще модели, ждем дольше перед следующей попыткой
-                wait_time = 15  # 15 секунд для rate limit
-                logging.warning(f"Rate limit detected for model {model_info['name']}. Waiting {wait_time} seconds before trying next model...")
-                await asyncio.sleep(wait_time)
+            # Если это rate limit (429) и есть еще модели, ждем дольше перед следующей попыткой
+            if is_rate_limit_error(e) and idx < len(models) - 1:
+                logging.warning(f"Rate limit detected for model {model_info['name']}. Waiting {REPLICATE_RATE_LIMIT_WAIT} seconds before trying next model...")
+                await asyncio.sleep(REPLICATE_RATE_LIMIT_WAIT)
             
             # Сохраняем ошибку и пробуем следующий модель
             last_error = e
@@ -310,189 +697,71 @@ async def process_replicate(image_bytes: bytes, api_key: str, prompt: Optional[s
         
         # Используем replicate.run с новым моделью и URL изображения
         # replicate.run() синхронный, но możemy użyć asyncio.to_thread() dla async
-async def process_fal(image_bytes: bytes, api_key: str, prompt: Optional[str] = None) -> bytes:
-    """FAL через fal-client используя fal-ai/imageutils/rembg"""
-    import base64
-    
+async def run_fal_model(endpoint: str, label: str, image_bytes: bytes, api_key: str, mime: Optional[str] = None, stream: bool = False):
+    """Общий запуск модели FAL через fal-client: upload, submit, ожидание и скачивание результата"""
     # Используем FAL_KEY из .env если не передан ключ, иначе устанавливаем переданный
     # FAL_KEY скрыт в переменных окружения (Railway variables или .env)
     if not api_key:
-        api_key = os.getenv("FAL_KEY", "")
-    if api_key:
-        os.environ["FAL_KEY"] = api_key
+        api_key = ENV_API_KEYS["fal"]
+    # Клиент с ключом запроса (без записи ключа в os.environ), переиспользуется между запросами
+    fal = get_fal_client(api_key or None)
     
     try:
         # FAL требует upload файла в их storage и получения URL
-        # fal_client.upload() принимает bytes напрямую, не BytesIO
-        # Upload файла в FAL storage и получаем URL (synchronous, не async)
-        image_url = fal_client.upload(image_bytes, content_type="image/jpeg")
+        # fal.upload() принимает bytes напрямую, не BytesIO (не блокирует event loop)
+        image_url = await fal.upload(image_bytes, content_type=mime or sniff_mime(image_bytes))
         
         # Проверяем, что URL получен
         if not image_url:
             raise HTTPException(status_code=500, detail="FAL: Failed to upload image, no URL returned")
         
-        logging.info(f"FAL image uploaded, URL: {image_url[:100]}...")
-        
-        # Подготавливаем аргументы для fal-ai/imageutils/rembg
-        arguments = {
-            "image_url": image_url
-        }
+        logging.info(f"{label} image uploaded, URL: {image_url[:100]}...")
         
         # Используем fal-client для асинхронной обработки
-        # FAL_KEY должен быть установлен в окружении (загружается из .env или Railway variables)
-        handler = await fal_client.submit_async(
-            "fal-ai/imageutils/rembg",
-            arguments=arguments,
-        )
-        
-        # Ждем завершения и логируем события
-        async for event in handler.iter_events(with_logs=True):
-            # Можно логировать события если нужно
-            if hasattr(event, 'type'):
-                logging.info(f"FAL event: {event.type}")
-        
-        result = await handler.get()
-        
-        # Логируем результат для отладки
-        logging.info(f"FAL result type: {type(result)}, content: {str(result)[:200] if result else 'None'}")
-        
-        # Получаем URL результата
-        # FAL возвращает {"image": {"url": "...", ...}} или {"image": "url_string"}
-        result_url = None
-        if isinstance(result, dict):
-            if "image" in result:
-                image_data = result["image"]
-                # Если image это объект с url
-                if isinstance(image_data, dict) and "url" in image_data:
-                    result_url = image_data["url"]
-                # Если image это строка (URL)
-                elif isinstance(image_data, str):
-                    result_url = image_data
-            elif "output" in result:
-                output_data = result["output"]
-                if isinstance(output_data, dict) and "url" in output_data:
-                    result_url = output_data["url"]
-                elif isinstance(output_data, str):
-                    result_url = output_data
-            elif "images" in result and len(result["images"]) > 0:
-                first_image = result["images"][0]
-                if isinstance(first_image, dict) and "url" in first_image:
-                    result_url = first_image["url"]
-                elif isinstance(first_image, str):
-                    result_url = first_image
-        elif isinstance(result, str):
-            result_url = result
-        
-        if not result_url:
-            logging.error(f"FAL result structure: {result}")
-            raise HTTPException(status_code=500, detail=f"FAL: No image URL in result. Result: {str(result)[:500]}")
-        
-        # Скачиваем результат
-        async with httpx.AsyncClient() as client:
-            response = await client.get(result_url, timeout=60.0)
-            if response.status_code != 200:
-                raise HTTPException(status_code=500, detail=f"Failed to download FAL result: {response.status_code}")
-            return response.content
-            
-    except HTTPException:
-        raise
-    except Exception as e:
-        logging.error(f"FAL processing error: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"FAL processing error: {str(e)}")
-
-async def process_fal_object_removal(image_bytes: bytes, api_key: str, prompt: Optional[str] = None) -> bytes:
-    """FAL через fal-client используя fal-ai/image-editing/object-removal"""
-    
-    # Используем FAL_KEY из .env если не передан ключ, иначе устанавливаем переданный
-    # FAL_KEY скрыт в переменных окружения (Railway variables или .env)
-    if not api_key:
-        api_key = os.getenv("FAL_KEY", "")
-    if api_key:
-        os.environ["FAL_KEY"] = api_key
-    
-    try:
-        # FAL требует upload файла в их storage и получения URL
-        # fal_client.upload() принимает bytes напрямую, не BytesIO
-        # Upload файла в FAL storage и получаем URL (synchronous, не async)
-        image_url = fal_client.upload(image_bytes, content_type="image/jpeg")
-        
-        # Проверяем, что URL получен
-        if not image_url:
-            raise HTTPException(status_code=500, detail="FAL: Failed to upload image, no URL returned")
-        
-        logging.info(f"FAL Object Removal image uploaded, URL: {image_url[:100]}...")
-        
-        # Подготавливаем аргументы для fal-ai/image-editing/object-removal
-        arguments = {
-            "image_url": image_url
-        }
-        
-        # Используем fal_client.submit_async() для асинхронной обработки (podobnie jak process_fal)
-        # FAL_KEY должен быть установлен в окружении (загружается из .env или Railway variables)
-        handler = await fal_client.submit_async(
-            "fal-ai/image-editing/object-removal",
-            arguments=arguments,
+        handler = await fal.submit(
+            endpoint,
+            arguments={"image_url": image_url},
         )
         
         # Ждем завершения и логируем события
         async for event in handler.iter_events(with_logs=True):
-            # Можно логировать события если нужно
             if hasattr(event, 'type'):
-                logging.info(f"FAL Object Removal event: {event.type}")
+                logging.debug("%s event: %s", label, event.type)
             # Логируем сообщения из логов
             if hasattr(event, 'logs') and event.logs:
                 for log in event.logs:
                     if isinstance(log, dict) and 'message' in log:
-                        logging.info(f"FAL Object Removal log: {log.get('message', '')}")
+                        logging.debug("%s log: %s", label, log.get('message', ''))
         
         result = await handler.get()
         
         # Логируем результат для отладки
-        logging.info(f"FAL Object Removal result type: {type(result)}, content: {str(result)[:200] if result else 'None'}")
+        logging.debug("%s result type: %s, content: %.200s", label, type(result), result)
         
         # Получаем URL результата
         # FAL возвращает {"image": {"url": "...", ...}} или {"image": "url_string"}
-        result_url = None
-        if isinstance(result, dict):
-            if "image" in result:
-                image_data = result["image"]
-                # Если image это объект с url
-                if isinstance(image_data, dict) and "url" in image_data:
-                    result_url = image_data["url"]
-                # Если image это строка (URL)
-                elif isinstance(image_data, str):
-                    result_url = image_data
-            elif "output" in result:
-                output_data = result["output"]
-                if isinstance(output_data, dict) and "url" in output_data:
-                    result_url = output_data["url"]
-                elif isinstance(output_data, str):
-                    result_url = output_data
-            elif "images" in result and len(result["images"]) > 0:
-                first_image = result["images"][0]
-                if isinstance(first_image, dict) and "url" in first_image:
-                    result_url = first_image["url"]
-                elif isinstance(first_image, str):
-                    result_url = first_image
-        elif isinstance(result, str):
-            result_url = result
+        result_url = extract_result_url(result)
         
         if not result_url:
-            logging.error(f"FAL Object Removal result structure: {result}")
-            raise HTTPException(status_code=500, detail=f"FAL Object Removal: No image URL in result. Result: {str(result)[:500]}")
+            logging.error(f"{label} result structure: {result}")
+            raise HTTPException(status_code=500, detail=f"{label}: No image URL in result. Result: {str(result)[:500]}")
         
         # Скачиваем результат
-        async with httpx.AsyncClient() as client:
-            response = await client.get(result_url, timeout=60.0)
-            if response.status_code != 200:
-                raise HTTPException(status_code=500, detail=f"Failed to download FAL Object Removal result: {response.status_code}")
-            return response.content
-            
+        return await fetch_result(result_url, label, stream=stream)
+        
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"FAL Object Removal processing error: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"FAL Object Removal processing error: {str(e)}")
+        logging.error(f"{label} processing error: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"{label} processing error: {str(e)}")
+
+async def process_fal(image_bytes: bytes, api_key: str, prompt: Optional[str] = None, mime: Optional[str] = None, stream: bool = False):
+    """FAL через fal-client используя fal-ai/imageutils/rembg"""
+    return await run_fal_model("fal-ai/imageutils/rembg", "FAL", image_bytes, api_key, mime, stream)
+
+async def process_fal_object_removal(image_bytes: bytes, api_key: str, prompt: Optional[str] = None, mime: Optional[str] = None, stream: bool = False):
+    """FAL через fal-client используя fal-ai/image-editing/object-removal"""
+    return await run_fal_model("fal-ai/image-editing/object-removal", "FAL Object Removal", image_bytes, api_key, mime, stream)
 
 # Модели
 MODELS = {
@@ -503,20 +772,92 @@ MODELS = {
     "fal_object_removal": process_fal_object_removal
 }
 
+# Модели, которые принимают файловый объект и отправляют его потоком (без чтения в память)
+STREAMING_MODELS = {"removebg", "clipdrop"}
+
+# Лимиты одновременных запросов по умолчанию (у Replicate ниже из-за rate limit)
+MODEL_INFLIGHT_DEFAULTS = {
+    "removebg": 32,
+    "clipdrop": 32,
+    "replicate": 16,
+    "fal": 32,
+    "fal_object_removal": 32
+}
+
+# Ограничение количества одновременных запросов к каждому провайдеру (MAX_INFLIGHT_<MODEL>)
+MODEL_SEMAPHORES = {
+    model: asyncio.Semaphore(int(os.getenv(f"MAX_INFLIGHT_{model.upper()}", MODEL_INFLIGHT_DEFAULTS[model])))
+    for model in MODELS
+}
+
+# Сколько файлов пакетной обработки продуктов обрабатывается моделью одновременно (и столько же скачивается впрок)
+BATCH_FILE_CONCURRENCY = int(os.getenv("BATCH_FILE_CONCURRENCY", "8"))
+
+# Максимальная сторона изображения, отправляемого провайдерам (0 - отправлять как есть)
+MAX_UPLOAD_EDGE = int(os.getenv("MAX_UPLOAD_EDGE", "2048"))
+# Модели, которым отправляем оригинал без уменьшения
+FULL_RES_MODELS = {"fal_object_removal"}
+
+def shrink_image(image: Union[bytes, BinaryIO], max_edge: int) -> Optional[bytes]:
+    """Уменьшение изображения больше max_edge (JPEG q85, с альфа-каналом - PNG); None если уменьшать не нужно"""
+    try:
+        img = Image.open(io.BytesIO(image) if isinstance(image, bytes) else image)
+        if max(img.size) <= max_edge or getattr(img, "n_frames", 1) > 1:
+            return None
+        # Для JPEG декодируем сразу с уменьшением
+        img.draft(img.mode, (max_edge, max_edge))
+        # Поворот по EXIF применяем до ресайза - метаданные при перекодировании теряются
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            img.save(output, format="PNG")
+        else:
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.save(output, format="JPEG", quality=85)
+        return output.getvalue()
+    except Exception as e:
+        logging.warning(f"Could not shrink image, sending original: {str(e)}")
+        return None
+    finally:
+        if not isinstance(image, bytes):
+            image.seek(0)
+
+# Ограничение количества одновременных парсингов публичных папок Яндекс Диска
+YANDEX_SCRAPE_SEMAPHORE = asyncio.Semaphore(50)
+
+# Расширения изображений (поиск подстроки без учета регистра - без lower() на каждой строке)
+IMAGE_EXTENSION_RE = re.compile(r'\.(?:jpe?g|png|gif|webp|bmp|tiff|svg)', re.I)
+RASTER_EXTENSION_RE = re.compile(r'\.(?:jpe?g|png|gif|webp|bmp|tiff)', re.I)
+# Кэш распарсенных публичных папок (ключ - URL папки и режим парсинга), время жизни - PUBLIC_FOLDER_CACHE_TTL секунд
+PUBLIC_FOLDER_CACHE = TTLCache(maxsize=512, ttl=int(os.getenv("PUBLIC_FOLDER_CACHE_TTL", "60")))
+
+# ID публичной папки (/d/ID) и путь в формате /client/disk/PATH
+YANDEX_FOLDER_ID_RE = re.compile(r'/d/([^/?]+)')
+YANDEX_CLIENT_PATH_RE = re.compile(r'/client/disk/([^/?]+)')
+# Классы элементов файлов на странице публичной папки
+DISK_CLASS_RE = re.compile(r'(file|item|resource|photo|image)', re.I)
+
+def intern_short(value: str) -> str:
+    """Интернирование коротких имён/URL (длинные строки не закрепляем в памяти)"""
+    return sys.intern(value) if len(value) < 256 else value
+
+# API ключи моделей из .env (читаются один раз при старте)
+ENV_API_KEYS = MappingProxyType({
+    "removebg": os.getenv("REMOVEBG_API_KEY", ""),
+    "clipdrop": os.getenv("CLIPDROP_API_KEY", ""),
+    "replicate": os.getenv("REPLICATE_API_KEY", ""),
+    "fal": os.getenv("FAL_KEY", ""),
+    "fal_object_removal": os.getenv("FAL_KEY", ""),  # Использует тот же ключ что и FAL
+})
+
 def get_api_key(model: str, api_key_from_request: Optional[str] = None) -> str:
     """Получение API ключа из запроса или env"""
     if api_key_from_request:
         return api_key_from_request
     
-    env_keys = {
-        "removebg": os.getenv("REMOVEBG_API_KEY"),
-        "clipdrop": os.getenv("CLIPDROP_API_KEY"),
-        "replicate": os.getenv("REPLICATE_API_KEY"),
-        "fal": os.getenv("FAL_KEY"),
-        "fal_object_removal": os.getenv("FAL_KEY"),  # Использует тот же ключ что и FAL
-    }
-    
-    key = env_keys.get(model) or ""
+    key = ENV_API_KEYS.get(model, "")
     
     # Логируем для отладки (только если ключ не найден)
     if not key and model == "replicate":
@@ -527,7 +868,7 @@ def get_api_key(model: str, api_key_from_request: Optional[str] = None) -> str:
 @app.get("/api/test/replicate-key")
 async def test_replicate_key():
     """Тест проверки REPLICATE_API_KEY из переменных окружения"""
-    api_key = os.getenv("REPLICATE_API_KEY")
+    api_key = ENV_API_KEYS["replicate"]
     if api_key:
         # Не возвращаем сам ключ, только информацию о его наличии
         return {
@@ -543,11 +884,23 @@ async def test_replicate_key():
             "message": "REPLICATE_API_KEY not found in environment variables"
         }
 
+# Главная страница читается один раз при старте, ETag считается по содержимому
+try:
+    with open("index.html", "rb") as f:
+        INDEX_BYTES = f.read()
+    INDEX_ETAG = '"' + hashlib.blake2b(INDEX_BYTES, digest_size=8).hexdigest() + '"'
+except FileNotFoundError:
+    INDEX_BYTES = None
+    INDEX_ETAG = None
+
 @app.get("/")
-async def root():
+async def root(request: Request):
     """Главная страница"""
-    if os.path.exists("index.html"):
-        return FileResponse("index.html")
+    if INDEX_BYTES is not None:
+        headers = {"ETag": INDEX_ETAG, "Cache-Control": "public, max-age=300"}
+        if request.headers.get("if-none-match") == INDEX_ETAG:
+            return Response(status_code=304, headers=headers)
+        return Response(content=INDEX_BYTES, media_type="text/html", headers=headers)
     return {"message": "Background Remover API", "status": "running"}
 
 @app.post("/api/process")
@@ -555,7 +908,8 @@ async def process_image(
     image: UploadFile = File(...),
     model: str = Form(...),
     apiKey: Optional[str] = Form(None),
-    prompt: Optional[str] = Form(None)
+    prompt: Optional[str] = Form(None),
+    race: bool = Form(False)
 ):
     """Обработка изображения для удаления фона"""
     if model not in MODELS:
@@ -566,16 +920,79 @@ async def process_image(
         raise HTTPException(status_code=400, detail="API key not provided")
     
     try:
-        image_bytes = await image.read()
-        logging.info(f"Processing image with model: {model}, size: {len(image_bytes)} bytes")
+        # Определяем реальный тип изображения один раз и передаем его во все модели
+        if model in STREAMING_MODELS:
+            # Файл отправляется в API потоком - читаем его чанками только для хэша и типа
+            hasher = hashlib.blake2b(digest_size=16)
+            while chunk := await image.read(STREAM_CHUNK_SIZE):
+                hasher.update(chunk)
+            await image.seek(0)
+            image_data = image.file
+            mime = sniff_mime(image_data)
+            image_size = image.size
+        else:
+            image_data = await image.read()
+            hasher = hashlib.blake2b(image_data, digest_size=16)
+            mime = sniff_mime(image_data)
+            image_size = len(image_data)
+        logging.info(f"Processing image with model: {model}, size: {image_size} bytes, type: {mime}")
+        
+        # Одинаковое изображение + модель (+ промпт) дают тот же результат - берем из кэша
+        if prompt:
+            hasher.update(b"\0" + prompt.encode())
+        cache_key = f"{hasher.hexdigest()}:{model}"
+        # Результат по уменьшенному до MAX_UPLOAD_EDGE изображению - под отдельным ключом:
+        # пакетная обработка отправляет оригиналы и берет из кэша только полноразмерные результаты
+        shrunk_key = f"{cache_key}:e{MAX_UPLOAD_EDGE}"
+        for key in (cache_key, shrunk_key):
+            if key in RESULT_CACHE:
+                logging.info(f"Returning cached result for {key}")
+                return Response(content=RESULT_CACHE[key], media_type="image/png")
+        
+        # Такой же запрос уже обрабатывается - ждем его результат (shield: отмена ожидающего не отменяет чужой запрос)
+        while (inflight := INFLIGHT_RESULTS.get(cache_key)) is not None:
+            try:
+                shared_result = await asyncio.wait_for(asyncio.shield(inflight), INFLIGHT_WAIT_SECONDS)
+            except asyncio.TimeoutError:
+                logging.warning(f"Identical in-flight request for {cache_key} did not finish in {INFLIGHT_WAIT_SECONDS}s, processing again")
+                break
+            if shared_result is not None:
+                logging.info(f"Returning result of identical in-flight request for {cache_key}")
+                return Response(content=shared_result, media_type="image/png")
+        INFLIGHT_RESULTS[cache_key] = asyncio.get_running_loop().create_future()
         
-        # Вызываем соответствующую функцию обработки
-        # Все функции принимают (image_bytes, api_key, prompt)
-        processed_bytes = await MODELS[model](image_bytes, api_key, prompt)
+        result_key = cache_key
+        try:
+            # Большие изображения уменьшаем перед отправкой в платные API (Pillow - в пуле потоков)
+            if MAX_UPLOAD_EDGE and model not in FULL_RES_MODELS:
+                shrunk = await asyncio.to_thread(shrink_image, image_data, MAX_UPLOAD_EDGE)
+                if shrunk is not None:
+                    logging.info(f"Image downscaled before upload: {image_size} -> {len(shrunk)} bytes")
+                    image_data = shrunk
+                    mime = sniff_mime(shrunk)
+                    result_key = shrunk_key
+            
+            # Вызываем соответствующую функцию обработки
+            # Все функции принимают (image_bytes, api_key, prompt, mime, stream)
+            # race=true - для Replicate запускаем все fallback-модели параллельно (быстрее, но дороже)
+            model_kwargs = {"race": True} if race and model == "replicate" else {}
+            async with MODEL_SEMAPHORES[model]:
+                result = await MODELS[model](image_data, api_key, prompt, mime, stream=True, **model_kwargs)
+        except BaseException:
+            # Ошибку не раздаем: ожидающие запросы обработают изображение сами
+            finish_inflight(cache_key, None)
+            raise
         
-        logging.info(f"Processing completed successfully, result size: {len(processed_bytes)} bytes")
+        # Результат отдаем клиенту потоком, не дожидаясь полной загрузки (ожидающим он передается по окончании потока)
+        if isinstance(result, httpx.Response):
+            logging.info(f"Processing completed successfully, streaming result ({result.headers.get('content-length', 'unknown')} bytes)")
+            return UpstreamStreamingResponse(result, cache_key=result_key, inflight_key=cache_key, media_type="image/png")
+        
+        logging.info(f"Processing completed successfully, result size: {len(result)} bytes")
+        cache_result(result_key, result)
+        finish_inflight(cache_key, result)
         return Response(
-            content=processed_bytes,
+            content=result,
             media_type="image/png"
         )
     except HTTPException:
@@ -584,16 +1001,46 @@ async def process_image(
         logging.error(f"Error in /api/process endpoint: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+# Файл фона для дизайна - пробуем разные пути, читаем один раз при старте
+BACKGROUND_PATHS = [
+    "/app/background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg",
+    os.path.expanduser("~/background_remover/background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg")
+]
+
+# Фон для версий с дизайном в пакетной обработке
+BATCH_BACKGROUND_PATHS = [
+    "/app/background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg",
+    os.path.expanduser("~/background_remover/background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg"),
+    "./background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg",
+    "background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg"
+]
+
+def load_background(paths: List[str]) -> Optional[bytes]:
+    """Чтение файла фона по первому найденному пути"""
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            continue
+        logging.info(f"Background loaded from {path} ({len(data)} bytes)")
+        return data
+    logging.warning(f"Background file not found (tried {len(paths)} paths, first: {paths[0]})")
+    return None
+
+BACKGROUND_BYTES = load_background(BACKGROUND_PATHS)
+BATCH_BACKGROUND_BYTES = load_background(BATCH_BACKGROUND_PATHS)
+# Replicate SDK передает файлы как base64 data URI, кодируя их при каждом запуске - фон кодируем один раз
+BATCH_BACKGROUND_URI = f"data:{sniff_mime(BATCH_BACKGROUND_BYTES)};base64,{base64.b64encode(BATCH_BACKGROUND_BYTES).decode()}" if BATCH_BACKGROUND_BYTES else None
+BACKGROUND_URI = f"data:{sniff_mime(BACKGROUND_BYTES)};base64,{base64.b64encode(BACKGROUND_BYTES).decode()}" if BACKGROUND_BYTES else None
+
 @app.post("/api/place-on-background")
 async def place_on_background(
     processedImage: UploadFile = File(...),
     prompt: Optional[str] = Form(None)
 ):
     """Размещение обработанного изображения на фоне используя prunaai/p-image-edit"""
-    import replicate
-    import os
-    
-    api_key = os.getenv("REPLICATE_API_KEY", "")
+    api_key = ENV_API_KEYS["replicate"]
     if not api_key:
         raise HTTPException(status_code=400, detail="REPLICATE_API_KEY not found")
     
@@ -601,37 +1048,17 @@ async def place_on_background(
         # Загружаем обработанное изображение
         processed_image_bytes = await processedImage.read()
         
-        # Путь к файлу фона - пробуем разные пути
-        background_paths = [
-            "/app/background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg",
-            os.path.expanduser("~/background_remover/background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg"),
-            "/app/background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpg.pdf",
-            os.path.expanduser("~/background_remover/background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpg.pdf")
-        ]
-        
-        background_path = None
-        for path in background_paths:
-            if os.path.exists(path):
-                background_path = path
-                break
-        
-        if not os.path.exists(background_path):
-            raise HTTPException(status_code=500, detail=f"Background file not found at {background_path}")
-        
-        # Читаем файл фона
-        with open(background_path, 'rb') as f:
-            background_image_bytes = f.read()
-        
-        # Устанавливаем API токен для replicate
-        os.environ["REPLICATE_API_TOKEN"] = api_key
+        # Фон загружен один раз при старте
+        if BACKGROUND_BYTES is None:
+            raise HTTPException(status_code=500, detail=f"Background file not found at {BACKGROUND_PATHS[0]}")
+        # Клиент с ключом запроса (без записи токена в os.environ), переиспользуется между запросами
+        replicate_client = get_replicate_client(api_key)
         
         # Согласно документации Replicate, можно передать file objects напрямую в replicate.run()
         # Model prunaai/p-image-edit принимает images как список file objects или URL
         # Передаем file objects напрямую - replicate автоматически их обработает
         processed_file_obj = io.BytesIO(processed_image_bytes)
         processed_file_obj.name = "processed.png"
-        background_file_obj = io.BytesIO(background_image_bytes)
-        background_file_obj.name = "background.jpeg"
         
         logging.info("Preparing images for prunaai/p-image-edit model...")
         
@@ -677,11 +1104,10 @@ Do not crop or resize the image."""
         # Согласно документации, images может быть списком file objects или URL
         # @img1 - это первый image (фон), @img2 - второй image (продукт)
         # Перемещаем указатели файлов в начало для чтения
-        background_file_obj.seek(0)
         processed_file_obj.seek(0)
         
         model_input = {
-            "images": [background_file_obj, processed_file_obj],  # @img1 - фон, @img2 - продукт
+            "images": [BACKGROUND_URI, processed_file_obj],  # @img1 - фон (data URI готов заранее), @img2 - продукт
             "prompt": prompt,
             "aspect_ratio": "4:3"  # Сохраняем соотношение сторон как в оригинале
         }
@@ -694,7 +1120,7 @@ Do not crop or resize the image."""
         
         # Запускаем модель
         output = await asyncio.to_thread(
-            replicate.run,
+            replicate_client.run,
             "prunaai/p-image-edit",
             input=model_input
         )
@@ -706,22 +1132,14 @@ Do not crop or resize the image."""
         if hasattr(output, 'read'):
             result_bytes = output.read()
         elif isinstance(output, str):
-            # Если это URL, скачиваем изображение
-            async with httpx.AsyncClient() as client:
-                response = await client.get(output, timeout=60.0)
-                if response.status_code != 200:
-                    raise HTTPException(status_code=500, detail=f"Failed to download result: {response.status_code}")
-                result_bytes = response.content
+            # Если это URL, скачиваем изображение через общий клиент
+            result_bytes = await fetch_result(output, "place-on-background")
         elif isinstance(output, list) and len(output) > 0:
             first_item = output[0]
             if hasattr(first_item, 'read'):
                 result_bytes = first_item.read()
             elif isinstance(first_item, str):
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(first_item, timeout=60.0)
-                    if response.status_code != 200:
-                        raise HTTPException(status_code=500, detail=f"Failed to download result: {response.status_code}")
-                    result_bytes = response.content
+                result_bytes = await fetch_result(first_item, "place-on-background")
         
         if not result_bytes:
             raise HTTPException(status_code=500, detail="Failed to get result from model")
@@ -738,8 +1156,55 @@ Do not crop or resize the image."""
         logging.error(f"Error in /api/place-on-background endpoint: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+def compose_template(image_bytes: bytes, template_width: int, template_height: int, image_format: str = "PNG") -> bytes:
+    """Вписывание изображения в белый шаблон, результат в PNG или WEBP (синхронно, для to_thread)"""
+    processed_img = Image.open(io.BytesIO(image_bytes))
+    
+    # Создаем белый шаблон нужного размера
+    template_img = Image.new("RGB", (template_width, template_height), "white")
+    
+    # Получаем размеры изображения
+    img_width, img_height = processed_img.size
+    
+    # Масштабируем изображение так, чтобы оно поместилось в шаблон с сохранением пропорций
+    # Используем меньший масштаб, чтобы изображение полностью поместилось в шаблон
+    # Вычисляем масштаб для заполнения по ширине и высоте, выбираем меньший
+    scale_width = template_width / img_width
+    scale_height = template_height / img_height
+    
+    # Используем меньший масштаб, чтобы изображение поместилось полностью
+    # Это гарантирует, что изображение не будет обрезано, а вокруг будет белое поле
+    scale = min(scale_width, scale_height)
+    
+    # Масштабируем изображение
+    new_width = int(img_width * scale)
+    new_height = int(img_height * scale)
+    # Для JPEG декодируем сразу с уменьшением (DCT-scaling libjpeg), для остальных форматов no-op
+    processed_img.draft(processed_img.mode, (new_width, new_height))
+    # При сильном уменьшении сначала целочисленный reduce() (быстрый box-фильтр), LANCZOS - только на последнем шаге
+    processed_img = processed_img.resize((new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    
+    # Центрируем изображение на белом фоне
+    x = (template_width - new_width) // 2
+    y = (template_height - new_height) // 2
+    
+    # Вставляем изображение прямо в шаблон - он создан под этот запрос
+    if processed_img.mode == "RGBA":
+        template_img.paste(processed_img, (x, y), processed_img)
+    else:
+        template_img.paste(processed_img, (x, y))
+    
+    # Сохраняем в bytes: PNG с быстрым сжатием (кодирование в разы быстрее уровня 6, файл чуть больше)
+    output = io.BytesIO()
+    if image_format == "WEBP":
+        template_img.save(output, format="WEBP", quality=90, method=4)
+    else:
+        template_img.save(output, format="PNG", compress_level=1)
+    return output.getvalue()
+
 @app.post("/api/place-template")
 async def place_template(
+    request: Request,
     image: UploadFile = File(...),
     template: str = Form("default"),
     width: int = Form(1200),
@@ -749,52 +1214,21 @@ async def place_template(
     try:
         # Загружаем изображение
         image_bytes = await image.read()
-        processed_img = Image.open(io.BytesIO(image_bytes))
         
         # Получаем размеры шаблона из параметров
         template_width = max(100, min(5000, width))  # Ограничиваем от 100 до 5000
         template_height = max(100, min(5000, height))  # Ограничиваем от 100 до 5000
         
-        # Создаем белый шаблон нужного размера
-        template_img = Image.new("RGB", (template_width, template_height), "white")
+        # WEBP отдаем только клиентам, явно принимающим image/webp, остальным - PNG
+        image_format = "WEBP" if "image/webp" in request.headers.get("accept", "") else "PNG"
         
-        # Получаем размеры изображения
-        img_width, img_height = processed_img.size
-        
-        # Масштабируем изображение так, чтобы оно поместилось в шаблон с сохранением пропорций
-        # Используем меньший масштаб, чтобы изображение полностью поместилось в шаблон
-        # Вычисляем масштаб для заполнения по ширине и высоте, выбираем меньший
-        scale_width = template_width / img_width
-        scale_height = template_height / img_height
-        
-        # Используем меньший масштаб, чтобы изображение поместилось полностью
-        # Это гарантирует, что изображение не будет обрезано, а вокруг будет белое поле
-        scale = min(scale_width, scale_height)
-        
-        # Масштабируем изображение
-        new_width = int(img_width * scale)
-        new_height = int(img_height * scale)
-        processed_img = processed_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # Центрируем изображение на белом фоне
-        x = (template_width - new_width) // 2
-        y = (template_height - new_height) // 2
-        
-        # Создаем результат
-        result = template_img.copy()
-        if processed_img.mode == "RGBA":
-            result.paste(processed_img, (x, y), processed_img)
-        else:
-            result.paste(processed_img, (x, y))
-        
-        # Сохраняем в bytes
-        output = io.BytesIO()
-        result.save(output, format="PNG")
-        output.seek(0)
+        # Декодирование, ресайз и кодирование Pillow - в пуле потоков, чтобы не блокировать event loop
+        result_bytes = await asyncio.to_thread(compose_template, image_bytes, template_width, template_height, image_format)
         
         return Response(
-            content=output.read(),
-            media_type="image/png"
+            content=result_bytes,
+            media_type=f"image/{image_format.lower()}",
+            headers={"Vary": "Accept"}
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -803,117 +1237,114 @@ async def place_template(
 @app.get("/auth/yandex")
 async def yandex_auth():
     """Начало OAuth авторизации Яндекс Диска"""
-    client_id = os.getenv("YANDEX_DISK_CLIENT_ID")
-    # Используем переменную окружения или определяем автоматически
-    redirect_uri = os.getenv("YANDEX_DISK_REDIRECT_URI")
-    if not redirect_uri:
-        # Пытаемся определить URL автоматически из запроса
-        from fastapi import Request
-        # Для Railway и других платформ лучше использовать переменную окружения
-        # В локальной разработке можно использовать localhost
-        redirect_uri = "http://localhost:8000/auth/yandex/callback"
-    
-    auth_url = f"https://oauth.yandex.ru/authorize?response_type=code&client_id={client_id}&redirect_uri={redirect_uri}"
-    from fastapi.responses import RedirectResponse
+    auth_url = f"https://oauth.yandex.ru/authorize?response_type=code&client_id={YANDEX_CLIENT_ID}&redirect_uri={YANDEX_REDIRECT_URI}"
     return RedirectResponse(url=auth_url)
 
+# Страница успешной авторизации: передает токен в основное окно и закрывается
+OAUTH_SUCCESS_PAGE = Template('''
+<html>
+    <body>
+        <h1>Авторизация успешна!</h1>
+        <p>Вы можете закрыть это окно.</p>
+        <script>
+            window.opener.postMessage({type: 'yandex_auth_success', token: $token}, '*');
+            setTimeout(() => window.close(), 2000);
+        </script>
+    </body>
+</html>
+''')
+
 @app.get("/auth/yandex/callback")
 async def yandex_callback(code: Optional[str] = None):
     """OAuth callback Яндекс Диска"""
     if not code:
         return Response(content='<script>window.close();</script>', media_type="text/html")
     
-    client_id = os.getenv("YANDEX_DISK_CLIENT_ID")
-    client_secret = os.getenv("YANDEX_DISK_CLIENT_SECRET")
-    # Используем переменную окружения (обязательно для Railway)
-    redirect_uri = os.getenv("YANDEX_DISK_REDIRECT_URI")
-    if not redirect_uri:
-        # Fallback для локальной разработки
-        redirect_uri = "http://localhost:8000/auth/yandex/callback"
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "https://oauth.yandex.ru/token",
-            data={
-                "grant_type": "authorization_code",
-                "code": code,
-                "client_id": client_id,
-                "client_secret": client_secret
-            },
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            timeout=30.0
-        )
-        
-        if response.status_code != 200:
-            return Response(
-                content='<h1>Ошибка авторизации</h1><script>setTimeout(() => window.close(), 2000);</script>',
-                media_type="text/html"
-            )
-        
-        access_token = response.json()["access_token"]
-        yandex_tokens.add(access_token)
-        
+    client = get_http_client()
+    response = await client.post(
+        "https://oauth.yandex.ru/token",
+        data={
+            "grant_type": "authorization_code",
+            "code": code,
+            "client_id": YANDEX_CLIENT_ID,
+            "client_secret": YANDEX_CLIENT_SECRET
+        },
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+        timeout=30.0
+    )
+    
+    if response.status_code != 200:
         return Response(
-            content=f'''
-            <html>
-                <body>
-                    <h1>Авторизация успешна!</h1>
-                    <p>Вы можете закрыть это окно.</p>
-                    <script>
-                        window.opener.postMessage({{type: 'yandex_auth_success', token: '{access_token}'}}, '*');
-                        setTimeout(() => window.close(), 2000);
-                    </script>
-                </body>
-            </html>
-            ''',
+            content='<h1>Ошибка авторизации</h1><script>setTimeout(() => window.close(), 2000);</script>',
             media_type="text/html"
         )
+    
+    access_token = orjson.loads(response.content)["access_token"]
+    yandex_tokens[access_token] = True
+    # Только что выданный токен заведомо валиден - первая проверка после входа не идёт в API
+    TOKEN_VALID_CACHE[hashlib.sha256(access_token.encode()).hexdigest()] = True
+    
+    # Токен вставляется как JSON строка ("<" экранирован, чтобы нельзя было закрыть тег script)
+    token_js = orjson.dumps(access_token).decode().replace("<", "\\u003c")
+    return Response(
+        content=OAUTH_SUCCESS_PAGE.substitute(token=token_js),
+        media_type="text/html"
+    )
+
+# Результаты проверки токенов (ключ - хэш токена): валидные держим 5 минут, невалидные - 30 секунд
+TOKEN_VALID_CACHE = TTLCache(maxsize=10_000, ttl=300)
+TOKEN_INVALID_CACHE = TTLCache(maxsize=10_000, ttl=30)
+
+async def validate_yandex_token(token: str) -> bool:
+    """Проверка токена запросом к /v1/disk с кэшированием результата"""
+    key = hashlib.sha256(token.encode()).hexdigest()
+    if key in TOKEN_VALID_CACHE:
+        return True
+    if key in TOKEN_INVALID_CACHE:
+        return False
+    
+    client = get_http_client()
+    try:
+        response = await client.get(
+            "https://cloud-api.yandex.net/v1/disk",
+            headers={"Authorization": f"OAuth {token}"},
+            timeout=10.0
+        )
+    except Exception:
+        # Сетевая ошибка - не кэшируем, проверим снова при следующем запросе
+        return False
+    
+    if response.status_code == 200:
+        TOKEN_VALID_CACHE[key] = True
+        return True
+    TOKEN_INVALID_CACHE[key] = True
+    return False
 
 @app.get("/api/yandex/check")
 async def check_yandex_auth(token: Optional[str] = None):
     """Проверка авторизации Яндекс Диска"""
     # Если токен не передан, пробуем использовать токен из .env
     if not token:
-        env_token = os.getenv("YANDEX_DISK_TOKEN")
+        env_token = YANDEX_ENV_TOKEN
         if env_token:
             token = env_token
     
     if not token:
         return {"authenticated": False}
     
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                "https://cloud-api.yandex.net/v1/disk",
-                headers={"Authorization": f"OAuth {token}"},
-                timeout=10.0
-            )
-            if response.status_code == 200:
-                yandex_tokens.add(token)
-                return {"authenticated": True, "token": token, "from_env": token == os.getenv("YANDEX_DISK_TOKEN")}
-        except:
-            pass
+    if await validate_yandex_token(token):
+        yandex_tokens[token] = True
+        return {"authenticated": True, "token": token, "from_env": token == YANDEX_ENV_TOKEN}
     
     return {"authenticated": False}
 
 @app.get("/api/yandex/get-env-token")
 async def get_env_token():
     """Получение токена из .env (если есть)"""
-    env_token = os.getenv("YANDEX_DISK_TOKEN")
+    env_token = YANDEX_ENV_TOKEN
     if env_token:
         # Проверяем валидность токена
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(
-                    "https://cloud-api.yandex.net/v1/disk",
-                    headers={"Authorization": f"OAuth {env_token}"},
-                    timeout=10.0
-                )
-                if response.status_code == 200:
-                    return {"has_token": True, "valid": True}
-            except:
-                pass
-        return {"has_token": True, "valid": False}
+        return {"has_token": True, "valid": await validate_yandex_token(env_token)}
     return {"has_token": False, "valid": False}
 
 @app.get("/api/yandex/folders")
@@ -921,393 +1352,413 @@ async def get_yandex_folders(token: Optional[str] = None, recursive: bool = Quer
     """Получение списка папок Яндекс Диска (только первый уровень по умолчанию)"""
     # Если токен не передан, пробуем использовать токен из .env
     if not token:
-        token = os.getenv("YANDEX_DISK_TOKEN")
+        token = YANDEX_ENV_TOKEN
     
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            "https://cloud-api.yandex.net/v1/disk/resources",
-            params={"path": "/", "limit": 1000},
-            headers={"Authorization": f"OAuth {token}"},
-            timeout=30.0
-        )
+    auth_headers = {"Authorization": f"OAuth {token}"}
+    client = get_http_client()
+    response = await client.get(
+        "https://cloud-api.yandex.net/v1/disk/resources",
+        params={"path": "/", "limit": 1000},
+        headers=auth_headers,
+        timeout=30.0
+    )
+    
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail="Failed to fetch folders")
+    
+    data = orjson.loads(response.content)
+    folders = [
+        {"name": item["name"], "path": item["path"], "depth": 0}
+        for item in data.get("_embedded", {}).get("items", [])
+        if item.get("type") == "dir"
+    ]
+    
+    # Если recursive=True, загружаем подпапки первого уровня
+    if recursive:
+        all_folders = folders.copy()
+        for folder in folders:
+            try:
+                sub_response = await client.get(
+                    "https://cloud-api.yandex.net/v1/disk/resources",
+                    params={"path": folder["path"], "limit": 1000},
+                    headers=auth_headers,
+                    timeout=30.0
+                )
+                
+                if sub_response.status_code == 200:
+                    sub_data = orjson.loads(sub_response.content)
+                    sub_items = sub_data.get("_embedded", {}).get("items", [])
+                    
+                    for item in sub_items:
+                        if item.get("type") == "dir":
+                            all_folders.append({
+                                "name": item["name"],
+                                "path": item["path"],
+                                "depth": 1
+                            })
+            except Exception as e:
+                logger = logging.getLogger(__name__)
+                logger.warning(f"Error fetching subfolders from {folder['path']}: {str(e)}")
+                continue
         
+        return {"folders": all_folders}
+    
+    return {"folders": folders}
+
+def iter_named_items(root, max_depth: int = 5):
+    """Словари с name и path/url/href в JSON дереве (итеративно, в порядке обхода в глубину, без промежуточных списков)"""
+    stack = [(root, 0)]
+    while stack:
+        obj, depth = stack.pop()
+        if isinstance(obj, dict):
+            if 'name' in obj and ('path' in obj or 'url' in obj or 'href' in obj):
+                yield obj
+            children = obj.values()
+        else:
+            children = obj
+        if depth < max_depth:
+            # Кладем в обратном порядке, чтобы сохранить порядок обхода как в рекурсивной версии
+            stack.extend(
+                (child, depth + 1) for child in reversed(children)
+                if isinstance(child, (dict, list))
+            )
+
+def is_public_page_tag(name: str, attrs: dict) -> bool:
+    """Отбор тегов страницы публичной папки, которые нужны методам поиска файлов"""
+    if name == 'script' or 'data-name' in attrs:
+        return True
+    if (name == 'a' and 'href' in attrs) or (name == 'img' and 'src' in attrs):
+        return True
+    classes = attrs.get('class')
+    if classes:
+        if not isinstance(classes, str):
+            classes = ' '.join(classes)
+        return DISK_CLASS_RE.search(classes) is not None
+    return False
+
+# Ключевые слова, по которым отбираем скрипты с JSON данными (один проход вместо поиска каждого слова)
+SCRIPT_KEYWORD_RE = re.compile(r'items|resources|files|itemsList|fileList|photos|images')
+
+# JSON паттерны в скриптах публичной страницы (компилируются один раз) с обязательной подстрокой:
+# если подстроки в скрипте нет, паттерн не может совпасть и регулярка не запускается
+PUBLIC_JSON_PATTERNS = [
+    (anchor, re.compile(pattern, re.DOTALL)) for anchor, pattern in (
+        ('window.__INITIAL_STATE__', r'window\.__INITIAL_STATE__\s*=\s*({.+?});'),
+        ('window.__DATA__', r'window\.__DATA__\s*=\s*({.+?});'),
+        ('"items"', r'"items"\s*:\s*\[(.*?)\]'),
+        ('"resources"', r'"resources"\s*:\s*\[(.*?)\]'),
+        ('"files"', r'"files"\s*:\s*\[(.*?)\]'),
+        ('"name"', r'\{[^{}]*"name"[^{}]*"path"[^{}]*\}'),
+        ('"name"', r'\[[^\]]*\{[^{}]*"name"[^{}]*\}[^\]]*\]')
+    )
+]
+
+# Признаки JSON состояния со списком файлов на странице
+PUBLIC_STATE_ANCHORS = ('window.__INITIAL_STATE__', 'window.__DATA__', '"items"', '"resources"', '"files"')
+# Сколько файлов из ссылок и img достаточно, чтобы не разбирать скрипты без JSON состояния
+PUBLIC_EARLY_EXIT_MIN = 20
+
+# Строим дерево только из нужных тегов (вложенные элементы подходящих тегов сохраняются целиком)
+PUBLIC_PAGE_STRAINER = SoupStrainer(is_public_page_tag)
+
+class PublicPageNodes(NamedTuple):
+    """Теги страницы публичной папки, разложенные по методам поиска"""
+    links: list
+    images: list
+    scripts: list
+    data_named: list
+    disk_classed: list
+
+def collect_public_page_nodes(soup: BeautifulSoup) -> PublicPageNodes:
+    """Один обход дерева вместо отдельного find_all для каждого метода (порядок документа сохраняется)"""
+    nodes = PublicPageNodes([], [], [], [], [])
+    for tag in soup.find_all(True):
+        name = tag.name
+        attrs = tag.attrs
+        if name == 'a' and 'href' in attrs:
+            nodes.links.append(tag)
+        elif name == 'img' and 'src' in attrs:
+            nodes.images.append(tag)
+        elif name == 'script':
+            nodes.scripts.append(tag)
+        if 'data-name' in attrs:
+            nodes.data_named.append(tag)
+        classes = attrs.get('class')
+        if classes:
+            if not isinstance(classes, str):
+                classes = ' '.join(classes)
+            if DISK_CLASS_RE.search(classes):
+                nodes.disk_classed.append(tag)
+    return nodes
+
+class FileEntry(NamedTuple):
+    """Найденный файл публичной папки (path и url совпадают, храним один раз)"""
+    name: str
+    url: str
+    mime_type: str = "image/jpeg"
+    
+    def to_dict(self) -> dict:
+        return {"name": self.name, "path": self.url, "url": self.url, "mime_type": self.mime_type}
+
+# Ключи имени и ссылки файла в JSON из скриптов страницы (в порядке приоритета)
+ITEM_NAME_KEYS = ('name', 'title', 'filename', 'displayName')
+ITEM_URL_KEYS = ('file', 'href', 'url', 'path', 'downloadUrl')
+
+def first_value(item: dict, keys: tuple):
+    """Первое непустое значение по списку ключей"""
+    for key in keys:
+        value = item.get(key)
+        if value:
+            return value
+    return ''
+
+YANDEX_DISK_BASE = "https://disk.yandex.ru"
+
+@lru_cache(maxsize=8192)
+def normalize_href(href: str, folder_id: Optional[str], folder_url: Optional[str]) -> str:
+    """Приведение ссылки со страницы публичной папки к абсолютному URL без query параметров"""
+    href = href.partition('?')[0]
+    if href.startswith(('http://', 'https://')):
+        return href
+    if href.startswith('/'):
+        return YANDEX_DISK_BASE + href
+    if folder_id:
+        return YANDEX_DISK_BASE + "/d/" + folder_id + "/" + href
+    # Для формата /client/disk/ используем базовый URL
+    base_url = folder_url.rpartition('/')[0] if folder_url else YANDEX_DISK_BASE
+    return base_url + "/" + href
+
+# Заголовки браузера для загрузки страниц Яндекс Диска
+PUBLIC_PAGE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7'
+}
+# Максимальный размер загружаемой HTML страницы (остаток не читаем)
+PUBLIC_PAGE_MAX_BYTES = int(os.getenv("PUBLIC_PAGE_MAX_MB", "5")) * 1024 * 1024
+
+async def fetch_public_page(url: str) -> Tuple[int, str]:
+    """Загрузка HTML страницы Яндекс Диска потоком с ограничением размера: (status_code, html)"""
+    client = get_http_client()
+    request = client.build_request("GET", url, headers=PUBLIC_PAGE_HEADERS, timeout=30.0)
+    response = await send_following_redirects(client, request, stream=True)
+    try:
         if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail="Failed to fetch folders")
-        
-        data = response.json()
-        folders = [
-            {"name": item["name"], "path": item["path"], "depth": 0}
-            for item in data.get("_embedded", {}).get("items", [])
-            if item.get("type") == "dir"
-        ]
-        
-        # Если recursive=True, загружаем подпапки первого уровня
-        if recursive:
-            all_folders = folders.copy()
-            for folder in folders:
+            return response.status_code, ""
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+            buffer.extend(chunk)
+            if len(buffer) >= PUBLIC_PAGE_MAX_BYTES:
+                logging.warning(f"Page {url} is larger than {PUBLIC_PAGE_MAX_BYTES} bytes, parsing truncated HTML")
+                break
+        return response.status_code, buffer.decode(response.encoding or "utf-8", errors="replace")
+    finally:
+        await response.aclose()
+
+def has_image_extension(*values: str) -> bool:
+    """Есть ли расширение изображения хотя бы в одной из строк"""
+    return any(IMAGE_EXTENSION_RE.search(value) for value in values)
+
+def iter_html_candidates(nodes: PublicPageNodes):
+    """Методы 1-2: ссылки на файлы и img теги -> (name, href, mime_type)"""
+    for link in nodes.links:
+        href = link.get('href', '').strip()
+        # Пробуем разные способы получить имя файла
+        name = (
+            link.get_text(strip=True) or 
+            link.get('title', '') or 
+            link.get('data-name', '') or
+            link.get('aria-label', '') or
+            ''
+        )
+        # Если имени нет в тексте, пробуем извлечь из href
+        if not name and href:
+            name = href.rpartition('/')[2].partition('?')[0]
+        # Проверяем расширение в имени или в href
+        if href and name and has_image_extension(name, href):
+            yield name, href, "image/jpeg"
+    
+    for img in nodes.images:
+        src = img.get('src', '').strip()
+        name = (
+            img.get('alt', '').strip() or
+            img.get('title', '').strip() or
+            img.get('data-name', '').strip() or
+            src.rpartition('/')[2].partition('?')[0]
+        )
+        if src and name and has_image_extension(name, src):
+            yield name, src, "image/jpeg"
+
+def iter_script_items(script_text: str):
+    """Словари файлов из JSON фрагментов скрипта"""
+    for anchor, pattern in PUBLIC_JSON_PATTERNS:
+        if anchor not in script_text:
+            continue
+        for match in pattern.finditer(script_text):
+            json_str = match.group(1) if match.groups() else match.group(0)
+            json_str = json_str.strip().rstrip(';')
+            
+            # Пробуем распарсить как JSON (orjson, fallback на json для NaN/Infinity и т.п.)
+            try:
+                data = orjson.loads(json_str)
+            except orjson.JSONDecodeError:
                 try:
-                    sub_response = await client.get(
-                        "https://cloud-api.yandex.net/v1/disk/resources",
-                        params={"path": folder["path"], "limit": 1000},
-                        headers={"Authorization": f"OAuth {token}"},
-                        timeout=30.0
-                    )
-                    
-                    if sub_response.status_code == 200:
-                        sub_data = sub_response.json()
-                        sub_items = sub_data.get("_embedded", {}).get("items", [])
-                        
-                        for item in sub_items:
-                            if item.get("type") == "dir":
-                                all_folders.append({
-                                    "name": item["name"],
-                                    "path": item["path"],
-                                    "depth": 1
-                                })
-                except Exception as e:
-                    logger = logging.getLogger(__name__)
-                    logger.warning(f"Error fetching subfolders from {folder['path']}: {str(e)}")
+                    data = json.loads(json_str)
+                except ValueError:
                     continue
             
-            return {"folders": all_folders}
-        
-        return {"folders": folders}
+            if isinstance(data, dict):
+                # Ищем items в словаре (обход в глубину без рекурсии)
+                found = False
+                for item in iter_named_items(data):
+                    found = True
+                    yield item
+                if found:
+                    continue
+                items = data.get('items', data.get('resources', data.get('files', data.get('data', []))))
+            elif isinstance(data, list):
+                items = data
+            else:
+                continue
+            
+            if isinstance(items, list):
+                yield from (item for item in items if isinstance(item, dict))
 
-@app.get("/api/yandex/public-files")
-async def get_public_yandex_files(public_url: str = Query(...)):
-    """Получение списка файлов из публичной папки Яндекс Диска"""
+def iter_script_candidates(scripts: list):
+    """Метод 3: данные о файлах в JSON внутри скриптов -> (name, href, mime_type)"""
+    for script in scripts:
+        script_text = script.string
+        # Расширенный поиск JSON данных только в скриптах с ключевыми словами
+        if not script_text or not SCRIPT_KEYWORD_RE.search(script_text):
+            continue
+        for item in iter_script_items(script_text):
+            name = first_value(item, ITEM_NAME_KEYS)
+            file_url = first_value(item, ITEM_URL_KEYS)
+            if isinstance(name, str) and isinstance(file_url, str) and name and file_url and has_image_extension(name):
+                yield name, file_url, item.get('mime_type') or item.get('mimeType') or 'image/jpeg'
+
+def iter_fallback_candidates(nodes: PublicPageNodes):
+    """Методы 4-5: data-name атрибуты и классы Яндекс Диска -> (name, href, mime_type)"""
+    for elem in nodes.data_named:
+        name = elem.get('data-name', '').strip()
+        href = (
+            elem.get('href', '').strip() or 
+            elem.get('data-href', '').strip() or
+            elem.get('data-url', '').strip()
+        )
+        if not href:
+            # Ссылка внутри элемента ищется только если у самого элемента ее нет
+            link = elem.find('a', href=True)
+            href = link.get('href', '').strip() if link else ''
+        if name and href and has_image_extension(name):
+            yield name, href, "image/jpeg"
+    
+    for elem in nodes.disk_classed:
+        link = elem.find('a', href=True)
+        if not link:
+            continue
+        href = link.get('href', '').strip()
+        name = (
+            link.get_text(strip=True) or 
+            link.get('title', '') or 
+            elem.get('data-name', '') or
+            href.rpartition('/')[2].partition('?')[0] or
+            ''
+        )
+        if href and name and has_image_extension(name, href):
+            yield name, href, "image/jpeg"
+
+@lru_cache(maxsize=2048)
+def parse_yandex_public_url(public_url: str) -> Tuple[Optional[str], Optional[str], str]:
+    """Разбор ссылки на публичную папку: (folder_id, folder_path, folder_url)"""
+    # Пробуем формат /d/ID
+    match = YANDEX_FOLDER_ID_RE.search(public_url)
+    if match:
+        folder_id = match.group(1)
+        return folder_id, None, f"{YANDEX_DISK_BASE}/d/{folder_id}"
+    
+    # Пробуем формат /client/disk/PATH
+    match = YANDEX_CLIENT_PATH_RE.search(public_url)
+    if match:
+        # Декодируем URL-encoded путь (если URL уже содержит кириллицу, unquote вернет его как есть)
+        folder_path = unquote(match.group(1))
+        return None, folder_path, public_url.partition('?')[0]  # Используем оригинальный URL
+    
+    raise HTTPException(status_code=400, detail="Invalid Yandex Disk URL format. Expected /d/ID or /client/disk/PATH")
+
+async def parse_public_folder(public_url: str, force_full: bool = False, refresh: bool = False) -> dict:
+    """Парсинг публичной папки Яндекс Диска (force_full - всегда запускать все методы поиска, refresh - мимо кэша)"""
     logger = logging.getLogger(__name__)
     
     try:
         # Извлекаем ID папки из URL
         # Формат: https://disk.yandex.ru/d/-uXMLsCHrFtxzg или https://disk.yandex.ru/client/disk/...
-        folder_id = None
-        folder_path = None
-        
-        # Пробуем формат /d/ID
-        match = re.search(r'/d/([^/?]+)', public_url)
-        if match:
-            folder_id = match.group(1)
-            folder_url = f"https://disk.yandex.ru/d/{folder_id}"
-        else:
-            # Пробуем формат /client/disk/PATH
-            match = re.search(r'/client/disk/([^/?]+)', public_url)
-            if match:
-                folder_path = match.group(1)
-                # Декодируем URL-encoded путь (если он закодирован)
-                from urllib.parse import unquote
-                try:
-                    # Пробуем декодировать - если URL уже содержит кириллицу, unquote вернет его как есть
-                    decoded_path = unquote(folder_path)
-                    folder_path = decoded_path
-                except:
-                    # Если декодирование не удалось, используем оригинальный путь
-                    pass
-                folder_url = public_url.split('?')[0]  # Используем оригинальный URL
-            else:
-                raise HTTPException(status_code=400, detail="Invalid Yandex Disk URL format. Expected /d/ID or /client/disk/PATH")
+        folder_id, folder_path, folder_url = parse_yandex_public_url(public_url)
         
         logger.info(f"Parsing Yandex Disk folder: folder_id={folder_id}, folder_path={folder_path}")
         
+        cache_key = (folder_url, force_full)
+        if not refresh:
+            cached = PUBLIC_FOLDER_CACHE.get(cache_key)
+            if cached is not None:
+                logger.info(f"Using cached public folder listing: {folder_url}")
+                return cached
+        
         # Парсим публичную страницу
-        async with httpx.AsyncClient() as client:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7'
-            }
-            response = await client.get(
-                folder_url,
-                headers=headers,
-                timeout=30.0,
-                follow_redirects=True
-            )
+        async with YANDEX_SCRAPE_SEMAPHORE:
+            status_code, html = await fetch_public_page(folder_url)
             
-            if response.status_code != 200:
-                raise HTTPException(status_code=response.status_code, detail="Failed to fetch public folder")
+            if status_code != 200:
+                raise HTTPException(status_code=status_code, detail="Failed to fetch public folder")
             
-            html = response.text
-            soup = BeautifulSoup(html, 'html.parser')
+            soup = BeautifulSoup(html, 'lxml', parse_only=PUBLIC_PAGE_STRAINER)
+            nodes = collect_public_page_nodes(soup)
             
-            files = []
+            # Один результат для всех методов: словарь по нормализованному URL + множество имен
+            files = {}
             seen_names = set()
-            seen_urls = set()
-            image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff', '.svg']
-            
-            # Метод 1: Ищем ссылки на файлы в HTML (улучшенный)
-            all_links = soup.find_all('a', href=True)
-            for link in all_links:
-                href = link.get('href', '').strip()
-                # Пробуем разные способы получить имя файла
-                name = (
-                    link.get_text(strip=True) or 
-                    link.get('title', '') or 
-                    link.get('data-name', '') or
-                    link.get('aria-label', '') or
-                    ''
-                )
-                
-                # Если имени нет в тексте, пробуем извлечь из href
-                if not name and href:
-                    name = href.split('/')[-1].split('?')[0]
-                
-                if href and name and name not in seen_names:
-                    # Проверяем расширение в имени или в href
-                    name_lower = name.lower()
-                    href_lower = href.lower()
-                    if any(ext in name_lower for ext in image_extensions) or any(ext in href_lower for ext in image_extensions):
-                        if href.startswith('http'):
-                            file_url = href.split('?')[0]  # Убираем query параметры
-                        elif href.startswith('/'):
-                            file_url = f"https://disk.yandex.ru{href.split('?')[0]}"
-                        else:
-                            if folder_id:
-                                file_url = f"https://disk.yandex.ru/d/{folder_id}/{href.split('?')[0]}"
-                            else:
-                                # Для формата /client/disk/ используем базовый URL
-                                base_url = folder_url.rsplit('/', 1)[0] if folder_url else "https://disk.yandex.ru"
-                                file_url = f"{base_url}/{href.split('?')[0]}"
-                        
-                        if file_url not in seen_urls:
-                            files.append({
-                                "name": name,
-                                "path": file_url,
-                                "url": file_url,
-                                "mime_type": "image/jpeg"
-                            })
-                            seen_names.add(name)
-                            seen_urls.add(file_url)
             
-            # Метод 2: Ищем изображения напрямую (img теги)
-            img_tags = soup.find_all('img', src=True)
-            for img in img_tags:
-                src = img.get('src', '').strip()
-                alt = img.get('alt', '').strip()
-                title = img.get('title', '').strip()
-                data_name = img.get('data-name', '').strip()
-                
-                name = alt or title or data_name or src.split('/')[-1].split('?')[0]
-                
-                if src and name and name not in seen_names:
-                    if any(ext in name.lower() for ext in image_extensions) or any(ext in src.lower() for ext in image_extensions):
-                        if src.startswith('http'):
-                            file_url = src.split('?')[0]
-                        elif src.startswith('/'):
-                            file_url = f"https://disk.yandex.ru{src.split('?')[0]}"
-                        else:
-                            if folder_id:
-                                file_url = f"https://disk.yandex.ru/d/{folder_id}/{src.split('?')[0]}"
-                            else:
-                                base_url = folder_url.rsplit('/', 1)[0] if folder_url else "https://disk.yandex.ru"
-                                file_url = f"{base_url}/{src.split('?')[0]}"
-                        
-                        if file_url not in seen_urls:
-                            files.append({
-                                "name": name,
-                                "path": file_url,
-                                "url": file_url,
-                                "mime_type": "image/jpeg"
-                            })
-                            seen_names.add(name)
-                            seen_urls.add(file_url)
-            
-            # Метод 3: Ищем данные в скриптах (JSON) - улучшенный
-            scripts = soup.find_all('script')
-            for script in scripts:
-                if not script.string:
-                    continue
-                
-                script_text = script.string
-                # Расширенный поиск JSON данных
-                if any(keyword in script_text for keyword in ['items', 'resources', 'files', 'itemsList', 'fileList', 'photos', 'images']):
-                    try:
-                        # Ищем различные JSON паттерны
-                        json_patterns = [
-                            r'window\.__INITIAL_STATE__\s*=\s*({.+?});',
-                            r'window\.__DATA__\s*=\s*({.+?});',
-                            r'"items"\s*:\s*\[(.*?)\]',
-                            r'"resources"\s*:\s*\[(.*?)\]',
-                            r'"files"\s*:\s*\[(.*?)\]',
-                            r'\{[^{}]*"name"[^{}]*"path"[^{}]*\}',
-                            r'\[[^\]]*\{[^{}]*"name"[^{}]*\}[^\]]*\]'
-                        ]
-                        
-                        for pattern in json_patterns:
-                            matches = re.finditer(pattern, script_text, re.DOTALL)
-                            for match in matches:
-                                try:
-                                    json_str = match.group(1) if match.groups() else match.group(0)
-                                    json_str = json_str.strip().rstrip(';')
-                                    
-                                    # Пробуем распарсить как JSON
-                                    try:
-                                        data = json.loads(json_str)
-                                    except:
-                                        # Если не JSON, пробуем найти объекты через regex
-                                        continue
-                                    
-                                    items = []
-                                    if isinstance(data, dict):
-                                        # Рекурсивно ищем items в словаре
-                                        def find_items(obj, depth=0):
-                                            if depth > 5:  # Ограничение глубины
-                                                return []
-                                            result = []
-                                            if isinstance(obj, dict):
-                                                if 'name' in obj and ('path' in obj or 'url' in obj or 'href' in obj):
-                                                    result.append(obj)
-                                                for v in obj.values():
-                                                    result.extend(find_items(v, depth+1))
-                                            elif isinstance(obj, list):
-                                                for item in obj:
-                                                    result.extend(find_items(item, depth+1))
-                                            return result
-                                        
-                                        items = find_items(data)
-                                        if not items:
-                                            items = data.get('items', data.get('resources', data.get('files', data.get('data', []))))
-                                    elif isinstance(data, list):
-                                        items = data
-                                    
-                                    for item in items:
-                                        if isinstance(item, dict):
-                                            name = (
-                                                item.get('name') or 
-                                                item.get('title') or 
-                                                item.get('filename') or 
-                                                item.get('displayName') or
-                                                ''
-                                            )
-                                            
-                                            if name and name not in seen_names:
-                                                name_lower = name.lower()
-                                                if any(ext in name_lower for ext in image_extensions):
-                                                    file_url = (
-                                                        item.get('file') or 
-                                                        item.get('href') or 
-                                                        item.get('url') or 
-                                                        item.get('path') or
-                                                        item.get('downloadUrl') or
-                                                        ''
-                                                    )
-                                                    
-                                                    if file_url:
-                                                        if not file_url.startswith('http'):
-                                                            if file_url.startswith('/'):
-                                                                file_url = f"https://disk.yandex.ru{file_url}"
-                                                            else:
-                                                                if folder_id:
-                                                                    file_url = f"https://disk.yandex.ru/d/{folder_id}/{file_url}"
-                                                                else:
-                                                                    base_url = folder_url.rsplit('/', 1)[0] if folder_url else "https://disk.yandex.ru"
-                                                                    file_url = f"{base_url}/{file_url}"
-                                                        
-                                                        file_url = file_url.split('?')[0]
-                                                        
-                                                        if file_url not in seen_urls:
-                                                            files.append({
-                                                                "name": name,
-                                                                "path": file_url,
-                                                                "url": file_url,
-                                                                "mime_type": item.get('mime_type', item.get('mimeType', 'image/jpeg'))
-                                                            })
-                                                            seen_names.add(name)
-                                                            seen_urls.add(file_url)
-                                except (json.JSONDecodeError, KeyError, AttributeError, TypeError) as e:
-                                    continue
-                    except Exception as e:
+            def collect(candidates):
+                """Нормализация и дедупликация кандидатов (name, href, mime_type)"""
+                for name, href, mime_type in candidates:
+                    if name in seen_names:
                         continue
+                    file_url = normalize_href(href, folder_id, folder_url)
+                    if file_url not in files:
+                        name = intern_short(name)
+                        file_url = intern_short(file_url)
+                        files[file_url] = FileEntry(name, file_url, mime_type)
+                        seen_names.add(name)
             
-            # Метод 4: Ищем через data-атрибуты и классы
-            elements = soup.find_all(attrs={'data-name': True})
-            for elem in elements:
-                name = elem.get('data-name', '').strip()
-                href = (
-                    elem.get('href', '').strip() or 
-                    elem.get('data-href', '').strip() or
-                    elem.get('data-url', '').strip() or
-                    (elem.find('a', href=True) and elem.find('a', href=True).get('href', '').strip()) or
-                    ''
-                )
-                
-                if name and href and name not in seen_names:
-                    name_lower = name.lower()
-                    if any(ext in name_lower for ext in image_extensions):
-                        if not href.startswith('http'):
-                            if href.startswith('/'):
-                                href = f"https://disk.yandex.ru{href}"
-                            else:
-                                if folder_id:
-                                    href = f"https://disk.yandex.ru/d/{folder_id}/{href}"
-                                else:
-                                    base_url = folder_url.rsplit('/', 1)[0] if folder_url else "https://disk.yandex.ru"
-                                    href = f"{base_url}/{href}"
-                        
-                        href = href.split('?')[0]
-                        
-                        if href not in seen_urls:
-                            files.append({
-                                "name": name,
-                                "path": href,
-                                "url": href,
-                                "mime_type": "image/jpeg"
-                            })
-                            seen_names.add(name)
-                            seen_urls.add(href)
+            # Методы 1-2: ссылки и img теги
+            collect(iter_html_candidates(nodes))
+            html_found = len(files)
             
-            # Метод 5: Ищем через классы с префиксами Яндекс Диска
-            disk_elements = soup.find_all(class_=re.compile(r'(file|item|resource|photo|image)', re.I))
-            for elem in disk_elements:
-                link = elem.find('a', href=True)
-                if link:
-                    href = link.get('href', '').strip()
-                    name = (
-                        link.get_text(strip=True) or 
-                        link.get('title', '') or 
-                        elem.get('data-name', '') or
-                        href.split('/')[-1].split('?')[0] or
-                        ''
-                    )
-                    
-                    if href and name and name not in seen_names:
-                        name_lower = name.lower()
-                        href_lower = href.lower()
-                        if any(ext in name_lower for ext in image_extensions) or any(ext in href_lower for ext in image_extensions):
-                            if not href.startswith('http'):
-                                if href.startswith('/'):
-                                    href = f"https://disk.yandex.ru{href}"
-                                else:
-                                    if folder_id:
-                                        href = f"https://disk.yandex.ru/d/{folder_id}/{href}"
-                                    else:
-                                        base_url = folder_url.rsplit('/', 1)[0] if folder_url else "https://disk.yandex.ru"
-                                        href = f"{base_url}/{href}"
-                            
-                            href = href.split('?')[0]
-                            
-                            if href not in seen_urls:
-                                files.append({
-                                    "name": name,
-                                    "path": href,
-                                    "url": href,
-                                    "mime_type": "image/jpeg"
-                                })
-                                seen_names.add(name)
-                            seen_urls.add(href)
+            # Метод 3 (JSON в скриптах) пропускаем, если ссылок уже достаточно и на странице нет JSON состояния
+            if force_full or html_found < PUBLIC_EARLY_EXIT_MIN or any(anchor in html for anchor in PUBLIC_STATE_ANCHORS):
+                collect(iter_script_candidates(nodes.scripts))
+            script_found = len(files) - html_found
+            
+            # Методы 4-5 нужны только если файлы не найдены (или force_full)
+            if force_full or not files:
+                collect(iter_fallback_candidates(nodes))
+            fallback_found = len(files) - html_found - script_found
             
-            logger.info(f"Found {len(files)} files using {len(seen_names)} unique names")
+            logger.info(f"Found {len(files)} files (html: {html_found}, scripts: {script_found}, fallback: {fallback_found})")
             
             # Если файлов не найдено, возвращаем информацию для отладки
             if len(files) == 0:
-                logger.warning(f"No files found. HTML length: {len(html)}, Links found: {len(all_links)}, Images found: {len(img_tags)}")
+                logger.warning(f"No files found. HTML length: {len(html)}, Links found: {len(nodes.links)}, Images found: {len(nodes.images)}")
                 # Сохраняем HTML для отладки (опционально, можно закомментировать в продакшене)
                 # with open(f"debug_{folder_id}.html", "w", encoding="utf-8") as f:
                 #     f.write(html)
             
-            return {"files": files, "folder_id": folder_id, "folder_path": folder_path, "total_found": len(files)}
+            result = {"files": [entry.to_dict() for entry in files.values()], "folder_id": folder_id, "folder_path": folder_path, "total_found": len(files)}
+            PUBLIC_FOLDER_CACHE[cache_key] = result
+            return result
             
     except HTTPException:
         raise
@@ -1315,162 +1766,232 @@ async def get_public_yandex_files(public_url: str = Query(...)):
         logger.error(f"Error parsing public folder: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error parsing public folder: {str(e)}")
 
+@app.get("/api/yandex/public-files")
+async def get_public_yandex_files(
+    public_url: str = Query(...),
+    force_full: bool = Query(False),
+    refresh: bool = Query(False)
+):
+    """Получение списка файлов из публичной папки Яндекс Диска"""
+    return await parse_public_folder(public_url, force_full=force_full, refresh=refresh)
+
 @app.get("/api/yandex/files")
 async def get_yandex_files(path: str, token: Optional[str] = None):
     """Получение списка файлов в папке"""
     # Если токен не передан, пробуем использовать токен из .env
     if not token:
-        token = os.getenv("YANDEX_DISK_TOKEN")
+        token = YANDEX_ENV_TOKEN
     
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    async with httpx.AsyncClient() as client:
+    client = get_http_client()
+    response = await client.get(
+        "https://cloud-api.yandex.net/v1/disk/resources",
+        params={"path": path, "limit": 1000},
+        headers={"Authorization": f"OAuth {token}"},
+        timeout=30.0
+    )
+    
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail="Failed to fetch files")
+    
+    data = orjson.loads(response.content)
+    files = [
+        {
+            "name": item["name"],
+            "path": item["path"],
+            "mime_type": item.get("mime_type"),
+            "size": item.get("size")
+        }
+        for item in data.get("_embedded", {}).get("items", [])
+        if item.get("type") == "file" and item.get("mime_type", "").startswith("image/")
+    ]
+    
+    return {"files": files}
+
+# Поля, которые запрашиваем у Yandex Disk API для структуры (меньше JSON для разбора)
+STRUCTURE_FIELDS = "_embedded.items.name,_embedded.items.type,_embedded.items.path,_embedded.items.mime_type,_embedded.items.size"
+
+# Максимум одновременных запросов к API при загрузке структуры одного запроса
+STRUCTURE_FETCH_CONCURRENCY = 20
+# Максимальная глубина жадной загрузки структуры (lazy=false)
+STRUCTURE_MAX_DEPTH = 5
+
+async def fetch_structure_level(
+    client: httpx.AsyncClient,
+    path: str,
+    headers: dict,
+    semaphore: asyncio.Semaphore,
+    level: int = 0,
+    eager_depth: int = 0
+) -> Optional[list]:
+    """Один уровень структуры папки; при eager_depth > 0 подпапки загружаются параллельно (None - ошибка API)"""
+    async with semaphore:
         response = await client.get(
             "https://cloud-api.yandex.net/v1/disk/resources",
-            params={"path": path, "limit": 1000},
-            headers={"Authorization": f"OAuth {token}"},
+            params={"path": path, "limit": 1000, "fields": STRUCTURE_FIELDS},
+            headers=headers,
             timeout=30.0
         )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail="Failed to fetch files")
-        
-        data = response.json()
-        files = [
-            {
-                "name": item["name"],
-                "path": item["path"],
-                "mime_type": item.get("mime_type"),
-                "size": item.get("size")
-            }
-            for item in data.get("_embedded", {}).get("items", [])
-            if item.get("type") == "file" and item.get("mime_type", "").startswith("image/")
-        ]
-        
-        return {"files": files}
+    
+    if response.status_code != 200:
+        return None
+    
+    data = orjson.loads(response.content)
+    items = data.get("_embedded", {}).get("items", [])
+    
+    result = []
+    
+    for item in items:
+        item_type = item.get("type")
+        name = item.get("name")
+        item_path = item.get("path", path)
+        
+        if item_type == "dir":
+            # Для папок не загружаем содержимое сразу (ленивая загрузка)
+            result.append({
+                "name": name,
+                "path": item_path,
+                "type": "dir",
+                "depth": level,
+                "children": None,  # Будет загружено по требованию
+                "has_children": True  # Уточняется ниже
+            })
+        else:
+            # Показываем только изображения
+            if RASTER_EXTENSION_RE.search(name) or item.get("mime_type", "").startswith("image/"):
+                result.append({
+                    "name": name,
+                    "path": item_path,
+                    "type": "file",
+                    "depth": level,
+                    "mime_type": item.get("mime_type"),
+                    "size": item.get("size")
+                })
+    
+    dirs = [entry for entry in result if entry["type"] == "dir"]
+    
+    if eager_depth > 0:
+        # Жадный режим: все подпапки уровня загружаются параллельно
+        children = await asyncio.gather(*(
+            fetch_structure_level(client, entry["path"], headers, semaphore, level + 1, eager_depth - 1)
+            for entry in dirs
+        ), return_exceptions=True)
+        for entry, entry_children in zip(dirs, children):
+            # При ошибке оставляем children=None и has_children=True, чтобы папку можно было раскрыть
+            if isinstance(entry_children, list):
+                entry["children"] = entry_children
+                entry["has_children"] = bool(entry_children)
+        return result
+    
+    # Параллельно проверяем, есть ли что-то внутри каждой папки (limit=1)
+    async def probe(entry_path: str) -> httpx.Response:
+        async with semaphore:
+            return await client.get(
+                "https://cloud-api.yandex.net/v1/disk/resources",
+                params={"path": entry_path, "limit": 1, "fields": "_embedded.items.name"},
+                headers=headers,
+                timeout=30.0
+            )
+    
+    probes = await asyncio.gather(*(probe(entry["path"]) for entry in dirs), return_exceptions=True)
+    for entry, probe_response in zip(dirs, probes):
+        # При ошибке проверки оставляем has_children=True, чтобы папку можно было раскрыть
+        if not isinstance(probe_response, Exception) and probe_response.status_code == 200:
+            entry["has_children"] = bool(orjson.loads(probe_response.content).get("_embedded", {}).get("items"))
+    
+    return result
 
 @app.get("/api/yandex/structure")
 async def get_yandex_structure(
     path: str = Query("/"),
     token: Optional[str] = Query(None),
-    lazy: bool = Query(True)
+    lazy: bool = Query(True),
+    depth: int = Query(1)
 ):
-    """Получение структуры папок и файлов с Yandex Disk (ленивая загрузка - только один уровень)"""
+    """Получение структуры папок и файлов с Yandex Disk (ленивая загрузка - один уровень, lazy=false - еще depth уровней подпапок)"""
     # Если токен не передан, пробуем использовать токен из .env
     if not token:
-        token = os.getenv("YANDEX_DISK_TOKEN")
+        token = YANDEX_ENV_TOKEN
     
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                "https://cloud-api.yandex.net/v1/disk/resources",
-                params={"path": path, "limit": 1000},
-                headers={"Authorization": f"OAuth {token}"},
-                timeout=30.0
-            )
-            
-            if response.status_code != 200:
-                return {"path": path, "structure": []}
-            
-            data = response.json()
-            items = data.get("_embedded", {}).get("items", [])
-            
-            result = []
-            image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff']
-            
-            for item in items:
-                item_type = item.get("type")
-                name = item.get("name")
-                item_path = item.get("path", path)
-                
-                if item_type == "dir":
-                    # Для папок не загружаем содержимое сразу (ленивая загрузка)
-                    result.append({
-                        "name": name,
-                        "path": item_path,
-                        "type": "dir",
-                        "depth": 0,
-                        "children": None,  # Будет загружено по требованию
-                        "has_children": True  # Предполагаем, что есть дети (можно проверить через API)
-                    })
-                else:
-                    # Показываем только изображения
-                    name_lower = name.lower()
-                    if any(ext in name_lower for ext in image_extensions) or item.get("mime_type", "").startswith("image/"):
-                        result.append({
-                            "name": name,
-                            "path": item_path,
-                            "type": "file",
-                            "depth": 0,
-                            "mime_type": item.get("mime_type"),
-                            "size": item.get("size")
-                        })
-            
-            return {
-                "path": path,
-                "structure": result
-            }
-            
-        except Exception as e:
-            logging.error(f"Error listing folder {path}: {str(e)}")
-            return {"path": path, "structure": []}
+    client = get_http_client()
+    try:
+        headers = {"Authorization": f"OAuth {token}"}
+        eager_depth = 0 if lazy else max(0, min(depth, STRUCTURE_MAX_DEPTH))
+        result = await fetch_structure_level(
+            client, path, headers, asyncio.Semaphore(STRUCTURE_FETCH_CONCURRENCY), eager_depth=eager_depth
+        )
+        
+        return {
+            "path": path,
+            "structure": result or []
+        }
+        
+    except Exception as e:
+        logging.error(f"Error listing folder {path}: {str(e)}")
+        return {"path": path, "structure": []}
 
 @app.get("/api/yandex/account-info")
 async def get_yandex_account_info(token: Optional[str] = Query(None)):
     """Получение информации о аккаунте Yandex Disk"""
     # Если токен не передан, пробуем использовать токен из .env
     if not token:
-        token = os.getenv("YANDEX_DISK_TOKEN")
+        token = YANDEX_ENV_TOKEN
     
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            "https://cloud-api.yandex.net/v1/disk",
-            headers={"Authorization": f"OAuth {token}"},
-            timeout=30.0
-        )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail="Failed to fetch account info")
-        
-        data = response.json()
-        total_space = data.get("total_space", 0)
-        used_space = data.get("used_space", 0)
-        
-        return {
-            "login": data.get("user", {}).get("login", "Unknown"),
-            "display_name": data.get("user", {}).get("display_name", "Unknown"),
-            "uid": data.get("user", {}).get("uid", "Unknown"),
-            "total_space_gb": round(total_space / (1024**3), 2) if total_space else 0,
-            "used_space_gb": round(used_space / (1024**3), 2) if used_space else 0,
-            "free_space_gb": round((total_space - used_space) / (1024**3), 2) if total_space and used_space else 0
-        }
+    client = get_http_client()
+    response = await client.get(
+        "https://cloud-api.yandex.net/v1/disk",
+        headers={"Authorization": f"OAuth {token}"},
+        timeout=30.0
+    )
+    
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail="Failed to fetch account info")
+    
+    data = orjson.loads(response.content)
+    total_space = data.get("total_space", 0)
+    used_space = data.get("used_space", 0)
+    
+    return {
+        "login": data.get("user", {}).get("login", "Unknown"),
+        "display_name": data.get("user", {}).get("display_name", "Unknown"),
+        "uid": data.get("user", {}).get("uid", "Unknown"),
+        "total_space_gb": round(total_space / (1024**3), 2) if total_space else 0,
+        "used_space_gb": round(used_space / (1024**3), 2) if used_space else 0,
+        "free_space_gb": round((total_space - used_space) / (1024**3), 2) if total_space and used_space else 0
+    }
+
+async def iter_upload_file(file: UploadFile):
+    """Чтение загружаемого файла чанками"""
+    while chunk := await file.read(STREAM_CHUNK_SIZE):
+        yield chunk
 
 @app.get("/api/yandex/download-public")
 async def download_public_file(file_url: str = Query(..., alias="url")):
     """Скачивание публичного файла с Яндекс Диска"""
     try:
-        async with httpx.AsyncClient() as client:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': '*/*',
-                'Referer': 'https://disk.yandex.ru/'
-            }
-            response = await client.get(file_url, headers=headers, timeout=60.0, follow_redirects=True)
-            
-            if response.status_code != 200:
-                raise HTTPException(status_code=response.status_code, detail="Failed to download file")
-            
-            return Response(
-                content=response.content,
-                media_type=response.headers.get("content-type", "application/octet-stream")
-            )
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'Accept': '*/*',
+            'Referer': 'https://disk.yandex.ru/'
+        }
+        response = await open_download_stream(file_url, headers=headers)
+        
+        if response.status_code != 200:
+            await response.aclose()
+            raise HTTPException(status_code=response.status_code, detail="Failed to download file")
+        
+        return UpstreamStreamingResponse(
+            response,
+            media_type=response.headers.get("content-type", "application/octet-stream")
+        )
     except HTTPException:
         raise
     except Exception as e:
@@ -1481,49 +2002,42 @@ async def download_yandex_file(path: str, token: Optional[str] = None):
     """Скачивание файла с Яндекс Диска (OAuth)"""
     # Если токен не передан, пробуем использовать токен из .env
     if not token:
-        token = os.getenv("YANDEX_DISK_TOKEN")
+        token = YANDEX_ENV_TOKEN
     
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    async with httpx.AsyncClient() as client:
-        # Получаем ссылку для скачивания
-        link_response = await client.get(
-            "https://cloud-api.yandex.net/v1/disk/resources/download",
-            params={"path": path},
-            headers={"Authorization": f"OAuth {token}"},
-            timeout=30.0
-        )
-        
-        if link_response.status_code != 200:
-            raise HTTPException(status_code=link_response.status_code, detail="Failed to get download link")
-        
-        download_url = link_response.json()["href"]
-        
-        # Скачиваем файл (Yandex Disk возвращает 302 redirect, нужно следовать за ним)
-        file_response = await client.get(download_url, timeout=60.0, follow_redirects=True)
-        
-        if file_response.status_code != 200:
-            raise HTTPException(status_code=file_response.status_code, detail=f"Failed to download file: {file_response.status_code}")
-        
-        # Определяем content-type из заголовков или по расширению файла
-        content_type = file_response.headers.get("content-type", "application/octet-stream")
-        if content_type == "application/octet-stream":
-            # Пытаемся определить тип по расширению из пути
-            path_lower = path.lower()
-            if path_lower.endswith(('.jpg', '.jpeg')):
-                content_type = "image/jpeg"
-            elif path_lower.endswith('.png'):
-                content_type = "image/png"
-            elif path_lower.endswith('.gif'):
-                content_type = "image/gif"
-            elif path_lower.endswith('.webp'):
-                content_type = "image/webp"
-        
-        return Response(
-            content=file_response.content,
-            media_type=content_type
-        )
+    client = get_http_client()
+    # Получаем ссылку для скачивания
+    link_response = await client.get(
+        "https://cloud-api.yandex.net/v1/disk/resources/download",
+        params={"path": path},
+        headers={"Authorization": f"OAuth {token}"},
+        timeout=30.0
+    )
+    
+    if link_response.status_code != 200:
+        raise HTTPException(status_code=link_response.status_code, detail="Failed to get download link")
+    
+    download_url = orjson.loads(link_response.content)["href"]
+    
+    # Скачиваем файл потоком (Yandex Disk возвращает 302 redirect, нужно следовать за ним)
+    file_response = await open_download_stream(download_url)
+    
+    if file_response.status_code != 200:
+        await file_response.aclose()
+        raise HTTPException(status_code=file_response.status_code, detail=f"Failed to download file: {file_response.status_code}")
+    
+    # Определяем content-type из заголовков или по расширению файла
+    content_type = file_response.headers.get("content-type", "application/octet-stream")
+    if content_type == "application/octet-stream":
+        # Пытаемся определить тип по расширению из пути
+        content_type = guess_content_type(path)
+    
+    return UpstreamStreamingResponse(
+        file_response,
+        media_type=content_type
+    )
 
 @app.post("/api/yandex/upload")
 async def upload_yandex_file(
@@ -1534,100 +2048,213 @@ async def upload_yandex_file(
     """Загрузка файла на Яндекс Диск"""
     # Если токен не передан, пробуем использовать токен из .env
     if not token:
-        token = os.getenv("YANDEX_DISK_TOKEN")
+        token = YANDEX_ENV_TOKEN
+    
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    auth_headers = {"Authorization": f"OAuth {token}"}
+    client = get_http_client()
+    # Проверяем, существует ли файл уже
+    try:
+        check_response = await client.get(
+            "https://cloud-api.yandex.net/v1/disk/resources",
+            params={"path": path},
+            headers=auth_headers,
+            timeout=30.0
+        )
+        if check_response.status_code == 200:
+            raise HTTPException(status_code=409, detail="File already exists")
+    except HTTPException:
+        raise
+    except:
+        pass  # Если проверка не удалась, продолжаем загрузку
+    
+    # Получаем ссылку для загрузки
+    link_response = await client.get(
+        "https://cloud-api.yandex.net/v1/disk/resources/upload",
+        params={"path": path, "overwrite": "false"},
+        headers=auth_headers,
+        timeout=30.0
+    )
+    
+    if link_response.status_code != 200:
+        raise HTTPException(status_code=link_response.status_code, detail="Failed to get upload link")
+    
+    upload_url = orjson.loads(link_response.content)["href"]
+    
+    # Загружаем файл потоком, не читая его целиком в память
+    upload_headers = {"Content-Type": file.content_type or "application/octet-stream"}
+    if file.size is not None:
+        upload_headers["Content-Length"] = str(file.size)
+    upload_response = await client.put(
+        upload_url,
+        content=iter_upload_file(file),
+        headers=upload_headers,
+        timeout=60.0
+    )
+    
+    if upload_response.status_code not in [201, 202]:
+        raise HTTPException(status_code=upload_response.status_code, detail="Failed to upload file")
+    
+    return {"success": True, "path": path}
+
+# Сколько файлов пакетной загрузки одновременно получают ссылку и загружаются на Яндекс Диск
+YANDEX_UPLOAD_CONCURRENCY = int(os.getenv("YANDEX_UPLOAD_CONCURRENCY", "8"))
+
+@app.post("/api/yandex/upload-batch")
+async def upload_yandex_files_batch(
+    files: List[UploadFile] = File(...),
+    paths: List[str] = Form(...),
+    token: Optional[str] = Form(None)
+):
+    """Параллельная загрузка нескольких файлов на Яндекс Диск"""
+    # Если токен не передан, пробуем использовать токен из .env
+    if not token:
+        token = YANDEX_ENV_TOKEN
     
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    file_bytes = await file.read()
+    if len(files) != len(paths):
+        raise HTTPException(status_code=400, detail="Number of files and paths must match")
     
-    async with httpx.AsyncClient() as client:
-        # Проверяем, существует ли файл уже
-        try:
-            check_response = await client.get(
-                "https://cloud-api.yandex.net/v1/disk/resources",
-                params={"path": path},
-                headers={"Authorization": f"OAuth {token}"},
+    client = get_http_client()
+    headers = {"Authorization": f"OAuth {token}"}
+    # Не больше YANDEX_UPLOAD_CONCURRENCY запросов пакета к Яндекс Диску одновременно
+    semaphore = asyncio.Semaphore(YANDEX_UPLOAD_CONCURRENCY)
+    
+    async def get_upload_link(path: str) -> httpx.Response:
+        """Получение ссылки для загрузки одного файла"""
+        async with semaphore:
+            return await client.get(
+                "https://cloud-api.yandex.net/v1/disk/resources/upload",
+                params={"path": path, "overwrite": "false"},
+                headers=headers,
                 timeout=30.0
             )
-            if check_response.status_code == 200:
-                raise HTTPException(status_code=409, detail="File already exists")
-        except HTTPException:
-            raise
-        except:
-            pass  # Если проверка не удалась, продолжаем загрузку
-        
-        # Получаем ссылку для загрузки
-        link_response = await client.get(
-            "https://cloud-api.yandex.net/v1/disk/resources/upload",
-            params={"path": path, "overwrite": "false"},
-            headers={"Authorization": f"OAuth {token}"},
-            timeout=30.0
-        )
-        
+    
+    # Получаем ссылки для загрузки параллельно
+    link_responses = await asyncio.gather(*(get_upload_link(path) for path in paths), return_exceptions=True)
+    
+    async def upload_one(file: UploadFile, path: str, link_response) -> dict:
+        """Загрузка одного файла по полученной ссылке"""
+        if isinstance(link_response, Exception):
+            return {"path": path, "success": False, "error": str(link_response)}
+        if link_response.status_code == 409:
+            return {"path": path, "success": False, "error": "File already exists"}
         if link_response.status_code != 200:
-            raise HTTPException(status_code=link_response.status_code, detail="Failed to get upload link")
-        
-        upload_url = link_response.json()["href"]
+            return {"path": path, "success": False, "error": f"Failed to get upload link: {link_response.status_code}"}
         
-        # Загружаем файл
-        upload_response = await client.put(
-            upload_url,
-            content=file_bytes,
-            headers={"Content-Type": file.content_type or "application/octet-stream"},
-            timeout=60.0
-        )
+        upload_headers = {"Content-Type": file.content_type or "application/octet-stream"}
+        if file.size is not None:
+            upload_headers["Content-Length"] = str(file.size)
+        try:
+            async with semaphore:
+                upload_response = await client.put(
+                    orjson.loads(link_response.content)["href"],
+                    content=iter_upload_file(file),
+                    headers=upload_headers,
+                    timeout=60.0
+                )
+        except Exception as e:
+            return {"path": path, "success": False, "error": str(e)}
         
         if upload_response.status_code not in [201, 202]:
-            raise HTTPException(status_code=upload_response.status_code, detail="Failed to upload file")
-        
-        return {"success": True, "path": path}
+            return {"path": path, "success": False, "error": f"Failed to upload file: {upload_response.status_code}"}
+        return {"path": path, "success": True}
+    
+    # Загружаем файлы параллельно
+    results = await asyncio.gather(*(
+        upload_one(file, path, link_response)
+        for file, path, link_response in zip(files, paths, link_responses)
+    ))
+    
+    return {"success": all(r["success"] for r in results), "results": results}
 
 @app.post("/api/yandex/create-folder")
 async def create_yandex_folder(path: str, token: Optional[str] = Form(None)):
     """Создание папки на Яндекс Диске"""
     # Если токен не передан, пробуем использовать токен из .env
     if not token:
-        token = os.getenv("YANDEX_DISK_TOKEN")
+        token = YANDEX_ENV_TOKEN
     
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    async with httpx.AsyncClient() as client:
-        response = await client.put(
-            "https://cloud-api.yandex.net/v1/disk/resources",
-            params={"path": path},
-            headers={"Authorization": f"OAuth {token}"},
-            timeout=30.0
-        )
-        
-        # Игнорируем ошибку если папка уже существует
-        if response.status_code == 409:
-            return {"success": True, "path": path, "exists": True}
-        
-        if response.status_code not in [201, 202]:
-            raise HTTPException(status_code=response.status_code, detail="Failed to create folder")
-        
-        return {"success": True, "path": path}
+    client = get_http_client()
+    response = await client.put(
+        "https://cloud-api.yandex.net/v1/disk/resources",
+        params={"path": path},
+        headers={"Authorization": f"OAuth {token}"},
+        timeout=30.0
+    )
+    
+    # Игнорируем ошибку если папка уже существует
+    if response.status_code == 409:
+        return {"success": True, "path": path, "exists": True}
+    
+    if response.status_code not in [201, 202]:
+        raise HTTPException(status_code=response.status_code, detail="Failed to create folder")
+    
+    return {"success": True, "path": path}
+
+# Имя продукта - начало имени файла до первой цифры, подчеркивания или дефиса
+PRODUCT_NAME_RE = re.compile(r'^([^0-9_\-]+)')
+
+# Размер части для base64 кодирования (кратен 3 - части кодируются независимо, ~2 мс на часть)
+B64_CHUNK_SIZE = 3 * 256 * 1024
+
+async def b64encode_async(data: bytes) -> str:
+    """base64 кодирование частями с передачей управления циклу событий между частями"""
+    if len(data) <= B64_CHUNK_SIZE:
+        return base64.b64encode(data).decode('ascii')
+    view = memoryview(data)
+    parts = []
+    for offset in range(0, len(data), B64_CHUNK_SIZE):
+        parts.append(base64.b64encode(view[offset:offset + B64_CHUNK_SIZE]).decode('ascii'))
+        await asyncio.sleep(0)
+    return ''.join(parts)
+
+# Результаты пакетной обработки, отдаваемые по ссылке (inline=false), ограничены суммарным размером (BATCH_RESULT_MB)
+BATCH_RESULT_STORE = TTLCache(maxsize=int(os.getenv("BATCH_RESULT_MB", "512")) * 1024 * 1024, ttl=3600, getsizeof=len)
+
+async def batch_output(data: bytes, inline: bool) -> dict:
+    """Поле результата пакетной обработки: base64 в JSON или ссылка на /api/batch-result"""
+    if inline or len(data) > BATCH_RESULT_STORE.maxsize:
+        return {"data": await b64encode_async(data)}
+    result_id = secrets.token_urlsafe(16)
+    BATCH_RESULT_STORE[result_id] = data
+    return {"url": f"/api/batch-result/{result_id}"}
+
+@app.get("/api/batch-result/{result_id}")
+async def get_batch_result(result_id: str):
+    """Изображение из результатов пакетной обработки (хранится час)"""
+    data = BATCH_RESULT_STORE.get(result_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Result not found or expired")
+    return Response(content=data, media_type="image/png")
 
 @app.post("/api/batch-process-products")
 async def batch_process_products(
     public_url: str = Form(...),
     model: str = Form("replicate"),
     apiKey: Optional[str] = Form(None),
-    token: Optional[str] = Form(None)
+    token: Optional[str] = Form(None),
+    inline: bool = Form(True)
 ):
     """
     Batch processing продуктов из папки Яндекс Диска.
     Ожидается структура: папки с продуктами, в каждой папке 5 фотографий.
     Все фотографии обрабатываются через удаление фона.
     Для первой фотографии каждого продукта создается версия с дизайном.
+    inline=false - вместо base64 в "data" возвращается "url" на /api/batch-result/{id} (для дизайна - ссылка Replicate).
     """
     logger = logging.getLogger(__name__)
     
     try:
         # Получаем список файлов из папки
-        files_response = await get_public_yandex_files(public_url=public_url)
+        files_response = await parse_public_folder(public_url)
         files = files_response.get("files", [])
         
         if not files:
@@ -1636,19 +2263,18 @@ async def batch_process_products(
         # Группируем файлы по продуктам
         # Предполагаем, что файлы организованы в папки или имеют паттерн именования
         # Для простоты, группируем по первым символам имени (до первого числа или разделителя)
-        products = {}
-        for file in files:
+        # Файлы сортируются по имени один раз (список из кэша не меняем), группы сохраняют этот порядок
+        products = defaultdict(list)
+        for file in sorted(files, key=lambda x: x.get("name", "")):
             name = file.get("name", "")
             # Извлекаем имя продукта (до первого числа, подчеркивания или дефиса)
-            product_match = re.match(r'^([^0-9_\-]+)', name)
+            product_match = PRODUCT_NAME_RE.match(name)
             if product_match:
                 product_name = product_match.group(1).strip()
             else:
                 # Если паттерн не найден, используем имя файла без расширения
                 product_name = name.rsplit('.', 1)[0]
             
-            if product_name not in products:
-                products[product_name] = []
             products[product_name].append(file)
         
         logger.info(f"Found {len(products)} products, total files: {len(files)}")
@@ -1658,141 +2284,189 @@ async def batch_process_products(
         if not api_key:
             raise HTTPException(status_code=400, detail="API key not provided")
         
+        # Конвейер: пока BATCH_FILE_CONCURRENCY файлов обрабатываются моделью, столько же следующих уже скачиваются
+        file_semaphore = asyncio.Semaphore(2 * BATCH_FILE_CONCURRENCY)
+        model_semaphore = asyncio.Semaphore(BATCH_FILE_CONCURRENCY)
+        # Версии с дизайном создаются по одной с паузой (rate limit Replicate)
+        design_lock = asyncio.Lock()
+        # Задачи удаления фона по хэшу изображения - одинаковые файлы внутри пакета обрабатываются один раз
+        model_tasks = {}
+        # Задачи создания версий с дизайном: (результаты продукта, задача)
+        design_tasks = []
+        
+        async def remove_background(image_bytes: bytes) -> bytes:
+            """Удаление фона выбранной моделью с учетом лимитов пакета и провайдера"""
+            async with model_semaphore, MODEL_SEMAPHORES[model]:
+                return await MODELS[model](image_bytes, api_key, None)
+        
+        async def make_design(product_name: str, processed_bytes: bytes) -> Optional[dict]:
+            """Версия первой фотографии продукта с дизайном (Replicate, фон из BATCH_BACKGROUND_URI)"""
+            try:
+                # Используем внутренний вызов place_on_background
+                processed_file_obj = io.BytesIO(processed_bytes)
+                processed_file_obj.name = "processed.png"
+                
+                # Используем replicate для размещения на фоне
+                replicate_client = get_replicate_client(api_key)
+                
+                default_prompt = """Add the product from @img2 to the image @img1. The product must levitate directly above the podium, barely touching the podium surface, with a visible contact shadow."""
+                
+                model_input = {
+                    "images": [BATCH_BACKGROUND_URI, processed_file_obj],
+                    "prompt": default_prompt,
+                    "aspect_ratio": "4:3"
+                }
+                
+                async with design_lock:
+                    # Добавляем задержку перед созданием дизайна для избежания rate limit (6 запросов в минуту)
+                    logger.info(f"    ⏳ Ожидание перед созданием дизайна (rate limit protection)...")
+                    await asyncio.sleep(11)
+                    
+                    design_output = await asyncio.to_thread(
+                        replicate_client.run,
+                        "prunaai/p-image-edit",
+                        input=model_input
+                    )
+                
+                # Без inline ссылку Replicate отдаем как есть - изображение не скачивается через сервер
+                if not inline:
+                    design_url = design_output[0] if isinstance(design_output, list) and design_output else design_output
+                    if isinstance(design_url, str):
+                        return {"name": f"{product_name}_design.png", "url": design_url, "size": None}
+                
+                design_bytes = None
+                if hasattr(design_output, 'read'):
+                    design_bytes = design_output.read()
+                elif isinstance(design_output, str):
+                    http_client = get_http_client()
+                    response = await http_client.get(design_output, timeout=60.0)
+                    if response.status_code == 200:
+                        design_bytes = response.content
+                elif isinstance(design_output, list) and len(design_output) > 0:
+                    first_item = design_output[0]
+                    if hasattr(first_item, 'read'):
+                        design_bytes = first_item.read()
+                    elif isinstance(first_item, str):
+                        http_client = get_http_client()
+                        response = await http_client.get(first_item, timeout=60.0)
+                        if response.status_code == 200:
+                            design_bytes = response.content
+                
+                if design_bytes:
+                    return {
+                        "name": f"{product_name}_design.png",
+                        **await batch_output(design_bytes, inline),
+                        "size": len(design_bytes)
+                    }
+            except Exception as e:
+                logger.warning(f"Failed to create design version for {product_name}: {str(e)}")
+            return None
+        
+        async def process_product_file(product_name: str, product_results: dict, idx: int, file_info: dict) -> Optional[dict]:
+            """Скачивание и удаление фона одного файла продукта (для первого файла запускается создание версии с дизайном)"""
+            async with file_semaphore:
+                # Скачиваем файл
+                file_url = file_info.get("url") or file_info.get("path")
+                headers = {
+                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+                    'Referer': 'https://disk.yandex.ru/'
+                }
+                # Если файл уже обрабатывался этой моделью - условный запрос, при 304 тело не скачивается
+                etag = DOWNLOAD_ETAGS.get(file_url)
+                cached_bytes = RESULT_CACHE.get(f"{file_url}#{etag}:{model}") if etag else None
+                if cached_bytes is not None:
+                    headers['If-None-Match'] = etag
+                file_response = await open_download_stream(file_url, headers=headers)
+                if file_response.status_code == 304:
+                    await file_response.aclose()
+                    logger.info(f"{file_info.get('name')} not modified, using cached result")
+                    processed_bytes = cached_bytes
+                else:
+                    if file_response.status_code != 200:
+                        await file_response.aclose()
+                        logger.warning(f"Failed to download {file_info.get('name')}: {file_response.status_code}")
+                        return None
+                    # Файл читается потоком с ограничением размера (слишком большие пропускаем)
+                    image_bytes = await read_download_limited(file_response, MAX_DOWNLOAD_BYTES)
+                    if image_bytes is None:
+                        logger.warning(f"Skipping {file_info.get('name')}: larger than {MAX_DOWNLOAD_BYTES} bytes")
+                        return None
+                    
+                    # Одинаковые изображения (в разных продуктах или повторных запусках) обрабатываем один раз
+                    cache_key = f"{hashlib.blake2b(image_bytes, digest_size=16).hexdigest()}:{model}"
+                    processed_bytes = RESULT_CACHE.get(cache_key)
+                    if processed_bytes is not None:
+                        logger.info(f"{file_info.get('name')}: using cached result for identical image")
+                    else:
+                        # Обрабатываем через удаление фона (одинаковые файлы пакета ждут одну задачу)
+                        task = model_tasks.get(cache_key)
+                        if task is None:
+                            task = model_tasks[cache_key] = asyncio.ensure_future(remove_background(image_bytes))
+                        processed_bytes = await task
+                        cache_result(cache_key, processed_bytes)
+                    
+                    etag = file_response.headers.get("etag")
+                    if etag:
+                        DOWNLOAD_ETAGS[file_url] = etag
+                        cache_result(f"{file_url}#{etag}:{model}", processed_bytes)
+            
+            # Для первой фотографии создаем версию с дизайном - отдельной задачей, не задерживая файлы
+            if idx == 0 and BATCH_BACKGROUND_BYTES:
+                design_tasks.append((product_results, asyncio.create_task(make_design(product_name, processed_bytes))))
+            
+            # Обработанное изображение
+            return {
+                "name": file_info.get("name", ""),
+                "processed_name": f"{product_name}_{idx + 1}_processed.png",
+                **await batch_output(processed_bytes, inline),
+                "size": len(processed_bytes)
+            }
+        
         results = []
-        processed_count = 0
-        total_count = len(files)
+        # Задачи по всем файлам всех продуктов и (продукт, файл) каждой задачи
+        tasks = []
+        task_targets = []
         
         # Обрабатываем каждый продукт
         for product_name, product_files in products.items():
-            # Сортируем файлы по имени для консистентности
-            product_files.sort(key=lambda x: x.get("name", ""))
-            
             product_results = {
                 "product_name": product_name,
                 "files": [],
                 "design_file": None
             }
+            results.append(product_results)
             
             # Обрабатываем каждое фото продукта
             for idx, file_info in enumerate(product_files):
-                try:
-                    # Скачиваем файл
-                    file_url = file_info.get("url") or file_info.get("path")
-                    async with httpx.AsyncClient() as client:
-                        headers = {
-                            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                            'Referer': 'https://disk.yandex.ru/'
-                        }
-                        file_response = await client.get(file_url, headers=headers, timeout=60.0, follow_redirects=True)
-                        if file_response.status_code != 200:
-                            logger.warning(f"Failed to download {file_info.get('name')}: {file_response.status_code}")
-                            continue
-                        image_bytes = file_response.content
-                    
-                    # Обрабатываем через удаление фона
-                    processed_bytes = await MODELS[model](image_bytes, api_key, None)
-                    
-                    processed_count += 1
-                    
-                    # Для первой фотографии создаем версию с дизайном
-                    if idx == 0:
-                        try:
-                            # Используем внутренний вызов place_on_background
-                            processed_file_obj = io.BytesIO(processed_bytes)
-                            processed_file_obj.name = "processed.png"
-                            
-                            # Получаем путь к фону
-                            background_paths = [
-                                "/app/background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg",
-                                os.path.expanduser("~/background_remover/background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg"),
-                                "./background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg",
-                                "background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg"
-                            ]
-                            
-                            background_path = None
-                            for path in background_paths:
-                                if os.path.exists(path):
-                                    background_path = path
-                                    break
-                            
-                            if background_path:
-                                with open(background_path, 'rb') as f:
-                                    background_bytes = f.read()
-                                
-                                background_file_obj = io.BytesIO(background_bytes)
-                                background_file_obj.name = "background.jpeg"
-                                
-                                # Используем replicate для размещения на фоне
-                                os.environ["REPLICATE_API_TOKEN"] = api_key
-                                
-                                default_prompt = """Add the product from @img2 to the image @img1. The product must levitate directly above the podium, barely touching the podium surface, with a visible contact shadow."""
-                                
-                                processed_file_obj.seek(0)
-                                background_file_obj.seek(0)
-                                
-                                model_input = {
-                                    "images": [background_file_obj, processed_file_obj],
-                                    "prompt": default_prompt,
-                                    "aspect_ratio": "4:3"
-                                }
-                                
-                                # Добавляем задержку перед созданием дизайна для избежания rate limit (6 запросов в минуту)
-                                logger.info(f"    ⏳ Ожидание перед созданием дизайна (rate limit protection)...")
-                                await asyncio.sleep(11)
-                                
-                                design_output = await asyncio.to_thread(
-                                    replicate.run,
-                                    "prunaai/p-image-edit",
-                                    input=model_input
-                                )
-                                
-                                design_bytes = None
-                                if hasattr(design_output, 'read'):
-                                    design_bytes = design_output.read()
-                                elif isinstance(design_output, str):
-                                    async with httpx.AsyncClient() as http_client:
-                                        response = await http_client.get(design_output, timeout=60.0)
-                                        if response.status_code == 200:
-                                            design_bytes = response.content
-                                elif isinstance(design_output, list) and len(design_output) > 0:
-                                    first_item = design_output[0]
-                                    if hasattr(first_item, 'read'):
-                                        design_bytes = first_item.read()
-                                    elif isinstance(first_item, str):
-                                        async with httpx.AsyncClient() as http_client:
-                                            response = await http_client.get(first_item, timeout=60.0)
-                                            if response.status_code == 200:
-                                                design_bytes = response.content
-                                
-                                if design_bytes:
-                                    product_results["design_file"] = {
-                                        "name": f"{product_name}_design.png",
-                                        "data": base64.b64encode(design_bytes).decode('utf-8'),
-                                        "size": len(design_bytes)
-                                    }
-                        except Exception as e:
-                            logger.warning(f"Failed to create design version for {product_name}: {str(e)}")
-                    
-                    # Сохраняем обработанное изображение
-                    product_results["files"].append({
-                        "name": file_info.get("name", ""),
-                        "processed_name": f"{product_name}_{idx + 1}_processed.png",
-                        "data": base64.b64encode(processed_bytes).decode('utf-8'),
-                        "size": len(processed_bytes)
-                    })
-                    
-                except Exception as e:
-                    logger.error(f"Error processing {file_info.get('name')}: {str(e)}")
-                    continue
-            
-            results.append(product_results)
+                tasks.append(process_product_file(product_name, product_results, idx, file_info))
+                task_targets.append((product_results, file_info))
         
-        return {
+        # Файлы обрабатываются параллельно, порядок результатов сохраняется
+        # Ошибка одного файла не останавливает остальные - исключения собираются и логируются здесь
+        try:
+            outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+            for (product_results, file_info), outcome in zip(task_targets, outcomes):
+                if isinstance(outcome, BaseException):
+                    logger.error(f"Error processing {file_info.get('name')}: {str(outcome)}")
+                elif outcome is not None:
+                    product_results["files"].append(outcome)
+            for product_results, design_task in design_tasks:
+                product_results["design_file"] = await design_task
+        finally:
+            # Запрос отменен (клиент отключился) - не оставляем платные вызовы (дизайн, удаление фона) работать на результат, который никто не прочитает
+            for _, design_task in design_tasks:
+                design_task.cancel()
+            for model_task in model_tasks.values():
+                model_task.cancel()
+        processed_count = sum(len(product_results["files"]) for product_results in results)
+        
+        # Ответ с base64 может быть очень большим - сразу в orjson, минуя обход jsonable_encoder
+        return ORJSONResponse({
             "success": True,
             "products_processed": len(results),
             "total_files_processed": processed_count,
             "results": results
-        }
+        })
         
     except HTTPException:
         raise
@@ -1802,7 +2476,17 @@ async def batch_process_products(
 
 async def send_progress_update(message: dict):
     """Helper function to format progress update as SSE"""
-    return f"data: {json_lib.dumps(message, ensure_ascii=False)}\n\n"
+    return f"data: {orjson.dumps(message).decode()}\n\n"
+
+# Паттерны ID папки в скриптах страницы Яндекс Диска
+FOLDER_ID_SCRIPT_PATTERNS = [
+    re.compile(r'"public_key"\s*:\s*"([^"]+)"'),
+    re.compile(r'"folderId"\s*:\s*"([^"]+)"'),
+    re.compile(r'"id"\s*:\s*"([^"]+)"'),
+    re.compile(r'/d/([a-zA-Z0-9_-]+)'),
+    re.compile(r'public_key["\']?\s*[:=]\s*["\']([^"\']+)["\']'),
+]
+FOLDER_ID_CANDIDATE_RE = re.compile(r'^[a-zA-Z0-9_-]+$')
 
 async def convert_yandex_url_to_d_format(url: str) -> str:
     """
@@ -1812,12 +2496,12 @@ async def convert_yandex_url_to_d_format(url: str) -> str:
     logger = logging.getLogger(__name__)
     
     # Если URL уже в формате /d/ID, возвращаем как есть
-    match = re.search(r'/d/([^/?]+)', url)
+    match = YANDEX_FOLDER_ID_RE.search(url)
     if match:
         return url
     
     # Проверяем формат /client/disk/...
-    match = re.search(r'/client/disk/([^/?]+)', url)
+    match = YANDEX_CLIENT_PATH_RE.search(url)
     if not match:
         raise HTTPException(
             status_code=400,
@@ -1828,87 +2512,67 @@ async def convert_yandex_url_to_d_format(url: str) -> str:
     
     try:
         # Парсим HTML страницы для извлечения ID папки
-        async with httpx.AsyncClient() as client:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7'
-            }
-            response = await client.get(
-                url,
-                headers=headers,
-                timeout=30.0,
-                follow_redirects=True
+        status_code, html = await fetch_public_page(url)
+        
+        if status_code != 200:
+            raise HTTPException(
+                status_code=status_code,
+                detail=f"Не удалось загрузить страницу Яндекс Диска: {status_code}"
             )
-            
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Не удалось загрузить страницу Яндекс Диска: {response.status_code}"
-                )
-            
-            html = response.text
-            soup = BeautifulSoup(html, 'html.parser')
-            
-            # Метод 1: Ищем ID в мета-тегах
-            meta_tags = soup.find_all('meta')
-            for meta in meta_tags:
-                property_attr = meta.get('property', '')
-                content = meta.get('content', '')
-                if 'yandex-disk' in property_attr.lower() or 'disk' in property_attr.lower():
-                    # Пробуем найти ID в content
-                    match = re.search(r'/d/([^/?]+)', content)
-                    if match:
-                        folder_id = match.group(1)
-                        converted_url = f"https://disk.yandex.ru/d/{folder_id}"
-                        logger.info(f"Found folder ID in meta tags: {folder_id}")
-                        return converted_url
-            
-            # Метод 2: Ищем ID в JavaScript коде (window.__INITIAL_STATE__ или подобное)
-            scripts = soup.find_all('script')
-            for script in scripts:
-                if not script.string:
-                    continue
-                
-                script_text = script.string
-                
-                # Ищем паттерны с ID папки
-                patterns = [
-                    r'"public_key"\s*:\s*"([^"]+)"',
-                    r'"folderId"\s*:\s*"([^"]+)"',
-                    r'"id"\s*:\s*"([^"]+)"',
-                    r'/d/([a-zA-Z0-9_-]+)',
-                    r'public_key["\']?\s*[:=]\s*["\']([^"\']+)["\']',
-                ]
-                
-                for pattern in patterns:
-                    matches = re.finditer(pattern, script_text)
-                    for match in matches:
-                        potential_id = match.group(1) if match.groups() else match.group(0)
-                        # Проверяем, что это похоже на ID (обычно содержит буквы, цифры, дефисы, подчеркивания)
-                        if re.match(r'^[a-zA-Z0-9_-]+$', potential_id) and len(potential_id) > 5:
-                            converted_url = f"https://disk.yandex.ru/d/{potential_id}"
-                            logger.info(f"Found folder ID in script: {potential_id}")
-                            return converted_url
-            
-            # Метод 3: Ищем ссылки на /d/ID в HTML
-            links = soup.find_all('a', href=True)
-            for link in links:
-                href = link.get('href', '')
-                match = re.search(r'/d/([^/?]+)', href)
+        
+        soup = BeautifulSoup(html, 'lxml')
+        
+        # Метод 1: Ищем ID в мета-тегах
+        meta_tags = soup.find_all('meta')
+        for meta in meta_tags:
+            property_attr = meta.get('property', '')
+            content = meta.get('content', '')
+            if 'yandex-disk' in property_attr.lower() or 'disk' in property_attr.lower():
+                # Пробуем найти ID в content
+                match = YANDEX_FOLDER_ID_RE.search(content)
                 if match:
                     folder_id = match.group(1)
                     converted_url = f"https://disk.yandex.ru/d/{folder_id}"
-                    logger.info(f"Found folder ID in link: {folder_id}")
+                    logger.info(f"Found folder ID in meta tags: {folder_id}")
                     return converted_url
-            
-            # Если не нашли ID, пробуем использовать оригинальный URL
-            # Но для пакетной обработки нужен именно ID, поэтому выбрасываем ошибку
-            raise HTTPException(
-                status_code=400,
-                detail="Не удалось извлечь ID папки из URL. Убедитесь, что папка публичная и доступна."
-            )
-            
+        
+        # Метод 2: Ищем ID в JavaScript коде (window.__INITIAL_STATE__ или подобное)
+        scripts = soup.find_all('script')
+        for script in scripts:
+            if not script.string:
+                continue
+            
+            script_text = script.string
+            
+            # Ищем паттерны с ID папки
+            for pattern in FOLDER_ID_SCRIPT_PATTERNS:
+                matches = pattern.finditer(script_text)
+                for match in matches:
+                    potential_id = match.group(1) if match.groups() else match.group(0)
+                    # Проверяем, что это похоже на ID (обычно содержит буквы, цифры, дефисы, подчеркивания)
+                    if FOLDER_ID_CANDIDATE_RE.match(potential_id) and len(potential_id) > 5:
+                        converted_url = f"https://disk.yandex.ru/d/{potential_id}"
+                        logger.info(f"Found folder ID in script: {potential_id}")
+                        return converted_url
+        
+        # Метод 3: Ищем ссылки на /d/ID в HTML
+        links = soup.find_all('a', href=True)
+        for link in links:
+            href = link.get('href', '')
+            match = YANDEX_FOLDER_ID_RE.search(href)
+            if match:
+                folder_id = match.group(1)
+                converted_url = f"https://disk.yandex.ru/d/{folder_id}"
+                logger.info(f"Found folder ID in link: {folder_id}")
+                return converted_url
+        
+        # Если не нашли ID, пробуем использовать оригинальный URL
+        # Но для пакетной обработки нужен именно ID, поэтому выбрасываем ошибку
+        raise HTTPException(
+            status_code=400,
+            detail="Не удалось извлечь ID папки из URL. Убедитесь, что папка публичная и доступна."
+        )
+        
     except HTTPException:
         raise
     except Exception as e:
@@ -1951,7 +2615,7 @@ async def batch_process_folders(
     try:
         # Получаем токен (из запроса или env variables)
         if not token:
-            token = os.getenv("YANDEX_DISK_TOKEN")
+            token = YANDEX_ENV_TOKEN
         
         if not token:
             logger.error("Yandex Disk token not found in request or environment variables")
@@ -1960,7 +2624,8 @@ async def batch_process_folders(
                 detail="Yandex Disk token not provided. Please authenticate via Yandex Disk OAuth or set YANDEX_DISK_TOKEN in Railway variables."
             )
         
-        logger.info(f"Using Yandex Disk token: {'from request' if token != os.getenv('YANDEX_DISK_TOKEN') else 'from env variables'}")
+        logger.info(f"Using Yandex Disk token: {'from request' if token != YANDEX_ENV_TOKEN else 'from env variables'}")
+        auth_headers = {"Authorization": f"OAuth {token}"}
         
         # Получаем API ключ
         api_key = get_api_key(model, apiKey)
@@ -1969,7 +2634,7 @@ async def batch_process_folders(
             logger.error(f"API key not found for model: {model}")
             logger.error(f"apiKey from request: {'provided' if apiKey else 'not provided'}")
             if model == "replicate":
-                env_key_exists = bool(os.getenv('REPLICATE_API_KEY'))
+                env_key_exists = bool(ENV_API_KEYS["replicate"])
                 logger.error(f"REPLICATE_API_KEY in env: {'exists' if env_key_exists else 'NOT FOUND - please set in Railway variables'}")
                 raise HTTPException(
                     status_code=400, 
@@ -1992,7 +2657,7 @@ async def batch_process_folders(
             logger.info(f"Detected public URL, extracting folder ID: {base_path}")
             
             # Извлекаем ID из URL формата https://disk.yandex.ru/d/ID
-            match = re.search(r'/d/([^/?]+)', base_path)
+            match = YANDEX_FOLDER_ID_RE.search(base_path)
             if match:
                 public_key = match.group(1)
                 use_public_api = True
@@ -2001,7 +2666,7 @@ async def batch_process_folders(
                 # Пробуем преобразовать URL формата /client/disk/... в формат /d/ID
                 try:
                     converted_url = await convert_yandex_url_to_d_format(base_path)
-                    match = re.search(r'/d/([^/?]+)', converted_url)
+                    match = YANDEX_FOLDER_ID_RE.search(converted_url)
                     if match:
                         public_key = match.group(1)
                         use_public_api = True
@@ -2023,105 +2688,105 @@ async def batch_process_folders(
         
         # Получаем информацию о выбранной папке и файлах в ней
         logger.info(f"Fetching files from Yandex Disk folder, path: {actual_path}, use_public_api: {use_public_api}")
-        async with httpx.AsyncClient() as client:
-            try:
-                if use_public_api:
-                    # Используем API для публичных папок
-                    response = await client.get(
-                        "https://cloud-api.yandex.net/v1/disk/public/resources",
-                        params={"public_key": public_key, "limit": 1000},
-                        headers={"Authorization": f"OAuth {token}"},
-                        timeout=30.0
-                    )
-                else:
-                    # Используем обычный API для приватных папок
-                    response = await client.get(
-                        "https://cloud-api.yandex.net/v1/disk/resources",
-                        params={"path": actual_path, "limit": 1000},
-                        headers={"Authorization": f"OAuth {token}"},
-                        timeout=30.0
-                    )
-                
-                logger.info(f"Yandex Disk API response status: {response.status_code}")
-                
-                if response.status_code != 200:
-                    try:
-                        error_json = response.json()
-                        error_text = str(error_json)
-                    except:
-                        error_text = response.text
-                    
-                    logger.error(f"Yandex Disk API error: {response.status_code}, response: {error_text}")
-                    
-                    if response.status_code == 401:
-                        raise HTTPException(
-                            status_code=401, 
-                            detail="Yandex Disk authentication failed. Token is invalid or expired. Please re-authenticate via OAuth or check YANDEX_DISK_TOKEN in Railway variables."
-                        )
-                    elif response.status_code == 403:
-                        raise HTTPException(
-                            status_code=403,
-                            detail="Access forbidden. Check if the token has proper permissions to access Yandex Disk."
-                        )
-                    elif response.status_code == 404:
-                        raise HTTPException(
-                            status_code=404,
-                            detail=f"Path not found: {base_path}. Please check if the path exists on Yandex Disk."
-                        )
-                    elif response.status_code == 405:
-                        raise HTTPException(
-                            status_code=405,
-                            detail="Method not allowed. This might indicate an issue with Yandex Disk API. Please check the token and try again."
-                        )
-                    else:
-                        raise HTTPException(
-                            status_code=response.status_code,
-                            detail=f"Yandex Disk API error ({response.status_code}): {error_text[:300]}"
-                        )
-            except httpx.RequestError as e:
-                logger.error(f"Request error when fetching folder: {str(e)}")
-                raise HTTPException(status_code=500, detail=f"Network error when accessing Yandex Disk: {str(e)}")
-            except HTTPException:
-                raise
-            except Exception as e:
-                logger.error(f"Unexpected error when fetching folder: {str(e)}", exc_info=True)
-                raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+        client = get_http_client()
+        try:
+            if use_public_api:
+                # Используем API для публичных папок
+                response = await client.get(
+                    "https://cloud-api.yandex.net/v1/disk/public/resources",
+                    params={"public_key": public_key, "limit": 1000},
+                    headers=auth_headers,
+                    timeout=30.0
+                )
+            else:
+                # Используем обычный API для приватных папок
+                response = await client.get(
+                    "https://cloud-api.yandex.net/v1/disk/resources",
+                    params={"path": actual_path, "limit": 1000},
+                    headers=auth_headers,
+                    timeout=30.0
+                )
             
-            data = response.json()
+            logger.info(f"Yandex Disk API response status: {response.status_code}")
             
-            # Получаем название папки
-            folder_name = data.get("name", "")
-            if not folder_name:
-                # Пытаемся извлечь из пути
-                if actual_path.startswith('/'):
-                    folder_name = actual_path.rstrip('/').split('/')[-1] or "Папка"
+            if response.status_code != 200:
+                try:
+                    error_json = orjson.loads(response.content)
+                    error_text = str(error_json)
+                except:
+                    error_text = response.text
+                
+                logger.error(f"Yandex Disk API error: {response.status_code}, response: {error_text}")
+                
+                if response.status_code == 401:
+                    raise HTTPException(
+                        status_code=401, 
+                        detail="Yandex Disk authentication failed. Token is invalid or expired. Please re-authenticate via OAuth or check YANDEX_DISK_TOKEN in Railway variables."
+                    )
+                elif response.status_code == 403:
+                    raise HTTPException(
+                        status_code=403,
+                        detail="Access forbidden. Check if the token has proper permissions to access Yandex Disk."
+                    )
+                elif response.status_code == 404:
+                    raise HTTPException(
+                        status_code=404,
+                        detail=f"Path not found: {base_path}. Please check if the path exists on Yandex Disk."
+                    )
+                elif response.status_code == 405:
+                    raise HTTPException(
+                        status_code=405,
+                        detail="Method not allowed. This might indicate an issue with Yandex Disk API. Please check the token and try again."
+                    )
                 else:
-                    folder_name = actual_path.split('/')[-1] or "Папка"
-            
-            folder_path = actual_path
-            
-            # Для публичных папок структура может быть немного другой
-            items = data.get("_embedded", {}).get("items", [])
-            if not items and use_public_api:
-                items = data.get("items", [])
-            
-            # Разделяем на подпапки и файлы
-            subfolders = [
-                item for item in items
-                if item.get("type") == "dir"
-            ]
-            
-            # Получаем файлы (изображения) напрямую в папке
-            files = [
-                item for item in items
-                if item.get("type") == "file" and item.get("mime_type", "").startswith("image/")
-            ]
-            
-            # Сортируем файлы по имени
-            files.sort(key=lambda x: x.get("name", ""))
-            
-            # Сортируем подпапки по имени
-            subfolders.sort(key=lambda x: x.get("name", ""))
+                    raise HTTPException(
+                        status_code=response.status_code,
+                        detail=f"Yandex Disk API error ({response.status_code}): {error_text[:300]}"
+                    )
+        except httpx.RequestError as e:
+            logger.error(f"Request error when fetching folder: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Network error when accessing Yandex Disk: {str(e)}")
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error when fetching folder: {str(e)}", exc_info=True)
+            raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+        
+        data = orjson.loads(response.content)
+        
+        # Получаем название папки
+        folder_name = data.get("name", "")
+        if not folder_name:
+            # Пытаемся извлечь из пути
+            if actual_path.startswith('/'):
+                folder_name = actual_path.rstrip('/').split('/')[-1] or "Папка"
+            else:
+                folder_name = actual_path.split('/')[-1] or "Папка"
+        
+        folder_path = actual_path
+        
+        # Для публичных папок структура может быть немного другой
+        items = data.get("_embedded", {}).get("items", [])
+        if not items and use_public_api:
+            items = data.get("items", [])
+        
+        # Разделяем на подпапки и файлы
+        subfolders = [
+            item for item in items
+            if item.get("type") == "dir"
+        ]
+        
+        # Получаем файлы (изображения) напрямую в папке
+        files = [
+            item for item in items
+            if item.get("type") == "file" and item.get("mime_type", "").startswith("image/")
+        ]
+        
+        # Сортируем файлы по имени
+        files.sort(key=lambda x: x.get("name", ""))
+        
+        # Сортируем подпапки по имени
+        subfolders.sort(key=lambda x: x.get("name", ""))
         
         logger.info(f"Found {len(subfolders)} subfolders and {len(files)} image files in folder '{folder_name}'")
         cost_logger.info(f"=== Начало обработки папки '{folder_name}' ===")
@@ -2139,14 +2804,14 @@ async def batch_process_folders(
             main_output_path = f"{folder_path}/{output_folder_name}"
         
         # Создаем папку для результатов
-        async with httpx.AsyncClient() as client:
-            create_response = await client.put(
-                "https://cloud-api.yandex.net/v1/disk/resources",
-                params={"path": main_output_path},
-                headers={"Authorization": f"OAuth {token}"},
-                timeout=30.0
-            )
-            # Игнорируем ошибку если папка уже существует
+        client = get_http_client()
+        create_response = await client.put(
+            "https://cloud-api.yandex.net/v1/disk/resources",
+            params={"path": main_output_path},
+            headers=auth_headers,
+            timeout=30.0
+        )
+        # Игнорируем ошибку если папка уже существует
         
         # Создаем async generator для streaming response
         async def generate_progress():
@@ -2173,46 +2838,46 @@ async def batch_process_folders(
                 
                 count = 0
                 try:
-                    async with httpx.AsyncClient() as client:
-                        if use_public_api:
-                            response = await client.get(
-                                "https://cloud-api.yandex.net/v1/disk/public/resources",
-                                params={"public_key": public_key, "path": path, "limit": 1000},
-                                headers={"Authorization": f"OAuth {token}"},
-                                timeout=30.0
-                            )
-                        else:
-                            response = await client.get(
-                                "https://cloud-api.yandex.net/v1/disk/resources",
-                                params={"path": path, "limit": 1000},
-                                headers={"Authorization": f"OAuth {token}"},
-                                timeout=30.0
-                            )
-                        
-                        if response.status_code != 200:
-                            return 0
-                        
-                        data = response.json()
-                        items = data.get("_embedded", {}).get("items", [])
-                        if not items and use_public_api:
-                            items = data.get("items", [])
-                        
-                        # Считаем файлы в текущей папке
-                        current_files = [
-                            item for item in items
-                            if item.get("type") == "file" and item.get("mime_type", "").startswith("image/")
-                        ]
-                        count += len(current_files)
-                        
-                        # Рекурсивно считаем файлы в подпапках (кроме "Обработанный")
-                        subfolders = [
-                            item for item in items
-                            if item.get("type") == "dir" and item.get("name") != "Обработанный"
-                        ]
-                        
-                        for subfolder in subfolders:
-                            subfolder_path = subfolder.get("path", "")
-                            count += await count_files_recursive(subfolder_path, depth + 1, max_depth)
+                    client = get_http_client()
+                    if use_public_api:
+                        response = await client.get(
+                            "https://cloud-api.yandex.net/v1/disk/public/resources",
+                            params={"public_key": public_key, "path": path, "limit": 1000},
+                            headers=auth_headers,
+                            timeout=30.0
+                        )
+                    else:
+                        response = await client.get(
+                            "https://cloud-api.yandex.net/v1/disk/resources",
+                            params={"path": path, "limit": 1000},
+                            headers=auth_headers,
+                            timeout=30.0
+                        )
+                    
+                    if response.status_code != 200:
+                        return 0
+                    
+                    data = orjson.loads(response.content)
+                    items = data.get("_embedded", {}).get("items", [])
+                    if not items and use_public_api:
+                        items = data.get("items", [])
+                    
+                    # Считаем файлы в текущей папке
+                    current_files = [
+                        item for item in items
+                        if item.get("type") == "file" and item.get("mime_type", "").startswith("image/")
+                    ]
+                    count += len(current_files)
+                    
+                    # Рекурсивно считаем файлы в подпапках (кроме "Обработанный")
+                    subfolders = [
+                        item for item in items
+                        if item.get("type") == "dir" and item.get("name") != "Обработанный"
+                    ]
+                    
+                    for subfolder in subfolders:
+                        subfolder_path = subfolder.get("path", "")
+                        count += await count_files_recursive(subfolder_path, depth + 1, max_depth)
                 
                 except:
                     pass  # Игнорируем ошибки при подсчете
@@ -2247,41 +2912,20 @@ async def batch_process_folders(
                                              design_count: list, results: dict):
                 """Создает дизайн для обработанного файла"""
                 try:
-                    # Получаем путь к фону
-                    background_paths = [
-                        "/app/background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg",
-                        os.path.expanduser("~/background_remover/background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg"),
-                        "./background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg",
-                        "background/ФМГ_Авито_Универсальная_Обложка_Без_Товара.jpeg"
-                    ]
-                    
-                    background_path = None
-                    for path in background_paths:
-                        if os.path.exists(path):
-                            background_path = path
-                            break
-                    
-                    if not background_path:
+                    # Фон прочитан один раз при старте
+                    if not BATCH_BACKGROUND_BYTES:
                         logger.warning(f"    Фон не найден, пропускаем создание дизайна")
                         return
                     
-                    with open(background_path, 'rb') as f:
-                        background_bytes = f.read()
-                    
                     processed_file_obj = io.BytesIO(processed_bytes)
                     processed_file_obj.name = "processed.png"
-                    background_file_obj = io.BytesIO(background_bytes)
-                    background_file_obj.name = "background.jpeg"
                     
-                    os.environ["REPLICATE_API_TOKEN"] = api_key
+                    replicate_client = get_replicate_client(api_key)
                     
                     default_prompt = """Add the product from @img2 to the image @img1. The product must levitate directly above the podium, barely touching the podium surface, with a visible contact shadow."""
                     
-                    processed_file_obj.seek(0)
-                    background_file_obj.seek(0)
-                    
                     model_input = {
-                        "images": [background_file_obj, processed_file_obj],
+                        "images": [BATCH_BACKGROUND_URI, processed_file_obj],
                         "prompt": default_prompt,
                         "aspect_ratio": "4:3"
                     }
@@ -2299,7 +2943,7 @@ async def batch_process_folders(
                     await asyncio.sleep(11)
                     
                     design_output = await asyncio.to_thread(
-                        replicate.run,
+                        replicate_client.run,
                         "prunaai/p-image-edit",
                         input=model_input
                     )
@@ -2310,19 +2954,19 @@ async def batch_process_folders(
                     if hasattr(design_output, 'read'):
                         design_bytes = design_output.read()
                     elif isinstance(design_output, str):
-                        async with httpx.AsyncClient() as http_client:
-                            response = await http_client.get(design_output, timeout=60.0)
-                            if response.status_code == 200:
-                                design_bytes = response.content
+                        http_client = get_http_client()
+                        response = await http_client.get(design_output, timeout=60.0)
+                        if response.status_code == 200:
+                            design_bytes = response.content
                     elif isinstance(design_output, list) and len(design_output) > 0:
                         first_item = design_output[0]
                         if hasattr(first_item, 'read'):
                             design_bytes = first_item.read()
                         elif isinstance(first_item, str):
-                            async with httpx.AsyncClient() as http_client:
-                                response = await http_client.get(first_item, timeout=60.0)
-                                if response.status_code == 200:
-                                    design_bytes = response.content
+                            http_client = get_http_client()
+                            response = await http_client.get(first_item, timeout=60.0)
+                            if response.status_code == 200:
+                                design_bytes = response.content
                     
                     if design_bytes:
                         # Сохраняем дизайн на Yandex Disk в ту же папку
@@ -2332,24 +2976,24 @@ async def batch_process_folders(
                         # Проверяем, существует ли дизайн уже
                         design_already_exists = False
                         try:
-                            async with httpx.AsyncClient() as check_design_client:
-                                if use_public_api:
-                                    check_design_response = await check_design_client.get(
-                                        "https://cloud-api.yandex.net/v1/disk/public/resources",
-                                        params={"public_key": public_key, "path": design_save_path},
-                                        headers={"Authorization": f"OAuth {token}"},
-                                        timeout=30.0
-                                    )
-                                else:
-                                    check_design_response = await check_design_client.get(
-                                        "https://cloud-api.yandex.net/v1/disk/resources",
-                                        params={"path": design_save_path},
-                                        headers={"Authorization": f"OAuth {token}"},
-                                        timeout=30.0
-                                    )
-                                
-                                if check_design_response.status_code == 200:
-                                    design_already_exists = True
+                            check_design_client = get_http_client()
+                            if use_public_api:
+                                check_design_response = await check_design_client.get(
+                                    "https://cloud-api.yandex.net/v1/disk/public/resources",
+                                    params={"public_key": public_key, "path": design_save_path},
+                                    headers=auth_headers,
+                                    timeout=30.0
+                                )
+                            else:
+                                check_design_response = await check_design_client.get(
+                                    "https://cloud-api.yandex.net/v1/disk/resources",
+                                    params={"path": design_save_path},
+                                    headers=auth_headers,
+                                    timeout=30.0
+                                )
+                            
+                            if check_design_response.status_code == 200:
+                                design_already_exists = True
                         except:
                             pass  # Если проверка не удалась, продолжаем создание
                         
@@ -2363,34 +3007,34 @@ async def batch_process_folders(
                                 "message": f"⏭ Дизайн уже существует, пропущен: {design_name}"
                             })
                         else:
-                            async with httpx.AsyncClient() as design_client:
-                                upload_link_response = await design_client.get(
-                                    "https://cloud-api.yandex.net/v1/disk/resources/upload",
-                                    params={"path": design_save_path, "overwrite": "false"},
-                                    headers={"Authorization": f"OAuth {token}"},
-                                    timeout=30.0
+                            design_client = get_http_client()
+                            upload_link_response = await design_client.get(
+                                "https://cloud-api.yandex.net/v1/disk/resources/upload",
+                                params={"path": design_save_path, "overwrite": "false"},
+                                headers=auth_headers,
+                                timeout=30.0
+                            )
+                            
+                            if upload_link_response.status_code == 200:
+                                upload_url = orjson.loads(upload_link_response.content)["href"]
+                                upload_response = await design_client.put(
+                                    upload_url,
+                                    content=design_bytes,
+                                    headers={"Content-Type": "image/png"},
+                                    timeout=60.0
                                 )
                                 
-                                if upload_link_response.status_code == 200:
-                                    upload_url = upload_link_response.json()["href"]
-                                    upload_response = await design_client.put(
-                                        upload_url,
-                                        content=design_bytes,
-                                        headers={"Content-Type": "image/png"},
-                                        timeout=60.0
-                                    )
+                                if upload_response.status_code in [201, 202]:
+                                    results["design_created"] = True
+                                    logger.info(f"    Saved design: {design_name}")
                                     
-                                    if upload_response.status_code in [201, 202]:
-                                        results["design_created"] = True
-                                        logger.info(f"    Saved design: {design_name}")
-                                        
-                                        yield await send_progress_update({
-                                            "type": "design_complete",
-                                            "folder_name": folder_name,
-                                            "file_name": file_name,
-                                            "design_name": design_name,
-                                            "message": f"✓ Дизайн создан и сохранен: {design_name}"
-                                        })
+                                    yield await send_progress_update({
+                                        "type": "design_complete",
+                                        "folder_name": folder_name,
+                                        "file_name": file_name,
+                                        "design_name": design_name,
+                                        "message": f"✓ Дизайн создан и сохранен: {design_name}"
+                                    })
                 except Exception as e:
                     logger.warning(f"    Failed to create design for {file_name}: {str(e)}")
                     results["errors"].append(f"Design creation failed: {str(e)}")
@@ -2409,430 +3053,406 @@ async def batch_process_folders(
                 
                 try:
                     # Получаем содержимое текущей папки
-                    async with httpx.AsyncClient() as client:
-                        if use_public_api:
-                            response = await client.get(
-                                "https://cloud-api.yandex.net/v1/disk/public/resources",
-                                params={"public_key": public_key, "path": current_path, "limit": 1000},
-                                headers={"Authorization": f"OAuth {token}"},
-                                timeout=30.0
-                            )
+                    client = get_http_client()
+                    if use_public_api:
+                        response = await client.get(
+                            "https://cloud-api.yandex.net/v1/disk/public/resources",
+                            params={"public_key": public_key, "path": current_path, "limit": 1000},
+                            headers=auth_headers,
+                            timeout=30.0
+                        )
+                    else:
+                        response = await client.get(
+                            "https://cloud-api.yandex.net/v1/disk/resources",
+                            params={"path": current_path, "limit": 1000},
+                            headers=auth_headers,
+                            timeout=30.0
+                        )
+                    
+                    if response.status_code != 200:
+                        logger.warning(f"Failed to fetch from {current_path}: {response.status_code}")
+                        return
+                    
+                    data = orjson.loads(response.content)
+                    items = data.get("_embedded", {}).get("items", [])
+                    if not items and use_public_api:
+                        items = data.get("items", [])
+                    
+                    # Разделяем на файлы и подпапки
+                    current_files = [
+                        item for item in items
+                        if item.get("type") == "file" and item.get("mime_type", "").startswith("image/")
+                    ]
+                    current_subfolders = [
+                        item for item in items
+                        if item.get("type") == "dir" and item.get("name") != "Обработанный"
+                    ]
+                    
+                    current_files.sort(key=lambda x: x.get("name", ""))
+                    current_subfolders.sort(key=lambda x: x.get("name", ""))
+                    
+                    # Если есть файлы, обрабатываем их
+                    if current_files:
+                        # Определяем путь для сохранения результатов
+                        output_path = f"{current_path}/Обработанный"
+                        
+                        # Проверяем существующие файлы в папке "Обработанный"
+                        existing_files = set()
+                        design_exists = False
+                        try:
+                            check_client = get_http_client()
+                            if use_public_api:
+                                check_response = await check_client.get(
+                                    "https://cloud-api.yandex.net/v1/disk/public/resources",
+                                    params={"public_key": public_key, "path": output_path, "limit": 1000},
+                                    headers=auth_headers,
+                                    timeout=30.0
+                                )
+                            else:
+                                check_response = await check_client.get(
+                                    "https://cloud-api.yandex.net/v1/disk/resources",
+                                    params={"path": output_path, "limit": 1000},
+                                    headers=auth_headers,
+                                    timeout=30.0
+                                )
+                            
+                            if check_response.status_code == 200:
+                                check_data = orjson.loads(check_response.content)
+                                check_items = check_data.get("_embedded", {}).get("items", [])
+                                if not check_items and use_public_api:
+                                    check_items = check_data.get("items", [])
+                                
+                                for item in check_items:
+                                    if item.get("type") == "file":
+                                        file_name = item.get("name", "")
+                                        existing_files.add(file_name)
+                                        # Проверяем наличие дизайна (файл с суффиксом _design.png)
+                                        if file_name.endswith("_design.png"):
+                                            design_exists = True
+                        except:
+                            pass  # Если папка не существует, это нормально
+                        
+                        # Фильтруем файлы - пропускаем уже обработанные
+                        files_to_process = []
+                        for file_info in current_files:
+                            file_name = file_info.get("name", "")
+                            save_name = f"{file_name.rsplit('.', 1)[0]}_processed.png"
+                            if save_name not in existing_files:
+                                files_to_process.append(file_info)
+                        
+                        # Если нет файлов для обработки, проверяем наличие дизайна
+                        if not files_to_process:
+                            logger.info(f"  Все файлы в {current_name} уже обработаны, пропускаем")
+                            # Если дизайна нет, нужно его создать из первого обработанного файла
+                            if not design_exists and current_files:
+                                # Находим первый обработанный файл для создания дизайна
+                                first_file = current_files[0]
+                                first_file_name = first_file.get("name", "")
+                                processed_file_name = f"{first_file_name.rsplit('.', 1)[0]}_processed.png"
+                                
+                                # Проверяем, что обработанный файл существует
+                                if processed_file_name in existing_files:
+                                            # Скачиваем обработанный файл для создания дизайна
+                                            try:
+                                                download_client = get_http_client()
+                                                if use_public_api:
+                                                    processed_file_path = f"{output_path}/{processed_file_name}"
+                                                    link_response = await download_client.get(
+                                                        "https://cloud-api.yandex.net/v1/disk/public/resources/download",
+                                                        params={"public_key": public_key, "path": processed_file_path},
+                                                        headers=auth_headers,
+                                                        timeout=30.0
+                                                    )
+                                                else:
+                                                    link_response = await download_client.get(
+                                                        "https://cloud-api.yandex.net/v1/disk/resources/download",
+                                                        params={"path": f"{output_path}/{processed_file_name}"},
+                                                        headers=auth_headers,
+                                                        timeout=30.0
+                                                    )
+                                                
+                                                if link_response.status_code == 200:
+                                                    download_url = orjson.loads(link_response.content)["href"]
+                                                    file_response = await send_following_redirects(download_client, download_client.build_request("GET", download_url, timeout=60.0))
+                                                    
+                                                    if file_response.status_code == 200:
+                                                        processed_bytes = file_response.content
+                                                        
+                                                        # Создаем дизайн
+                                                        async for update in create_design_generator(
+                                                            processed_bytes, first_file_name, current_name, output_path,
+                                                            token, use_public_api, public_key, api_key, design_count, results
+                                                        ):
+                                                            yield update
+                                            except Exception as e:
+                                                logger.warning(f"    Не удалось создать дизайн для {current_name}: {str(e)}")
+                            # Продолжаем обработку подпапок
                         else:
-                            response = await client.get(
+                            # Создаем папку для результатов только если есть файлы для обработки
+                            create_client = get_http_client()
+                            create_response = await create_client.put(
                                 "https://cloud-api.yandex.net/v1/disk/resources",
-                                params={"path": current_path, "limit": 1000},
-                                headers={"Authorization": f"OAuth {token}"},
+                                params={"path": output_path},
+                                headers=auth_headers,
                                 timeout=30.0
                             )
-                        
-                        if response.status_code != 200:
-                            logger.warning(f"Failed to fetch from {current_path}: {response.status_code}")
-                            return
-                        
-                        data = response.json()
-                        items = data.get("_embedded", {}).get("items", [])
-                        if not items and use_public_api:
-                            items = data.get("items", [])
-                        
-                        # Разделяем на файлы и подпапки
-                        current_files = [
-                            item for item in items
-                            if item.get("type") == "file" and item.get("mime_type", "").startswith("image/")
-                        ]
-                        current_subfolders = [
-                            item for item in items
-                            if item.get("type") == "dir" and item.get("name") != "Обработанный"
-                        ]
-                        
-                        current_files.sort(key=lambda x: x.get("name", ""))
-                        current_subfolders.sort(key=lambda x: x.get("name", ""))
-                        
-                        # Если есть файлы, обрабатываем их
-                        if current_files:
-                            # Определяем путь для сохранения результатов
-                            output_path = f"{current_path}/Обработанный"
                             
-                            # Проверяем существующие файлы в папке "Обработанный"
-                            existing_files = set()
-                            design_exists = False
-                            try:
-                                async with httpx.AsyncClient() as check_client:
-                                    if use_public_api:
-                                        check_response = await check_client.get(
-                                            "https://cloud-api.yandex.net/v1/disk/public/resources",
-                                            params={"public_key": public_key, "path": output_path, "limit": 1000},
-                                            headers={"Authorization": f"OAuth {token}"},
+                            # Обрабатываем только файлы, которые еще не обработаны
+                            for file_idx, file_info in enumerate(files_to_process):
+                                try:
+                                    file_name = file_info.get("name", "")
+                                    file_path = file_info.get("path", "")
+                                    
+                                    logger.info(f"  Processing file {file_idx + 1}/{len(files_to_process)} from {current_name}: {file_name}")
+                                    
+                                    # Отправляем информацию о начале обработки файла
+                                    yield await send_progress_update({
+                                        "type": "file_start",
+                                        "folder_name": current_name,
+                                        "file_index": file_idx + 1,
+                                        "total_files": len(files_to_process),
+                                        "file_name": file_name,
+                                        "message": f"Обработка файла {file_idx + 1}/{len(files_to_process)} из '{current_name}': {file_name}"
+                                    })
+                                    
+                                    # Скачиваем файл
+                                    file_is_public = use_public_api
+                                    
+                                    download_client = get_http_client()
+                                    if file_is_public:
+                                        # Для публичных файлов используем другой endpoint
+                                        public_file_path = f"{current_path}/{file_name}" if current_path else file_name
+                                        link_response = await download_client.get(
+                                            "https://cloud-api.yandex.net/v1/disk/public/resources/download",
+                                            params={"public_key": public_key, "path": public_file_path},
+                                            headers=auth_headers,
                                             timeout=30.0
                                         )
                                     else:
-                                        check_response = await check_client.get(
-                                            "https://cloud-api.yandex.net/v1/disk/resources",
-                                            params={"path": output_path, "limit": 1000},
-                                            headers={"Authorization": f"OAuth {token}"},
+                                        # Для приватных файлов используем обычный endpoint
+                                        link_response = await download_client.get(
+                                            "https://cloud-api.yandex.net/v1/disk/resources/download",
+                                            params={"path": file_path},
+                                            headers=auth_headers,
                                             timeout=30.0
                                         )
                                     
-                                    if check_response.status_code == 200:
-                                        check_data = check_response.json()
-                                        check_items = check_data.get("_embedded", {}).get("items", [])
-                                        if not check_items and use_public_api:
-                                            check_items = check_data.get("items", [])
-                                        
-                                        for item in check_items:
-                                            if item.get("type") == "file":
-                                                file_name = item.get("name", "")
-                                                existing_files.add(file_name)
-                                                # Проверяем наличие дизайна (файл с суффиксом _design.png)
-                                                if file_name.endswith("_design.png"):
-                                                    design_exists = True
-                            except:
-                                pass  # Если папка не существует, это нормально
-                            
-                            # Фильтруем файлы - пропускаем уже обработанные
-                            files_to_process = []
-                            for file_info in current_files:
-                                file_name = file_info.get("name", "")
-                                save_name = f"{file_name.rsplit('.', 1)[0]}_processed.png"
-                                if save_name not in existing_files:
-                                    files_to_process.append(file_info)
-                            
-                            # Если нет файлов для обработки, проверяем наличие дизайна
-                            if not files_to_process:
-                                logger.info(f"  Все файлы в {current_name} уже обработаны, пропускаем")
-                                # Если дизайна нет, нужно его создать из первого обработанного файла
-                                if not design_exists and current_files:
-                                    # Находим первый обработанный файл для создания дизайна
-                                    first_file = current_files[0]
-                                    first_file_name = first_file.get("name", "")
-                                    processed_file_name = f"{first_file_name.rsplit('.', 1)[0]}_processed.png"
+                                    if link_response.status_code != 200:
+                                        raise Exception(f"Failed to get download link: {link_response.status_code}")
                                     
-                                    # Проверяем, что обработанный файл существует
-                                    if processed_file_name in existing_files:
-                                                # Скачиваем обработанный файл для создания дизайна
-                                                try:
-                                                    async with httpx.AsyncClient() as download_client:
-                                                        if use_public_api:
-                                                            processed_file_path = f"{output_path}/{processed_file_name}"
-                                                            link_response = await download_client.get(
-                                                                "https://cloud-api.yandex.net/v1/disk/public/resources/download",
-                                                                params={"public_key": public_key, "path": processed_file_path},
-                                                                headers={"Authorization": f"OAuth {token}"},
-                                                                timeout=30.0
-                                                            )
-                                                        else:
-                                                            link_response = await download_client.get(
-                                                                "https://cloud-api.yandex.net/v1/disk/resources/download",
-                                                                params={"path": f"{output_path}/{processed_file_name}"},
-                                                                headers={"Authorization": f"OAuth {token}"},
-                                                                timeout=30.0
-                                                            )
-                                                        
-                                                        if link_response.status_code == 200:
-                                                            download_url = link_response.json()["href"]
-                                                            file_response = await download_client.get(download_url, timeout=60.0, follow_redirects=True)
-                                                            
-                                                            if file_response.status_code == 200:
-                                                                processed_bytes = file_response.content
-                                                                
-                                                                # Создаем дизайн
-                                                                async for update in create_design_generator(
-                                                                    processed_bytes, first_file_name, current_name, output_path,
-                                                                    token, use_public_api, public_key, api_key, design_count, results
-                                                                ):
-                                                                    yield update
-                                                except Exception as e:
-                                                    logger.warning(f"    Не удалось создать дизайн для {current_name}: {str(e)}")
-                                # Продолжаем обработку подпапок
-                            else:
-                                # Создаем папку для результатов только если есть файлы для обработки
-                                async with httpx.AsyncClient() as create_client:
-                                    create_response = await create_client.put(
-                                        "https://cloud-api.yandex.net/v1/disk/resources",
-                                        params={"path": output_path},
-                                        headers={"Authorization": f"OAuth {token}"},
-                                        timeout=30.0
-                                    )
-                                
-                                # Обрабатываем только файлы, которые еще не обработаны
-                                for file_idx, file_info in enumerate(files_to_process):
-                                    try:
-                                        file_name = file_info.get("name", "")
-                                        file_path = file_info.get("path", "")
-                                        
-                                        logger.info(f"  Processing file {file_idx + 1}/{len(files_to_process)} from {current_name}: {file_name}")
-                                        
-                                        # Отправляем информацию о начале обработки файла
-                                        yield await send_progress_update({
-                                            "type": "file_start",
-                                            "folder_name": current_name,
-                                            "file_index": file_idx + 1,
-                                            "total_files": len(files_to_process),
-                                            "file_name": file_name,
-                                            "message": f"Обработка файла {file_idx + 1}/{len(files_to_process)} из '{current_name}': {file_name}"
-                                        })
-                                        
-                                        # Скачиваем файл
-                                        file_is_public = use_public_api
-                                        
-                                        async with httpx.AsyncClient() as download_client:
-                                            if file_is_public:
-                                                # Для публичных файлов используем другой endpoint
-                                                public_file_path = f"{current_path}/{file_name}" if current_path else file_name
-                                                link_response = await download_client.get(
-                                                    "https://cloud-api.yandex.net/v1/disk/public/resources/download",
-                                                    params={"public_key": public_key, "path": public_file_path},
-                                                    headers={"Authorization": f"OAuth {token}"},
-                                                    timeout=30.0
-                                                )
-                                            else:
-                                                # Для приватных файлов используем обычный endpoint
-                                                link_response = await download_client.get(
-                                                    "https://cloud-api.yandex.net/v1/disk/resources/download",
-                                                    params={"path": file_path},
-                                                    headers={"Authorization": f"OAuth {token}"},
-                                                    timeout=30.0
-                                                )
-                                            
-                                            if link_response.status_code != 200:
-                                                raise Exception(f"Failed to get download link: {link_response.status_code}")
-                                            
-                                            download_url = link_response.json()["href"]
-                                            file_response = await download_client.get(download_url, timeout=60.0, follow_redirects=True)
-                                            
-                                            if file_response.status_code != 200:
-                                                raise Exception(f"Failed to download file: {file_response.status_code}")
-                                            
-                                            image_bytes = file_response.content
-                                        
-                                        # Обрабатываем через удаление фона
+                                    download_url = orjson.loads(link_response.content)["href"]
+                                    file_response = await send_following_redirects(download_client, download_client.build_request("GET", download_url, timeout=60.0))
+                                    
+                                    if file_response.status_code != 200:
+                                        raise Exception(f"Failed to download file: {file_response.status_code}")
+                                    
+                                    image_bytes = file_response.content
+                                    
+                                    # Обрабатываем через удаление фона
+                                    yield await send_progress_update({
+                                        "type": "processing",
+                                        "folder_name": current_name,
+                                        "file_name": file_name,
+                                        "step": "background_removal",
+                                        "message": f"Удаление фона: {file_name}"
+                                    })
+                                    
+                                    # Добавляем задержку между запросами для избежания rate limiting
+                                    if file_idx > 0:
+                                        delay_seconds = 11
+                                        await asyncio.sleep(delay_seconds)
+                                    
+                                    async with MODEL_SEMAPHORES[model]:
+                                        processed_bytes = await MODELS[model](image_bytes, api_key, None)
+                                    bg_count[0] += 1
+                                    background_removal_count = bg_count[0]
+                                    
+                                    # Размещаем на белом фоне с заданным размером (PIL - в потоке, не блокируя event loop)
+                                    template_width = max(100, min(5000, width))
+                                    template_height = max(100, min(5000, height))
+                                    white_bg_bytes = await asyncio.to_thread(compose_template, processed_bytes, template_width, template_height)
+                                    
+                                    # Сохраняем на Yandex Disk
+                                    save_name = f"{file_name.rsplit('.', 1)[0]}_processed.png"
+                                    save_path = f"{output_path}/{save_name}"
+                                    
+                                    # Проверяем, существует ли файл уже
+                                    if save_name in existing_files:
+                                        logger.info(f"    ⏭ Пропущен (уже существует): {save_name}")
                                         yield await send_progress_update({
-                                            "type": "processing",
+                                            "type": "file_complete",
                                             "folder_name": current_name,
                                             "file_name": file_name,
-                                            "step": "background_removal",
-                                            "message": f"Удаление фона: {file_name}"
+                                            "saved_name": save_name,
+                                            "message": f"⏭ Файл уже существует, пропущен: {save_name}"
                                         })
+                                        continue
+                                    
+                                    yield await send_progress_update({
+                                        "type": "saving",
+                                        "folder_name": current_name,
+                                        "file_name": file_name,
+                                        "saved_name": save_name,
+                                        "save_path": save_path,
+                                        "message": f"Сохранение: {save_name}"
+                                    })
+                                    
+                                    try:
+                                        upload_client = get_http_client()
+                                        upload_link_response = await upload_client.get(
+                                            "https://cloud-api.yandex.net/v1/disk/resources/upload",
+                                            params={"path": save_path, "overwrite": "false"},
+                                            headers=auth_headers,
+                                            timeout=30.0
+                                        )
                                         
-                                        # Добавляем задержку между запросами для избежания rate limiting
-                                        if file_idx > 0:
-                                            delay_seconds = 11
-                                            await asyncio.sleep(delay_seconds)
-                                        
-                                        processed_bytes = await MODELS[model](image_bytes, api_key, None)
-                                        bg_count[0] += 1
-                                        background_removal_count = bg_count[0]
-                                        
-                                        # Размещаем на белом фоне с заданным размером
-                                        processed_img = Image.open(io.BytesIO(processed_bytes))
-                                        template_width = max(100, min(5000, width))
-                                        template_height = max(100, min(5000, height))
-                                        template_img = Image.new("RGB", (template_width, template_height), "white")
-                                        
-                                        img_width, img_height = processed_img.size
-                                        scale_width = template_width / img_width
-                                        scale_height = template_height / img_height
-                                        scale = min(scale_width, scale_height)
-                                        
-                                        new_width = int(img_width * scale)
-                                        new_height = int(img_height * scale)
-                                        processed_img = processed_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                                        
-                                        x = (template_width - new_width) // 2
-                                        y = (template_height - new_height) // 2
-                                        
-                                        result = template_img.copy()
-                                        if processed_img.mode == "RGBA":
-                                            result.paste(processed_img, (x, y), processed_img)
-                                        else:
-                                            result.paste(processed_img, (x, y))
+                                        if upload_link_response.status_code != 200:
+                                            error_text = upload_link_response.text
+                                            logger.error(f"    Failed to get upload link for {save_path}: {upload_link_response.status_code} - {error_text}")
+                                            raise Exception(f"Failed to get upload link: {upload_link_response.status_code} - {error_text}")
                                         
-                                        # Сохраняем в bytes
-                                        output = io.BytesIO()
-                                        result.save(output, format="PNG")
-                                        output.seek(0)
-                                        white_bg_bytes = output.read()
+                                        upload_url = orjson.loads(upload_link_response.content)["href"]
+                                        upload_response = await upload_client.put(
+                                            upload_url,
+                                            content=white_bg_bytes,
+                                            headers={"Content-Type": "image/png"},
+                                            timeout=60.0
+                                        )
                                         
-                                        # Сохраняем на Yandex Disk
-                                        save_name = f"{file_name.rsplit('.', 1)[0]}_processed.png"
-                                        save_path = f"{output_path}/{save_name}"
+                                        if upload_response.status_code not in [201, 202]:
+                                            error_text = upload_response.text
+                                            logger.error(f"    Failed to upload {save_name}: {upload_response.status_code} - {error_text}")
+                                            raise Exception(f"Failed to upload file: {upload_response.status_code} - {error_text}")
                                         
-                                        # Проверяем, существует ли файл уже
-                                        if save_name in existing_files:
-                                            logger.info(f"    ⏭ Пропущен (уже существует): {save_name}")
-                                            yield await send_progress_update({
-                                                "type": "file_complete",
-                                                "folder_name": current_name,
-                                                "file_name": file_name,
-                                                "saved_name": save_name,
-                                                "message": f"⏭ Файл уже существует, пропущен: {save_name}"
-                                            })
-                                            continue
+                                        results["files_processed"] += 1
+                                        logger.info(f"    ✓ Saved: {save_name} to {save_path}")
+                                        existing_files.add(save_name)  # Добавляем в список существующих
                                         
                                         yield await send_progress_update({
-                                            "type": "saving",
+                                            "type": "file_complete",
                                             "folder_name": current_name,
                                             "file_name": file_name,
                                             "saved_name": save_name,
-                                            "save_path": save_path,
-                                            "message": f"Сохранение: {save_name}"
+                                            "message": f"✓ Файл обработан и сохранен: {save_name} в {output_path}"
                                         })
-                                        
-                                        try:
-                                            async with httpx.AsyncClient() as upload_client:
-                                                upload_link_response = await upload_client.get(
-                                                    "https://cloud-api.yandex.net/v1/disk/resources/upload",
-                                                    params={"path": save_path, "overwrite": "false"},
-                                                    headers={"Authorization": f"OAuth {token}"},
-                                                    timeout=30.0
-                                                )
-                                                
-                                                if upload_link_response.status_code != 200:
-                                                    error_text = upload_link_response.text
-                                                    logger.error(f"    Failed to get upload link for {save_path}: {upload_link_response.status_code} - {error_text}")
-                                                    raise Exception(f"Failed to get upload link: {upload_link_response.status_code} - {error_text}")
-                                                
-                                                upload_url = upload_link_response.json()["href"]
-                                                upload_response = await upload_client.put(
-                                                    upload_url,
-                                                    content=white_bg_bytes,
-                                                    headers={"Content-Type": "image/png"},
-                                                    timeout=60.0
-                                                )
-                                                
-                                                if upload_response.status_code not in [201, 202]:
-                                                    error_text = upload_response.text
-                                                    logger.error(f"    Failed to upload {save_name}: {upload_response.status_code} - {error_text}")
-                                                    raise Exception(f"Failed to upload file: {upload_response.status_code} - {error_text}")
-                                            
-                                            results["files_processed"] += 1
-                                            logger.info(f"    ✓ Saved: {save_name} to {save_path}")
-                                            existing_files.add(save_name)  # Добавляем в список существующих
-                                            
-                                            yield await send_progress_update({
-                                                "type": "file_complete",
-                                                "folder_name": current_name,
-                                                "file_name": file_name,
-                                                "saved_name": save_name,
-                                                "message": f"✓ Файл обработан и сохранен: {save_name} в {output_path}"
-                                            })
-                                        except Exception as save_error:
-                                            error_msg = f"Ошибка сохранения {save_name}: {str(save_error)}"
-                                            logger.error(f"    {error_msg}")
-                                            results["errors"].append(error_msg)
-                                            yield await send_progress_update({
-                                                "type": "file_error",
-                                                "folder_name": current_name,
-                                                "file_name": file_name,
-                                                "error": error_msg,
-                                                "message": f"⚠️ {error_msg}"
-                                            })
-                                            continue
-                                        
+                                    except Exception as save_error:
+                                        error_msg = f"Ошибка сохранения {save_name}: {str(save_error)}"
+                                        logger.error(f"    {error_msg}")
+                                        results["errors"].append(error_msg)
                                         yield await send_progress_update({
-                                            "type": "file_complete",
+                                            "type": "file_error",
                                             "folder_name": current_name,
                                             "file_name": file_name,
-                                            "saved_name": save_name,
-                                            "message": f"✓ Файл обработан и сохранен: {save_name}"
+                                            "error": error_msg,
+                                            "message": f"⚠️ {error_msg}"
                                         })
-                                    except Exception as e:
-                                        logger.error(f"    Error processing {file_info.get('name', 'unknown')}: {str(e)}")
-                                        results["errors"].append(f"{file_info.get('name', 'unknown')}: {str(e)}")
                                         continue
+                                    
+                                    yield await send_progress_update({
+                                        "type": "file_complete",
+                                        "folder_name": current_name,
+                                        "file_name": file_name,
+                                        "saved_name": save_name,
+                                        "message": f"✓ Файл обработан и сохранен: {save_name}"
+                                    })
+                                except Exception as e:
+                                    logger.error(f"    Error processing {file_info.get('name', 'unknown')}: {str(e)}")
+                                    results["errors"].append(f"{file_info.get('name', 'unknown')}: {str(e)}")
+                                    continue
+                            
+                            # После обработки всех файлов проверяем наличие дизайна и создаем его, если нужно
+                            # Повторно проверяем наличие дизайна в папке "Обработанный"
+                            design_exists = False
+                            first_processed_file_name = None
+                            try:
+                                check_client = get_http_client()
+                                if use_public_api:
+                                    check_response = await check_client.get(
+                                        "https://cloud-api.yandex.net/v1/disk/public/resources",
+                                        params={"public_key": public_key, "path": output_path, "limit": 1000},
+                                        headers=auth_headers,
+                                        timeout=30.0
+                                    )
+                                else:
+                                    check_response = await check_client.get(
+                                        "https://cloud-api.yandex.net/v1/disk/resources",
+                                        params={"path": output_path, "limit": 1000},
+                                        headers=auth_headers,
+                                        timeout=30.0
+                                    )
                                 
-                                # После обработки всех файлов проверяем наличие дизайна и создаем его, если нужно
-                                # Повторно проверяем наличие дизайна в папке "Обработанный"
-                                design_exists = False
-                                first_processed_file_name = None
+                                if check_response.status_code == 200:
+                                    check_data = orjson.loads(check_response.content)
+                                    check_items = check_data.get("_embedded", {}).get("items", [])
+                                    if not check_items and use_public_api:
+                                        check_items = check_data.get("items", [])
+                                    
+                                    for item in check_items:
+                                        if item.get("type") == "file":
+                                            file_name_check = item.get("name", "")
+                                            # Проверяем наличие дизайна
+                                            if file_name_check.endswith("_design.png"):
+                                                design_exists = True
+                                            # Сохраняем имя первого обработанного файла (не дизайна)
+                                            elif file_name_check.endswith("_processed.png") and first_processed_file_name is None:
+                                                first_processed_file_name = file_name_check
+                            except Exception as e:
+                                logger.warning(f"    Не удалось проверить наличие дизайна в {output_path}: {str(e)}")
+                            
+                            # Если дизайна нет, создаем его из первого обработанного файла
+                            if not design_exists and first_processed_file_name:
                                 try:
-                                    async with httpx.AsyncClient() as check_client:
+                                    # Находим исходное имя файла (без _processed.png)
+                                    original_file_name = first_processed_file_name.replace("_processed.png", "")
+                                    # Ищем исходный файл в списке обработанных файлов
+                                    source_file_name = None
+                                    for file_info in current_files:
+                                        if file_info.get("name", "").rsplit('.', 1)[0] == original_file_name.rsplit('.', 1)[0]:
+                                            source_file_name = file_info.get("name", "")
+                                            break
+                                    
+                                    if source_file_name:
+                                        # Скачиваем обработанный файл для создания дизайна
+                                        download_client = get_http_client()
                                         if use_public_api:
-                                            check_response = await check_client.get(
-                                                "https://cloud-api.yandex.net/v1/disk/public/resources",
-                                                params={"public_key": public_key, "path": output_path, "limit": 1000},
-                                                headers={"Authorization": f"OAuth {token}"},
+                                            processed_file_path = f"{output_path}/{first_processed_file_name}"
+                                            link_response = await download_client.get(
+                                                "https://cloud-api.yandex.net/v1/disk/public/resources/download",
+                                                params={"public_key": public_key, "path": processed_file_path},
+                                                headers=auth_headers,
                                                 timeout=30.0
                                             )
                                         else:
-                                            check_response = await check_client.get(
-                                                "https://cloud-api.yandex.net/v1/disk/resources",
-                                                params={"path": output_path, "limit": 1000},
-                                                headers={"Authorization": f"OAuth {token}"},
+                                            link_response = await download_client.get(
+                                                "https://cloud-api.yandex.net/v1/disk/resources/download",
+                                                params={"path": f"{output_path}/{first_processed_file_name}"},
+                                                headers=auth_headers,
                                                 timeout=30.0
                                             )
                                         
-                                        if check_response.status_code == 200:
-                                            check_data = check_response.json()
-                                            check_items = check_data.get("_embedded", {}).get("items", [])
-                                            if not check_items and use_public_api:
-                                                check_items = check_data.get("items", [])
+                                        if link_response.status_code == 200:
+                                            download_url = orjson.loads(link_response.content)["href"]
+                                            file_response = await send_following_redirects(download_client, download_client.build_request("GET", download_url, timeout=60.0))
                                             
-                                            for item in check_items:
-                                                if item.get("type") == "file":
-                                                    file_name_check = item.get("name", "")
-                                                    # Проверяем наличие дизайна
-                                                    if file_name_check.endswith("_design.png"):
-                                                        design_exists = True
-                                                    # Сохраняем имя первого обработанного файла (не дизайна)
-                                                    elif file_name_check.endswith("_processed.png") and first_processed_file_name is None:
-                                                        first_processed_file_name = file_name_check
-                                except Exception as e:
-                                    logger.warning(f"    Не удалось проверить наличие дизайна в {output_path}: {str(e)}")
-                                
-                                # Если дизайна нет, создаем его из первого обработанного файла
-                                if not design_exists and first_processed_file_name:
-                                    try:
-                                        # Находим исходное имя файла (без _processed.png)
-                                        original_file_name = first_processed_file_name.replace("_processed.png", "")
-                                        # Ищем исходный файл в списке обработанных файлов
-                                        source_file_name = None
-                                        for file_info in current_files:
-                                            if file_info.get("name", "").rsplit('.', 1)[0] == original_file_name.rsplit('.', 1)[0]:
-                                                source_file_name = file_info.get("name", "")
-                                                break
-                                        
-                                        if source_file_name:
-                                            # Скачиваем обработанный файл для создания дизайна
-                                            async with httpx.AsyncClient() as download_client:
-                                                if use_public_api:
-                                                    processed_file_path = f"{output_path}/{first_processed_file_name}"
-                                                    link_response = await download_client.get(
-                                                        "https://cloud-api.yandex.net/v1/disk/public/resources/download",
-                                                        params={"public_key": public_key, "path": processed_file_path},
-                                                        headers={"Authorization": f"OAuth {token}"},
-                                                        timeout=30.0
-                                                    )
-                                                else:
-                                                    link_response = await download_client.get(
-                                                        "https://cloud-api.yandex.net/v1/disk/resources/download",
-                                                        params={"path": f"{output_path}/{first_processed_file_name}"},
-                                                        headers={"Authorization": f"OAuth {token}"},
-                                                        timeout=30.0
-                                                    )
+                                            if file_response.status_code == 200:
+                                                processed_bytes = file_response.content
                                                 
-                                                if link_response.status_code == 200:
-                                                    download_url = link_response.json()["href"]
-                                                    file_response = await download_client.get(download_url, timeout=60.0, follow_redirects=True)
-                                                    
-                                                    if file_response.status_code == 200:
-                                                        processed_bytes = file_response.content
-                                                        
-                                                        # Создаем дизайн
-                                            async for update in create_design_generator(
-                                                            processed_bytes, source_file_name, current_name, output_path,
-                                                token, use_public_api, public_key, api_key, design_count, results
-                                            ):
-                                                yield update
-                                    except Exception as e:
-                                        logger.warning(f"    Не удалось создать дизайн для {current_name}: {str(e)}")
-                                        results["errors"].append(f"Design creation failed for {current_name}: {str(e)}")
-                        
-                        # Рекурсивно обрабатываем все подпапки
-                        for subfolder in current_subfolders:
-                            subfolder_path = subfolder.get("path", "")
-                            subfolder_name = subfolder.get("name", "")
-                            async for update in process_folder_recursive(subfolder_path, subfolder_name, depth + 1, max_depth, False, design_created_flag):
-                                yield update
+                                                # Создаем дизайн
+                                        async for update in create_design_generator(
+                                                        processed_bytes, source_file_name, current_name, output_path,
+                                            token, use_public_api, public_key, api_key, design_count, results
+                                        ):
+                                            yield update
+                                except Exception as e:
+                                    logger.warning(f"    Не удалось создать дизайн для {current_name}: {str(e)}")
+                                    results["errors"].append(f"Design creation failed for {current_name}: {str(e)}")
+                    
+                    # Рекурсивно обрабатываем все подпапки
+                    for subfolder in current_subfolders:
+                        subfolder_path = subfolder.get("path", "")
+                        subfolder_name = subfolder.get("name", "")
+                        async for update in process_folder_recursive(subfolder_path, subfolder_name, depth + 1, max_depth, False, design_created_flag):
+                            yield update
                 
                 except Exception as e:
                     logger.error(f"Error processing folder {current_name}: {str(e)}")
@@ -2866,31 +3486,31 @@ async def batch_process_folders(
                 main_output_path = f"{folder_path}/{output_folder_name}"
                 existing_files = set()
                 try:
-                    async with httpx.AsyncClient() as check_client:
-                        if use_public_api:
-                            check_response = await check_client.get(
-                                "https://cloud-api.yandex.net/v1/disk/public/resources",
-                                params={"public_key": public_key, "path": main_output_path, "limit": 1000},
-                                headers={"Authorization": f"OAuth {token}"},
-                                timeout=30.0
-                            )
-                        else:
-                            check_response = await check_client.get(
-                                "https://cloud-api.yandex.net/v1/disk/resources",
-                                params={"path": main_output_path, "limit": 1000},
-                                headers={"Authorization": f"OAuth {token}"},
-                                timeout=30.0
-                            )
+                    check_client = get_http_client()
+                    if use_public_api:
+                        check_response = await check_client.get(
+                            "https://cloud-api.yandex.net/v1/disk/public/resources",
+                            params={"public_key": public_key, "path": main_output_path, "limit": 1000},
+                            headers=auth_headers,
+                            timeout=30.0
+                        )
+                    else:
+                        check_response = await check_client.get(
+                            "https://cloud-api.yandex.net/v1/disk/resources",
+                            params={"path": main_output_path, "limit": 1000},
+                            headers=auth_headers,
+                            timeout=30.0
+                        )
+                    
+                    if check_response.status_code == 200:
+                        check_data = orjson.loads(check_response.content)
+                        check_items = check_data.get("_embedded", {}).get("items", [])
+                        if not check_items and use_public_api:
+                            check_items = check_data.get("items", [])
                         
-                        if check_response.status_code == 200:
-                            check_data = check_response.json()
-                            check_items = check_data.get("_embedded", {}).get("items", [])
-                            if not check_items and use_public_api:
-                                check_items = check_data.get("items", [])
-                            
-                            for item in check_items:
-                                if item.get("type") == "file":
-                                    existing_files.add(item.get("name", ""))
+                        for item in check_items:
+                            if item.get("type") == "file":
+                                existing_files.add(item.get("name", ""))
                 except:
                     pass  # Если папка не существует, это нормально
                 
@@ -2909,37 +3529,37 @@ async def batch_process_folders(
                     design_exists = False
                     first_processed_file_name = None
                     try:
-                        async with httpx.AsyncClient() as check_client:
-                            if use_public_api:
-                                check_response = await check_client.get(
-                                    "https://cloud-api.yandex.net/v1/disk/public/resources",
-                                    params={"public_key": public_key, "path": main_output_path, "limit": 1000},
-                                    headers={"Authorization": f"OAuth {token}"},
-                                    timeout=30.0
-                                )
-                            else:
-                                check_response = await check_client.get(
-                                    "https://cloud-api.yandex.net/v1/disk/resources",
-                                    params={"path": main_output_path, "limit": 1000},
-                                    headers={"Authorization": f"OAuth {token}"},
-                                    timeout=30.0
-                                )
+                        check_client = get_http_client()
+                        if use_public_api:
+                            check_response = await check_client.get(
+                                "https://cloud-api.yandex.net/v1/disk/public/resources",
+                                params={"public_key": public_key, "path": main_output_path, "limit": 1000},
+                                headers=auth_headers,
+                                timeout=30.0
+                            )
+                        else:
+                            check_response = await check_client.get(
+                                "https://cloud-api.yandex.net/v1/disk/resources",
+                                params={"path": main_output_path, "limit": 1000},
+                                headers=auth_headers,
+                                timeout=30.0
+                            )
+                        
+                        if check_response.status_code == 200:
+                            check_data = orjson.loads(check_response.content)
+                            check_items = check_data.get("_embedded", {}).get("items", [])
+                            if not check_items and use_public_api:
+                                check_items = check_data.get("items", [])
                             
-                            if check_response.status_code == 200:
-                                check_data = check_response.json()
-                                check_items = check_data.get("_embedded", {}).get("items", [])
-                                if not check_items and use_public_api:
-                                    check_items = check_data.get("items", [])
-                                
-                                for item in check_items:
-                                    if item.get("type") == "file":
-                                        file_name_check = item.get("name", "")
-                                        # Проверяем наличие дизайна
-                                        if file_name_check.endswith("_design.png"):
-                                            design_exists = True
-                                        # Сохраняем имя первого обработанного файла (не дизайна)
-                                        elif file_name_check.endswith("_processed.png") and first_processed_file_name is None:
-                                            first_processed_file_name = file_name_check
+                            for item in check_items:
+                                if item.get("type") == "file":
+                                    file_name_check = item.get("name", "")
+                                    # Проверяем наличие дизайна
+                                    if file_name_check.endswith("_design.png"):
+                                        design_exists = True
+                                    # Сохраняем имя первого обработанного файла (не дизайна)
+                                    elif file_name_check.endswith("_processed.png") and first_processed_file_name is None:
+                                        first_processed_file_name = file_name_check
                     except Exception as e:
                         logger.warning(f"    Не удалось проверить наличие дизайна в {main_output_path}: {str(e)}")
                     
@@ -2957,48 +3577,48 @@ async def batch_process_folders(
                             
                             if source_file_name:
                                 # Скачиваем обработанный файл для создания дизайна
-                                async with httpx.AsyncClient() as download_client:
-                                    if use_public_api:
-                                        processed_file_path = f"{main_output_path}/{first_processed_file_name}"
-                                        link_response = await download_client.get(
-                                            "https://cloud-api.yandex.net/v1/disk/public/resources/download",
-                                            params={"public_key": public_key, "path": processed_file_path},
-                                            headers={"Authorization": f"OAuth {token}"},
-                                            timeout=30.0
-                                        )
-                                    else:
-                                        link_response = await download_client.get(
-                                            "https://cloud-api.yandex.net/v1/disk/resources/download",
-                                            params={"path": f"{main_output_path}/{first_processed_file_name}"},
-                                            headers={"Authorization": f"OAuth {token}"},
-                                            timeout=30.0
-                                        )
+                                download_client = get_http_client()
+                                if use_public_api:
+                                    processed_file_path = f"{main_output_path}/{first_processed_file_name}"
+                                    link_response = await download_client.get(
+                                        "https://cloud-api.yandex.net/v1/disk/public/resources/download",
+                                        params={"public_key": public_key, "path": processed_file_path},
+                                        headers=auth_headers,
+                                        timeout=30.0
+                                    )
+                                else:
+                                    link_response = await download_client.get(
+                                        "https://cloud-api.yandex.net/v1/disk/resources/download",
+                                        params={"path": f"{main_output_path}/{first_processed_file_name}"},
+                                        headers=auth_headers,
+                                        timeout=30.0
+                                    )
+                                
+                                if link_response.status_code == 200:
+                                    download_url = orjson.loads(link_response.content)["href"]
+                                    file_response = await send_following_redirects(download_client, download_client.build_request("GET", download_url, timeout=60.0))
                                     
-                                    if link_response.status_code == 200:
-                                        download_url = link_response.json()["href"]
-                                        file_response = await download_client.get(download_url, timeout=60.0, follow_redirects=True)
+                                    if file_response.status_code == 200:
+                                        processed_bytes = file_response.content
                                         
-                                        if file_response.status_code == 200:
-                                            processed_bytes = file_response.content
-                                            
-                                            # Создаем дизайн
-                                            async for update in create_design_generator(
-                                                processed_bytes, source_file_name, folder_name, main_output_path,
-                                                token, use_public_api, public_key, api_key, design_count, results
-                                            ):
-                                                yield update
+                                        # Создаем дизайн
+                                        async for update in create_design_generator(
+                                            processed_bytes, source_file_name, folder_name, main_output_path,
+                                            token, use_public_api, public_key, api_key, design_count, results
+                                        ):
+                                            yield update
                         except Exception as e:
                             logger.warning(f"    Не удалось создать дизайн для главной папки {folder_name}: {str(e)}")
                             results["errors"].append(f"Design creation failed for {folder_name}: {str(e)}")
                 else:
                     # Создаем папку для результатов только если есть файлы для обработки
-                    async with httpx.AsyncClient() as create_client:
-                        create_response = await create_client.put(
-                            "https://cloud-api.yandex.net/v1/disk/resources",
-                            params={"path": main_output_path},
-                            headers={"Authorization": f"OAuth {token}"},
-                            timeout=30.0
-                        )
+                    create_client = get_http_client()
+                    create_response = await create_client.put(
+                        "https://cloud-api.yandex.net/v1/disk/resources",
+                        params={"path": main_output_path},
+                        headers=auth_headers,
+                        timeout=30.0
+                    )
                     
                 yield await send_progress_update({
                     "type": "folder_start",
@@ -3029,35 +3649,35 @@ async def batch_process_folders(
                         # Скачиваем файл
                         file_is_public = use_public_api
                         
-                        async with httpx.AsyncClient() as client:
-                            if file_is_public:
-                                # Для публичных файлов используем другой endpoint
-                                public_file_path = f"{folder_path}/{file_name}" if folder_path else file_name
-                                link_response = await client.get(
-                                    "https://cloud-api.yandex.net/v1/disk/public/resources/download",
-                                    params={"public_key": public_key, "path": public_file_path},
-                                    headers={"Authorization": f"OAuth {token}"},
-                                    timeout=30.0
-                                )
-                            else:
-                                # Для приватных файлов используем обычный endpoint
-                                link_response = await client.get(
-                                    "https://cloud-api.yandex.net/v1/disk/resources/download",
-                                    params={"path": file_path},
-                                    headers={"Authorization": f"OAuth {token}"},
-                                    timeout=30.0
-                                )
-                            
-                            if link_response.status_code != 200:
-                                raise Exception(f"Failed to get download link: {link_response.status_code}")
-                            
-                            download_url = link_response.json()["href"]
-                            file_response = await client.get(download_url, timeout=60.0, follow_redirects=True)
-                            
-                            if file_response.status_code != 200:
-                                raise Exception(f"Failed to download file: {file_response.status_code}")
-                            
-                            image_bytes = file_response.content
+                        client = get_http_client()
+                        if file_is_public:
+                            # Для публичных файлов используем другой endpoint
+                            public_file_path = f"{folder_path}/{file_name}" if folder_path else file_name
+                            link_response = await client.get(
+                                "https://cloud-api.yandex.net/v1/disk/public/resources/download",
+                                params={"public_key": public_key, "path": public_file_path},
+                                headers=auth_headers,
+                                timeout=30.0
+                            )
+                        else:
+                            # Для приватных файлов используем обычный endpoint
+                            link_response = await client.get(
+                                "https://cloud-api.yandex.net/v1/disk/resources/download",
+                                params={"path": file_path},
+                                headers=auth_headers,
+                                timeout=30.0
+                            )
+                        
+                        if link_response.status_code != 200:
+                            raise Exception(f"Failed to get download link: {link_response.status_code}")
+                        
+                        download_url = orjson.loads(link_response.content)["href"]
+                        file_response = await send_following_redirects(client, client.build_request("GET", download_url, timeout=60.0))
+                        
+                        if file_response.status_code != 200:
+                            raise Exception(f"Failed to download file: {file_response.status_code}")
+                        
+                        image_bytes = file_response.content
                         
                         # Обрабатываем через удаление фона
                         yield await send_progress_update({
@@ -3073,39 +3693,15 @@ async def batch_process_folders(
                             delay_seconds = 11  # 11 секунд между запросами = ~5 запросов в минуту
                             await asyncio.sleep(delay_seconds)
                         
-                        processed_bytes = await MODELS[model](image_bytes, api_key, None)
+                        async with MODEL_SEMAPHORES[model]:
+                            processed_bytes = await MODELS[model](image_bytes, api_key, None)
                         bg_count[0] += 1
                         background_removal_count = bg_count[0]
                         
-                        # Размещаем на белом фоне с заданным размером
-                        processed_img = Image.open(io.BytesIO(processed_bytes))
+                        # Размещаем на белом фоне с заданным размером (PIL - в потоке, не блокируя event loop)
                         template_width = max(100, min(5000, width))
                         template_height = max(100, min(5000, height))
-                        template_img = Image.new("RGB", (template_width, template_height), "white")
-                        
-                        img_width, img_height = processed_img.size
-                        scale_width = template_width / img_width
-                        scale_height = template_height / img_height
-                        scale = min(scale_width, scale_height)
-                        
-                        new_width = int(img_width * scale)
-                        new_height = int(img_height * scale)
-                        processed_img = processed_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                        
-                        x = (template_width - new_width) // 2
-                        y = (template_height - new_height) // 2
-                        
-                        result = template_img.copy()
-                        if processed_img.mode == "RGBA":
-                            result.paste(processed_img, (x, y), processed_img)
-                        else:
-                            result.paste(processed_img, (x, y))
-                        
-                        # Сохраняем в bytes
-                        output = io.BytesIO()
-                        result.save(output, format="PNG")
-                        output.seek(0)
-                        white_bg_bytes = output.read()
+                        white_bg_bytes = await asyncio.to_thread(compose_template, processed_bytes, template_width, template_height)
                         
                         # Сохраняем на Yandex Disk
                         save_name = f"{file_name.rsplit('.', 1)[0]}_processed.png"
@@ -3133,31 +3729,31 @@ async def batch_process_folders(
                         })
                         
                         try:
-                            async with httpx.AsyncClient() as client:
-                                upload_link_response = await client.get(
-                                    "https://cloud-api.yandex.net/v1/disk/resources/upload",
-                                    params={"path": save_path, "overwrite": "false"},
-                                    headers={"Authorization": f"OAuth {token}"},
-                                    timeout=30.0
-                                )
-                                
-                                if upload_link_response.status_code != 200:
-                                    error_text = upload_link_response.text
-                                    logger.error(f"    Failed to get upload link for {save_path}: {upload_link_response.status_code} - {error_text}")
-                                    raise Exception(f"Failed to get upload link: {upload_link_response.status_code} - {error_text}")
-                                
-                                upload_url = upload_link_response.json()["href"]
-                                upload_response = await client.put(
-                                    upload_url,
-                                    content=white_bg_bytes,
-                                    headers={"Content-Type": "image/png"},
-                                    timeout=60.0
-                                )
-                                
-                                if upload_response.status_code not in [201, 202]:
-                                    error_text = upload_response.text
-                                    logger.error(f"    Failed to upload {save_name}: {upload_response.status_code} - {error_text}")
-                                    raise Exception(f"Failed to upload file: {upload_response.status_code} - {error_text}")
+                            client = get_http_client()
+                            upload_link_response = await client.get(
+                                "https://cloud-api.yandex.net/v1/disk/resources/upload",
+                                params={"path": save_path, "overwrite": "false"},
+                                headers=auth_headers,
+                                timeout=30.0
+                            )
+                            
+                            if upload_link_response.status_code != 200:
+                                error_text = upload_link_response.text
+                                logger.error(f"    Failed to get upload link for {save_path}: {upload_link_response.status_code} - {error_text}")
+                                raise Exception(f"Failed to get upload link: {upload_link_response.status_code} - {error_text}")
+                            
+                            upload_url = orjson.loads(upload_link_response.content)["href"]
+                            upload_response = await client.put(
+                                upload_url,
+                                content=white_bg_bytes,
+                                headers={"Content-Type": "image/png"},
+                                timeout=60.0
+                            )
+                            
+                            if upload_response.status_code not in [201, 202]:
+                                error_text = upload_response.text
+                                logger.error(f"    Failed to upload {save_name}: {upload_response.status_code} - {error_text}")
+                                raise Exception(f"Failed to upload file: {upload_response.status_code} - {error_text}")
                             
                             results["files_processed"] += 1
                             logger.info(f"    ✓ Saved: {save_name} to {save_path}")
@@ -3201,37 +3797,37 @@ async def batch_process_folders(
                 design_exists = False
                 first_processed_file_name = None
                 try:
-                    async with httpx.AsyncClient() as check_client:
-                        if use_public_api:
-                            check_response = await check_client.get(
-                                "https://cloud-api.yandex.net/v1/disk/public/resources",
-                                params={"public_key": public_key, "path": main_output_path, "limit": 1000},
-                                headers={"Authorization": f"OAuth {token}"},
-                                timeout=30.0
-                            )
-                        else:
-                            check_response = await check_client.get(
-                                "https://cloud-api.yandex.net/v1/disk/resources",
-                                params={"path": main_output_path, "limit": 1000},
-                                headers={"Authorization": f"OAuth {token}"},
-                                timeout=30.0
-                            )
+                    check_client = get_http_client()
+                    if use_public_api:
+                        check_response = await check_client.get(
+                            "https://cloud-api.yandex.net/v1/disk/public/resources",
+                            params={"public_key": public_key, "path": main_output_path, "limit": 1000},
+                            headers=auth_headers,
+                            timeout=30.0
+                        )
+                    else:
+                        check_response = await check_client.get(
+                            "https://cloud-api.yandex.net/v1/disk/resources",
+                            params={"path": main_output_path, "limit": 1000},
+                            headers=auth_headers,
+                            timeout=30.0
+                        )
+                    
+                    if check_response.status_code == 200:
+                        check_data = orjson.loads(check_response.content)
+                        check_items = check_data.get("_embedded", {}).get("items", [])
+                        if not check_items and use_public_api:
+                            check_items = check_data.get("items", [])
                         
-                        if check_response.status_code == 200:
-                            check_data = check_response.json()
-                            check_items = check_data.get("_embedded", {}).get("items", [])
-                            if not check_items and use_public_api:
-                                check_items = check_data.get("items", [])
-                            
-                            for item in check_items:
-                                if item.get("type") == "file":
-                                    file_name_check = item.get("name", "")
-                                    # Проверяем наличие дизайна
-                                    if file_name_check.endswith("_design.png"):
-                                        design_exists = True
-                                    # Сохраняем имя первого обработанного файла (не дизайна)
-                                    elif file_name_check.endswith("_processed.png") and first_processed_file_name is None:
-                                        first_processed_file_name = file_name_check
+                        for item in check_items:
+                            if item.get("type") == "file":
+                                file_name_check = item.get("name", "")
+                                # Проверяем наличие дизайна
+                                if file_name_check.endswith("_design.png"):
+                                    design_exists = True
+                                # Сохраняем имя первого обработанного файла (не дизайна)
+                                elif file_name_check.endswith("_processed.png") and first_processed_file_name is None:
+                                    first_processed_file_name = file_name_check
                 except Exception as e:
                     logger.warning(f"    Не удалось проверить наличие дизайна в {main_output_path}: {str(e)}")
                 
@@ -3249,36 +3845,36 @@ async def batch_process_folders(
                         
                         if source_file_name:
                             # Скачиваем обработанный файл для создания дизайна
-                            async with httpx.AsyncClient() as download_client:
-                                if use_public_api:
-                                    processed_file_path = f"{main_output_path}/{first_processed_file_name}"
-                                    link_response = await download_client.get(
-                                        "https://cloud-api.yandex.net/v1/disk/public/resources/download",
-                                        params={"public_key": public_key, "path": processed_file_path},
-                                        headers={"Authorization": f"OAuth {token}"},
-                                        timeout=30.0
-                                    )
-                                else:
-                                    link_response = await download_client.get(
-                                        "https://cloud-api.yandex.net/v1/disk/resources/download",
-                                        params={"path": f"{main_output_path}/{first_processed_file_name}"},
-                                        headers={"Authorization": f"OAuth {token}"},
-                                        timeout=30.0
-                                    )
+                            download_client = get_http_client()
+                            if use_public_api:
+                                processed_file_path = f"{main_output_path}/{first_processed_file_name}"
+                                link_response = await download_client.get(
+                                    "https://cloud-api.yandex.net/v1/disk/public/resources/download",
+                                    params={"public_key": public_key, "path": processed_file_path},
+                                    headers=auth_headers,
+                                    timeout=30.0
+                                )
+                            else:
+                                link_response = await download_client.get(
+                                    "https://cloud-api.yandex.net/v1/disk/resources/download",
+                                    params={"path": f"{main_output_path}/{first_processed_file_name}"},
+                                    headers=auth_headers,
+                                    timeout=30.0
+                                )
+                            
+                            if link_response.status_code == 200:
+                                download_url = orjson.loads(link_response.content)["href"]
+                                file_response = await send_following_redirects(download_client, download_client.build_request("GET", download_url, timeout=60.0))
                                 
-                                if link_response.status_code == 200:
-                                    download_url = link_response.json()["href"]
-                                    file_response = await download_client.get(download_url, timeout=60.0, follow_redirects=True)
+                                if file_response.status_code == 200:
+                                    processed_bytes = file_response.content
                                     
-                                    if file_response.status_code == 200:
-                                        processed_bytes = file_response.content
-                                        
-                                        # Создаем дизайн
-                                        async for update in create_design_generator(
-                                            processed_bytes, source_file_name, folder_name, main_output_path,
-                                            token, use_public_api, public_key, api_key, design_count, results
-                                        ):
-                                            yield update
+                                    # Создаем дизайн
+                                    async for update in create_design_generator(
+                                        processed_bytes, source_file_name, folder_name, main_output_path,
+                                        token, use_public_api, public_key, api_key, design_count, results
+                                    ):
+                                        yield update
                     except Exception as e:
                         logger.warning(f"    Не удалось создать дизайн для главной папки {folder_name}: {str(e)}")
                         results["errors"].append(f"Design creation failed for {folder_name}: {str(e)}")
@@ -3346,5 +3942,14 @@ if __name__ == "__main__":
     import uvicorn
     # Railway и другие платформы устанавливают PORT через переменную окружения
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # uvicorn[standard]: loop="auto"/http="auto" выбирают uvloop и httptools, если они установлены (Linux)
+    # Один процесс - общие HTTP пул и кэши; параллельность за счет asyncio
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=port,
+        loop="auto",
+        http="auto",
+        limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY", 1024))
+    )
 
@@ -0,0 +1,91 @@
+"""
+Testy regresyjne: współdzielenie wyniku identycznych żądań /api/process (INFLIGHT_RESULTS)
+"""
+import asyncio
+import hashlib
+import io
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+from fastapi import UploadFile
+
+# Dodajemy katalog główny do ścieżki, żeby importować main
+sys.path.insert(0, str(Path(__file__).parent))
+
+import main
+
+def make_upload(data: bytes) -> UploadFile:
+    """Plik obrazu jak z formularza"""
+    return UploadFile(file=io.BytesIO(data), size=len(data), filename="image.jpg")
+
+def cache_key_for(data: bytes, model: str) -> str:
+    """Klucz jak w process_image (bez promptu)"""
+    return f"{hashlib.blake2b(data, digest_size=16).hexdigest()}:{model}"
+
+@pytest.fixture
+def fake_fal(monkeypatch):
+    """Model fal zwracający otwarty strumień, bez zmniejszania obrazu"""
+    calls = []
+    upstreams = []
+
+    async def fake_model(image_bytes, api_key, prompt=None, mime=None, stream=False):
+        calls.append(image_bytes)
+        upstream = httpx.Response(200, stream=httpx.ByteStream(b"RESULT"))
+        upstreams.append(upstream)
+        return upstream
+
+    monkeypatch.setitem(main.MODELS, "fal", fake_model)
+    monkeypatch.setattr(main, "MAX_UPLOAD_EDGE", 0)
+    return calls, upstreams
+
+@pytest.mark.asyncio
+async def test_stream_never_started_releases_inflight(fake_fal):
+    """Klient rozłączył się przed ciałem odpowiedzi: wpis w INFLIGHT_RESULTS znika, połączenie jest zamknięte"""
+    calls, upstreams = fake_fal
+    data = b"\xff\xd8\xff" + b"never-started" * 10
+    key = cache_key_for(data, "fal")
+
+    response = await main.process_image(image=make_upload(data), model="fal", apiKey="k", prompt=None, race=False)
+    assert key in main.INFLIGHT_RESULTS
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        # Oddajemy sterowanie pętli - rozłączenie wygrywa z wysyłaniem ciała
+        await asyncio.sleep(0)
+
+    await response({"type": "http"}, receive, send)
+
+    assert key not in main.INFLIGHT_RESULTS
+    assert upstreams[0].is_closed
+
+    # Kolejne identyczne żądanie nie czeka w nieskończoność, tylko przetwarza obraz samo
+    second = await asyncio.wait_for(
+        main.process_image(image=make_upload(data), model="fal", apiKey="k", prompt=None, race=False),
+        timeout=1,
+    )
+    assert len(calls) == 2
+    await second({"type": "http"}, receive, send)
+    assert key not in main.INFLIGHT_RESULTS
+
+@pytest.mark.asyncio
+async def test_waiter_times_out_on_stuck_inflight(fake_fal, monkeypatch):
+    """Zawieszony identyczny request: oczekujący po INFLIGHT_WAIT_SECONDS przetwarza obraz sam"""
+    calls, upstreams = fake_fal
+    data = b"\xff\xd8\xff" + b"stuck" * 10
+    key = cache_key_for(data, "fal")
+    stuck = asyncio.get_running_loop().create_future()
+    monkeypatch.setitem(main.INFLIGHT_RESULTS, key, stuck)
+    monkeypatch.setattr(main, "INFLIGHT_WAIT_SECONDS", 0.05)
+
+    response = await asyncio.wait_for(
+        main.process_image(image=make_upload(data), model="fal", apiKey="k", prompt=None, race=False),
+        timeout=1,
+    )
+    assert len(calls) == 1
+    assert isinstance(response, main.UpstreamStreamingResponse)
+    await response.upstream.aclose()
+    main.finish_inflight(key, None)
@@ -0,0 +1,80 @@
+"""
+Testy /api/yandex/upload-batch: walidacja, 409 dla pojedynczego pliku, ograniczenie równoległości
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import httpx
+import orjson
+from fastapi.testclient import TestClient
+
+# Dodajemy katalog główny do ścieżki, żeby importować main
+sys.path.insert(0, str(Path(__file__).parent))
+
+import main
+
+def make_files(count: int) -> list:
+    """Pliki formularza files[]"""
+    return [("files", (f"{i}.png", b"PNG%d" % i, "image/png")) for i in range(count)]
+
+def test_files_paths_mismatch_returns_400():
+    """Różna liczba plików i ścieżek - 400"""
+    client = TestClient(main.app)
+    response = client.post(
+        "/api/yandex/upload-batch",
+        files=make_files(2),
+        data={"paths": ["/a.png"], "token": "t"},
+    )
+    assert response.status_code == 400
+
+def test_existing_file_reported_per_file(monkeypatch):
+    """409 przy pobieraniu linku dotyczy tylko tego pliku, pozostałe są wysyłane"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "cloud-api.yandex.net":
+            if request.url.params["path"] == "/exists.png":
+                return httpx.Response(409)
+            return httpx.Response(200, content=orjson.dumps({"href": "https://uploader.disk.yandex.net/put"}))
+        return httpx.Response(201)
+
+    monkeypatch.setattr(main, "http_pool", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    client = TestClient(main.app)
+    response = client.post(
+        "/api/yandex/upload-batch",
+        files=make_files(2),
+        data={"paths": ["/exists.png", "/new.png"], "token": "t"},
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert body["success"] is False
+    assert body["results"] == [
+        {"path": "/exists.png", "success": False, "error": "File already exists"},
+        {"path": "/new.png", "success": True},
+    ]
+
+def test_upload_concurrency_is_bounded(monkeypatch):
+    """Nie więcej niż YANDEX_UPLOAD_CONCURRENCY równoczesnych żądań do Yandex Disk"""
+    active = 0
+    max_active = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal active, max_active
+        active += 1
+        max_active = max(max_active, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        if request.url.host == "cloud-api.yandex.net":
+            return httpx.Response(200, content=orjson.dumps({"href": "https://uploader.disk.yandex.net/put"}))
+        return httpx.Response(201)
+
+    monkeypatch.setattr(main, "http_pool", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(main, "YANDEX_UPLOAD_CONCURRENCY", 2)
+    client = TestClient(main.app)
+    response = client.post(
+        "/api/yandex/upload-batch",
+        files=make_files(6),
+        data={"paths": [f"/{i}.png" for i in range(6)], "token": "t"},
+    )
+    assert response.status_code == 200
+    assert response.json()["success"] is True
+    assert max_active == 2